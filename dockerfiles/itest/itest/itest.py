@@ -1,11 +1,15 @@
+import BaseHTTPServer
 import contextlib
 import csv
 import json
 import os
 import subprocess
+import tempfile
+import threading
 import time
 import urllib2
 import socket
+import SocketServer
 
 import kazoo.client
 import pytest
@@ -118,6 +122,14 @@ YIELD_PARAMS = [
 
 MAP_FILE = '/var/run/synapse/maps/ip_to_service.map'
 
+SYNAPSE_TOOLS_PYTHON = '/opt/venvs/synapse-tools/bin/python'
+
+# For the standalone HAProxy tests of features the HAProxy Synapse runs
+# doesn't have (seamless reloads, pool-max-conn), see the Dockerfiles
+STANDALONE_HAPROXY_PATH = '/usr/bin/haproxy-synapse-2.0'
+SEAMLESS_RELOAD_PORT = 20300
+HTTP_REUSE_PORT = 20301
+
 INITIAL_MAP_FILE_CONTENTS = ''
 with open(MAP_FILE, 'r') as f:
     INITIAL_MAP_FILE_CONTENTS = f.read()
@@ -576,6 +588,61 @@ class TestGroupTwo(object):
             assert test_ip in svc_map
             assert svc_map[test_ip] == test_svc
 
+        map_url = 'http://localhost:32124/?prefix=%s&limit=1' % test_ip
+        request = urllib2.Request(url=map_url)
+        with contextlib.closing(
+                urllib2.urlopen(request, timeout=SOCKET_TIMEOUT)) as page:
+            svc_map = json.loads(page.read())
+            assert svc_map == {test_ip: test_svc}
+
+        map_url = 'http://localhost:32124/?summary=1'
+        request = urllib2.Request(url=map_url)
+        with contextlib.closing(
+                urllib2.urlopen(request, timeout=SOCKET_TIMEOUT)) as page:
+            summary = json.loads(page.read())
+            assert summary['entries'] >= 1
+            assert summary['size_bytes'] > 0
+            assert summary['refreshes'] >= 1
+            assert summary['map_file'] == map_file
+
+    def test_map_debug_paging_and_refresh_time(self):
+        reset_map_file()
+        map_file = '/var/run/synapse/maps/ip_to_service.map'
+        with open(map_file) as f:
+            original = f.read()
+        with open(map_file, 'a') as f:
+            for i in range(10000):
+                f.write('\n10.%d.%d.%d paging-service' % (i // 65536, i // 256 % 256, i % 256))
+
+        try:
+            time.sleep(6)
+
+            map_url = 'http://localhost:32124/?summary=1'
+            with contextlib.closing(
+                    urllib2.urlopen(urllib2.Request(url=map_url), timeout=SOCKET_TIMEOUT)) as page:
+                summary = json.loads(page.read())
+            # Loading 10000 entries takes some time, but nowhere near a second
+            assert 0 < summary['last_refresh_ms'] < 1000
+
+            pages = []
+            for offset in (0, 100):
+                map_url = 'http://localhost:32124/?prefix=10.&offset=%d&limit=100' % offset
+                with contextlib.closing(
+                        urllib2.urlopen(urllib2.Request(url=map_url), timeout=SOCKET_TIMEOUT)) as page:
+                    pages.append(json.loads(page.read()))
+            assert [len(entries) for entries in pages] == [100, 100]
+            # Sorted, so consecutive pages neither overlap nor skip entries
+            assert max(pages[0]) < min(pages[1])
+
+            # Taken as the nearest whole, non-negative number of entries
+            map_url = 'http://localhost:32124/?prefix=10.&offset=-5.5&limit=2.7'
+            with contextlib.closing(
+                    urllib2.urlopen(urllib2.Request(url=map_url), timeout=SOCKET_TIMEOUT)) as page:
+                assert sorted(json.loads(page.read())) == sorted(pages[0])[:2]
+        finally:
+            with open(map_file, 'w') as f:
+                f.write(original)
+
 
 class TestGroupThree(object):
     @staticmethod
@@ -602,3 +669,215 @@ class TestGroupThree(object):
             with contextlib.closing(
                 urllib2.urlopen(request, timeout=SOCKET_TIMEOUT)) as page:
                 assert page.info().dict['x-smartstack-origin'] == '0'
+
+
+def generate_standalone_haproxy(tmpdir, options, service_info=None):
+    """What configure_synapse generates for a standalone HAProxy in `tmpdir`
+
+    configure_synapse only runs under the package's own Python 3, so this
+    asks it in a subprocess.
+    """
+    script = (
+        'import json, sys\n'
+        'from synapse_tools import configure_synapse\n'
+        'args = json.loads(sys.argv[1])\n'
+        'config = configure_synapse.set_defaults(args["options"])\n'
+        'top_level = configure_synapse._generate_haproxy_top_level(config)\n'
+        'result = {key: top_level[key] for key in '
+        '("global", "defaults", "reload_command")}\n'
+        'if args["service_info"] is not None:\n'
+        '    result["service"] = configure_synapse._generate_haproxy_for_watcher(\n'
+        '        "itest", args["service_info"], config)\n'
+        'print(json.dumps(result))\n'
+    )
+    options = dict({
+        'bind_addr': '0.0.0.0',
+        'haproxy_path': STANDALONE_HAPROXY_PATH,
+        'haproxy_config_path': os.path.join(tmpdir, 'haproxy.cfg'),
+        'haproxy_pid_file_path': os.path.join(tmpdir, 'haproxy.pid'),
+        'haproxy_socket_file_path': os.path.join(tmpdir, 'haproxy.sock'),
+    }, **options)
+    return json.loads(subprocess.check_output([
+        SYNAPSE_TOOLS_PYTHON, '-c', script,
+        json.dumps({'options': options, 'service_info': service_info}),
+    ]))
+
+
+@contextlib.contextmanager
+def standalone_haproxy(tmpdir, generated, sections):
+    """Runs HAProxy with the generated global and defaults sections"""
+    if not os.path.exists(STANDALONE_HAPROXY_PATH):
+        pytest.skip('%s is not installed' % STANDALONE_HAPROXY_PATH)
+
+    lines = ['global'] + ['    ' + line for line in generated['global']]
+    lines += ['defaults'] + ['    ' + line for line in generated['defaults']]
+    for header, section in sections:
+        lines += [header] + ['    ' + line for line in section]
+    config_path = os.path.join(tmpdir, 'haproxy.cfg')
+    with open(config_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    pid_path = os.path.join(tmpdir, 'haproxy.pid')
+    subprocess.check_call([
+        STANDALONE_HAPROXY_PATH, '-f', config_path, '-p', pid_path])
+    time.sleep(1)
+    try:
+        yield
+    finally:
+        # After reloads the pidfile names the current instance
+        with open(pid_path) as f:
+            for pid in f.read().split():
+                subprocess.call(['kill', pid])
+
+
+class TestSeamlessReload(object):
+    """Reloads a standalone HAProxy the way configure_synapse tells Synapse
+    to with haproxy_seamless_reload, while a client keeps connecting
+    """
+
+    RELOADS = 10
+
+    def test_seamless_reload_drops_no_connections(self):
+        tmpdir = tempfile.mkdtemp()
+        generated = generate_standalone_haproxy(tmpdir, {'haproxy_seamless_reload': True})
+        assert ' -x ' in generated['reload_command']
+
+        data = SERVICES['service_three.main']
+        listen = [
+            'bind 0.0.0.0:%d' % SEAMLESS_RELOAD_PORT,
+            'server service_three %s:%d' % (data['ip_address'], data['port']),
+        ]
+        uri = 'http://localhost:%d%s' % (SEAMLESS_RELOAD_PORT, data['healthcheck_uri'])
+        stop = threading.Event()
+        results = {'ok': 0, 'errors': []}
+
+        def hammer():
+            while not stop.is_set():
+                try:
+                    with contextlib.closing(
+                            urllib2.urlopen(uri, timeout=SOCKET_TIMEOUT)) as page:
+                        assert page.read().strip() == 'OK'
+                    results['ok'] += 1
+                except Exception as e:
+                    # Refused while no instance listened, or reset by one
+                    # that went away
+                    results['errors'].append(repr(e))
+
+        with standalone_haproxy(tmpdir, generated, [('listen seamless', listen)]):
+            client = threading.Thread(target=hammer)
+            client.start()
+            try:
+                for _ in range(self.RELOADS):
+                    time.sleep(0.5)
+                    subprocess.check_call(generated['reload_command'], shell=True)
+                time.sleep(0.5)
+            finally:
+                stop.set()
+                client.join()
+
+        assert results['ok'] > self.RELOADS
+        assert results['errors'] == []
+
+
+class CountingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A stand-in backend that counts the connections it accepts"""
+
+    daemon_threads = True
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('OK')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpReuseBenchmark(object):
+    """Times requests through one service with and without http_reuse and
+    pool_max_conn, against a local backend that costs nothing but the
+    connection
+
+    Run with -s to see the numbers.
+    """
+
+    REQUESTS = 500
+
+    def time_requests(self, service_info):
+        backend = CountingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        server = threading.Thread(target=backend.serve_forever)
+        server.daemon = True
+        server.start()
+
+        tmpdir = tempfile.mkdtemp()
+        generated = generate_standalone_haproxy(tmpdir, {}, dict(
+            service_info, proxy_port=HTTP_REUSE_PORT))
+        service = generated['service']
+        # Health checks go to hacheck, which the stand-in doesn't have
+        server_options = service['server_options'].split()
+        for option in ('observe', 'port'):
+            index = server_options.index(option)
+            del server_options[index:index + 2]
+        server_options.remove('check')
+        backend_section = [
+            line for line in service['backend'] if 'httpchk' not in line and 'http-check' not in line
+        ] + [
+            'server stand_in 127.0.0.1:%d %s' % (backend.server_address[1], ' '.join(server_options)),
+        ]
+        frontend_section = service['frontend'] + [
+            'bind 127.0.0.1:%d' % HTTP_REUSE_PORT,
+            'default_backend itest',
+        ]
+
+        uri = 'http://127.0.0.1:%d/' % HTTP_REUSE_PORT
+        try:
+            with standalone_haproxy(tmpdir, generated, [
+                ('frontend itest', frontend_section),
+                ('backend itest', backend_section),
+            ]):
+                latencies = []
+                for _ in range(self.REQUESTS):
+                    # A new client connection each time, like most clients
+                    # of a Synapse-managed HAProxy
+                    start = time.time()
+                    with contextlib.closing(
+                            urllib2.urlopen(uri, timeout=SOCKET_TIMEOUT)) as page:
+                        assert page.read() == 'OK'
+                    latencies.append(time.time() - start)
+        finally:
+            backend.shutdown()
+            backend.server_close()
+
+        latencies.sort()
+        return backend.connections, latencies
+
+    def test_http_reuse_benchmark(self):
+        results = {}
+        for name, service_info in (
+            ('no reuse', {}),
+            ('http_reuse always', {'http_reuse': 'always'}),
+            ('http_reuse always, pool_max_conn 4', {'http_reuse': 'always', 'pool_max_conn': 4}),
+        ):
+            connections, latencies = self.time_requests(service_info)
+            results[name] = connections
+            print('%-36s %4d server connections, p50 %.2fms, p99 %.2fms' % (
+                name, connections,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[len(latencies) * 99 // 100] * 1000,
+            ))
+
+        # Every request opens a server connection of its own without reuse,
+        # and hardly any do with it
+        assert results['no reuse'] == self.REQUESTS
+        assert results['http_reuse always'] < self.REQUESTS // 10
+        assert results['http_reuse always, pool_max_conn 4'] <= 4
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Times how the reaper finds haproxy-synapse processes in a synthetic /proc.
+
+Compares find_pids_by_name, which reads comm (and the status of the
+matches), with what get_alumni used to do: psutil.process_iter() and
+name() and username() on every process.  Both scan the same tree of
+--entries fake processes, --matches of them haproxy-synapse.  On a real
+/proc the gap is larger, since the kernel generates stat and status on
+every read while comm is cheap.
+
+    python benchmarks/find_alumni_benchmark.py --entries 10000
+"""
+import argparse
+import os
+import pwd
+import shutil
+import tempfile
+import timeit
+from typing import List
+
+import psutil
+
+from synapse_tools.haproxy_synapse_reaper import find_pids_by_name
+
+
+PROCESS_NAME = 'haproxy-synapse'
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--entries', type=int, default=10000,
+                        help='Processes in the synthetic /proc (default: %(default)s).')
+    parser.add_argument('--matches', type=int, default=10,
+                        help='How many of them are %s (default: %%(default)s).' % PROCESS_NAME)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Scans to time, the best one is reported (default: %(default)s).')
+    return parser.parse_args()
+
+
+def write_proc_entry(
+    proc_root: str,
+    pid: int,
+    comm: str,
+    uid: int,
+) -> None:
+    proc_dir = os.path.join(proc_root, str(pid))
+    os.mkdir(proc_dir)
+    with open(os.path.join(proc_dir, 'comm'), 'w') as fh:
+        fh.write(comm + '\n')
+    with open(os.path.join(proc_dir, 'cmdline'), 'w') as fh:
+        fh.write('/usr/bin/%s\0' % comm)
+    with open(os.path.join(proc_dir, 'status'), 'w') as fh:
+        fh.write('Name:\t{0}\nState:\tS (sleeping)\nPPid:\t1\n'
+                 'Uid:\t{1}\t{1}\t{1}\t{1}\nGid:\t0\t0\t0\t0\n'.format(comm, uid))
+    # What psutil reads for the name and create time: pid, comm, state,
+    # ppid and 48 more fields, the 22nd of which is the start time
+    fields = ['S', '1'] + ['0'] * 48
+    fields[19] = str(pid)
+    with open(os.path.join(proc_dir, 'stat'), 'w') as fh:
+        fh.write('%d (%s) %s\n' % (pid, comm, ' '.join(fields)))
+
+
+def build_proc_root(
+    entries: int,
+    matches: int,
+) -> str:
+    proc_root = tempfile.mkdtemp(prefix='proc')
+    with open(os.path.join(proc_root, 'stat'), 'w') as fh:
+        fh.write('btime 0\n')
+    uid = os.getuid()
+    for pid in range(1, entries + 1):
+        comm = PROCESS_NAME if pid % (entries // matches) == 0 else 'worker-%d' % (pid % 50)
+        write_proc_entry(proc_root, pid, comm, uid)
+    return proc_root
+
+
+def scan_with_psutil(
+    username: str,
+) -> List[int]:
+    pids = []
+    # Cold, like the reaper's periodic runs: no cached Process objects
+    psutil._pmap.clear()
+    for proc in psutil.process_iter():
+        try:
+            if proc.name() == PROCESS_NAME and proc.username() == username:
+                pids.append(proc.pid)
+        except psutil.Error:
+            continue
+    return pids
+
+
+def main() -> None:
+    args = parse_args()
+    proc_root = build_proc_root(args.entries, args.matches)
+    try:
+        psutil.PROCFS_PATH = proc_root
+        uid = os.getuid()
+        username = pwd.getpwuid(uid).pw_name
+
+        found = sorted(find_pids_by_name(PROCESS_NAME, uid, proc_root))
+        assert found == sorted(scan_with_psutil(username)), 'The scans disagree'
+        assert len(found) == args.matches
+
+        for name, scan in (
+            ('psutil name() + username()', lambda: scan_with_psutil(username)),
+            ('find_pids_by_name', lambda: list(find_pids_by_name(PROCESS_NAME, uid, proc_root))),
+        ):
+            best = min(timeit.repeat(scan, number=1, repeat=args.repeat))
+            print('%-28s %8.1fms per scan of %d entries' % (name, best * 1000, args.entries))
+    finally:
+        shutil.rmtree(proc_root)
+
+
+if __name__ == '__main__':
+    main()
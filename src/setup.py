@@ -28,7 +28,11 @@ setup(
             'configure_synapse=synapse_tools.configure_synapse:main',
             'generate_container_ip_map=synapse_tools.generate_container_ip_map:main',
             'haproxy_synapse_reaper=synapse_tools.haproxy_synapse_reaper:main',
+            'synapse_capacity_planner=synapse_tools.capacity_planner:main',
+            'synapse_haproxy_log_stats=synapse_tools.haproxy_log_stats:main',
+            'synapse_healthcheck_planner=synapse_tools.healthcheck_planner:main',
             'synapse_qdisc_tool=synapse_tools.haproxy.qdisc_tool:main',
+            'synapse_reload_nginx=synapse_tools.reload_nginx:main',
         ],
     },
     scripts=[
@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+
+"""Estimates how much memory and how many file descriptors the HAProxy and
+nginx processes of a Synapse config will use, before it is rolled out.
+
+HAProxy allocates most of its memory per stream: a request and a response
+buffer of tune.bufsize each, the stream itself, and the captured headers of
+its frontend.  At most `maxconn` streams exist at once, which is the worst
+case.  Buffers are only allocated while data is in flight, so typically
+only the streams the backends can actually serve hold them, and only some
+of those at any time.
+
+On top of that come per proxy and per server structures, health check
+buffers and stick tables.  The per structure sizes are rough figures, good
+enough to tell whether a config fits a host, not to account for every byte.
+
+With --memory-budget the planner also works out the largest
+maximum_connections whose worst case fits the budget.
+"""
+import argparse
+import json
+import re
+import sys
+from typing import cast
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+import psutil
+
+from synapse_tools.configure_synapse import BaseConfig
+from synapse_tools.configure_synapse import generate_host_configuration
+from synapse_tools.configure_synapse import get_host_config
+from synapse_tools.haproxy_synapse_reaper import parse_size
+
+
+# HAProxy's own default
+DEFAULT_BUFSIZE = 16384
+
+# struct stream, session and the two connections of an established stream
+STREAM_OVERHEAD_BYTES = 2048
+
+# struct proxy and the frontend or backend around it
+PROXY_BYTES = 16 * 1024
+
+# struct server and its check, which gets a buffer while it runs
+SERVER_BYTES = 4 * 1024
+
+# A stick table entry without its key and data
+STICK_ENTRY_BYTES = 64
+
+# Log sockets, the stats socket, the master socket and so on
+HAPROXY_SPARE_FDS = 16
+
+# nginx stream proxying: a proxy_buffer_size buffer in each direction and
+# the two connections
+NGINX_STREAM_BYTES = 2 * 16384 + 1024
+
+DEFAULT_SERVERS_PER_BACKEND = 10
+DEFAULT_UTILIZATION = 0.1
+
+SIZE_SUFFIXES = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+STICK_TABLE_RE = re.compile(
+    r'stick-table type (?P<type>\S+)(?: len (?P<len>\d+))?.* size (?P<size>\d+)(?P<suffix>[kmg]?)')
+CAPTURE_RE = re.compile(r'capture (?:request|response) header \S+ len (?P<len>\d+)')
+SERVER_LIMITS_RE = re.compile(r'maxconn (?P<maxconn>\d+) maxqueue (?P<maxqueue>\d+)')
+
+# Key sizes of the stick table types, see stktable_types in stick_table.c
+STICK_KEY_BYTES = {'ip': 4, 'ipv6': 16, 'integer': 4, 'string': 32, 'binary': 32}
+
+
+Estimate = NamedTuple('Estimate', [
+    ('process', str),
+    ('worst_case_bytes', int),
+    ('typical_bytes', int),
+    ('fds', int),
+])
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--synapse-config', default=None,
+                        help='Synapse JSON config to plan for (default: generate '
+                             'it like configure_synapse would).')
+    parser.add_argument('--servers-per-backend', type=int,
+                        default=DEFAULT_SERVERS_PER_BACKEND,
+                        help='Servers discovered per backend, on average '
+                             '(default: %(default)s).')
+    parser.add_argument('--utilization', type=float, default=DEFAULT_UTILIZATION,
+                        help='Share of the backends\' capacity in use at a '
+                             'typical moment (default: %(default)s).')
+    parser.add_argument('--memory-budget', type=parse_size, default=None,
+                        help='Memory HAProxy may use, e.g. 2G. Prints the largest '
+                             'maximum_connections that fits.')
+    parser.add_argument('--host-memory', type=parse_size, default=None,
+                        help='Memory of the host (default: this host\'s).')
+    parser.add_argument('--fd-limit', type=int, default=None,
+                        help='Most file descriptors one process may have '
+                             '(default: this host\'s fs.nr_open).')
+    return parser.parse_args()
+
+
+def _find_int(
+    lines: Iterable[str],
+    keyword: str,
+    default: int,
+) -> int:
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 2 and parts[0] == keyword:
+            return int(parts[1])
+    return default
+
+
+def _extra_sections(
+    config: BaseConfig,
+) -> Dict[str, Iterable[str]]:
+    return cast(Dict[str, Iterable[str]], config['haproxy']['extra_sections'])
+
+
+def _proxy_sections(
+    config: BaseConfig,
+) -> List[List[str]]:
+    """The option lines of every frontend, backend and listen section"""
+    sections = []
+    for service in config['services'].values():
+        haproxy = service.get('haproxy', {})
+        if haproxy.get('disabled'):
+            continue
+        if 'frontend' in haproxy and ('port' in haproxy or 'bind_address' in haproxy):
+            sections.append(haproxy['frontend'])
+        if 'backend' in haproxy:
+            sections.append(haproxy['backend'])
+    for name, lines in _extra_sections(config).items():
+        if name.split()[0] in ('frontend', 'backend', 'listen'):
+            sections.append(list(lines))
+    return sections
+
+
+def count_listeners(
+    config: BaseConfig,
+) -> int:
+    listeners = 0
+    for service in config['services'].values():
+        haproxy = service.get('haproxy', {})
+        if haproxy.get('disabled') or 'frontend' not in haproxy:
+            continue
+        if haproxy.get('port') is not None or 'bind_address' in haproxy:
+            listeners += 1
+        listeners += sum(1 for line in haproxy['frontend'] if line.startswith('bind '))
+    for name, lines in _extra_sections(config).items():
+        listeners += sum(1 for line in lines if line.startswith('bind '))
+    return listeners
+
+
+def capture_bytes(
+    config: BaseConfig,
+) -> int:
+    """The most bytes any one frontend captures per stream"""
+    most = 0
+    for lines in _proxy_sections(config):
+        captured = 0
+        for line in lines:
+            match = CAPTURE_RE.match(line)
+            if match:
+                # Captures are NUL terminated
+                captured += int(match.group('len')) + 1
+        most = max(most, captured)
+    return most
+
+
+def stick_table_bytes(
+    config: BaseConfig,
+) -> int:
+    total = 0
+    for lines in _proxy_sections(config):
+        for line in lines:
+            match = STICK_TABLE_RE.search(line)
+            if not match:
+                continue
+            key_bytes = int(match.group('len') or STICK_KEY_BYTES.get(match.group('type'), 32))
+            size = int(match.group('size')) * SIZE_SUFFIXES[match.group('suffix')]
+            total += size * (STICK_ENTRY_BYTES + key_bytes)
+    return total
+
+
+def ring_bytes(
+    config: BaseConfig,
+) -> int:
+    """The buffers of the ring sections, like the one the logs go through"""
+    return sum(
+        _find_int(lines, 'size', 0)
+        for name, lines in _extra_sections(config).items()
+        if name.split()[0] == 'ring'
+    )
+
+
+def count_backends(
+    config: BaseConfig,
+) -> int:
+    return sum(
+        1 for service in config['services'].values()
+        if not service.get('haproxy', {}).get('disabled') and 'backend' in service.get('haproxy', {})
+    )
+
+
+def backend_capacity(
+    config: BaseConfig,
+    servers_per_backend: int,
+) -> int:
+    """How many streams the servers of all backends take in, queues included"""
+    capacity = 0
+    for service in config['services'].values():
+        haproxy = service.get('haproxy', {})
+        if haproxy.get('disabled') or 'backend' not in haproxy:
+            continue
+        match = SERVER_LIMITS_RE.search(haproxy.get('server_options', ''))
+        if match:
+            capacity += servers_per_backend * (
+                int(match.group('maxconn')) + int(match.group('maxqueue')))
+    return capacity
+
+
+def haproxy_stream_bytes(
+    config: BaseConfig,
+) -> int:
+    bufsize = _find_int(config['haproxy']['global'], 'tune.bufsize', DEFAULT_BUFSIZE)
+    return 2 * bufsize + STREAM_OVERHEAD_BYTES + capture_bytes(config)
+
+
+def haproxy_fixed_bytes(
+    config: BaseConfig,
+    servers_per_backend: int,
+) -> int:
+    """Memory that doesn't depend on the number of streams"""
+    backends = count_backends(config)
+    return (
+        len(_proxy_sections(config)) * PROXY_BYTES +
+        backends * servers_per_backend * SERVER_BYTES +
+        stick_table_bytes(config) +
+        ring_bytes(config)
+    )
+
+
+def estimate_haproxy(
+    config: BaseConfig,
+    servers_per_backend: int,
+    utilization: float,
+) -> Estimate:
+    maxconn = _find_int(config['haproxy']['global'], 'maxconn', 0)
+    stream_bytes = haproxy_stream_bytes(config)
+    fixed_bytes = haproxy_fixed_bytes(config, servers_per_backend)
+    typical_streams = min(maxconn, backend_capacity(config, servers_per_backend)) * utilization
+
+    # Every stream has a client and a server connection, and every server
+    # a check connection now and then
+    fds = (
+        2 * maxconn + count_listeners(config) +
+        count_backends(config) * servers_per_backend + HAPROXY_SPARE_FDS
+    )
+    return Estimate(
+        process='haproxy',
+        worst_case_bytes=fixed_bytes + maxconn * stream_bytes,
+        typical_bytes=fixed_bytes + int(typical_streams * stream_bytes),
+        fds=fds,
+    )
+
+
+def estimate_nginx(
+    config: BaseConfig,
+    utilization: float,
+) -> Optional[Estimate]:
+    if 'nginx' not in config:
+        return None
+    contexts = config['nginx']['contexts']
+    worker_connections = _find_int(contexts.get('events', []), 'worker_connections', 512)
+    rlimit_nofile = _find_int(contexts.get('main', []), 'worker_rlimit_nofile', worker_connections)
+    workers = _find_int(contexts.get('main', []), 'worker_processes', 1)
+
+    # Each proxied stream takes a client and an upstream connection
+    streams = workers * worker_connections // 2
+    return Estimate(
+        process='nginx',
+        worst_case_bytes=streams * NGINX_STREAM_BYTES,
+        typical_bytes=int(streams * utilization) * NGINX_STREAM_BYTES,
+        fds=max(rlimit_nofile, worker_connections),
+    )
+
+
+def max_connections_for_budget(
+    config: BaseConfig,
+    budget_bytes: int,
+    servers_per_backend: int,
+) -> int:
+    """The largest maximum_connections whose worst case fits in the budget"""
+    available = budget_bytes - haproxy_fixed_bytes(config, servers_per_backend)
+    return max(0, available // haproxy_stream_bytes(config))
+
+
+def get_fd_limit() -> int:
+    with open('/proc/sys/fs/nr_open') as fh:
+        return int(fh.read().strip())
+
+
+def format_size(
+    size: float,
+) -> str:
+    for unit in ('B', 'KiB', 'MiB'):
+        if abs(size) < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024
+    return '%.1fGiB' % size
+
+
+def check_fits(
+    estimates: Iterable[Estimate],
+    host_memory: int,
+    fd_limit: int,
+) -> List[str]:
+    """Returns what doesn't fit the host"""
+    problems = []
+    estimates = list(estimates)
+    worst_case_bytes = sum(estimate.worst_case_bytes for estimate in estimates)
+    if worst_case_bytes > host_memory:
+        problems.append('Worst case memory %s exceeds the host\'s %s' % (
+            format_size(worst_case_bytes), format_size(host_memory)))
+    for estimate in estimates:
+        if estimate.fds > fd_limit:
+            problems.append('%s needs %d file descriptors, more than the limit of %d' % (
+                estimate.process, estimate.fds, fd_limit))
+    return problems
+
+
+def load_synapse_config(
+    synapse_config_path: Optional[str],
+) -> BaseConfig:
+    """Reads a Synapse JSON config, or generates this host's without one"""
+    if synapse_config_path is None:
+        generated, _ = generate_host_configuration(get_host_config())
+        return generated
+    with open(synapse_config_path) as fp:
+        config: BaseConfig = json.load(fp)
+    return config
+
+
+def main() -> None:
+    args = parse_args()
+    config = load_synapse_config(args.synapse_config)
+
+    estimates = [estimate_haproxy(config, args.servers_per_backend, args.utilization)]
+    nginx_estimate = estimate_nginx(config, args.utilization)
+    if nginx_estimate is not None:
+        estimates.append(nginx_estimate)
+
+    for estimate in estimates:
+        print('%-8s worst case %10s  typical %10s  fds %d' % (
+            estimate.process, format_size(estimate.worst_case_bytes),
+            format_size(estimate.typical_bytes), estimate.fds))
+
+    if args.memory_budget is not None:
+        print('maximum_connections for a %s budget: %d' % (
+            format_size(args.memory_budget),
+            max_connections_for_budget(config, args.memory_budget, args.servers_per_backend)))
+
+    host_memory = args.host_memory
+    if host_memory is None:
+        host_memory = psutil.virtual_memory().total
+    fd_limit = args.fd_limit
+    if fd_limit is None:
+        fd_limit = get_fd_limit()
+    problems = check_fits(estimates, host_memory, fd_limit)
+    for problem in problems:
+        print('DOES NOT FIT: %s' % problem)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
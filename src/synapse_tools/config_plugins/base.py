@@ -2,13 +2,16 @@ import abc
 from typing import List
 from typing import Iterable
 from typing import Mapping
+from typing import Optional
 
 from mypy_extensions import TypedDict
 
 
-class LoggingDict(TypedDict):
+class LoggingDict(TypedDict, total=False):
     enabled: bool
     sample_rate: int
+    aggregate: bool
+    flush_interval_s: int
 
 
 class PathBasedRoutingDict(TypedDict):
@@ -29,12 +32,23 @@ class ServiceInfo(TypedDict):  # TODO: castable from ServiceNAmespaceConfig
     timeout_connect_ms: int
     timeout_client_ms: int
     timeout_server_ms: int
+    endpoint_timeouts: Mapping[str, int]
     mode: str
     balance: str
     keepalive: bool
+    http_reuse: str
+    pool_max_conn: int
+    pool_purge_delay_ms: int
     extra_headers: Mapping[str, str]
     extra_healthcheck_headers: Mapping[str, str]
     healthcheck_uri: str
+    healthcheck_inter_ms: int
+    healthcheck_fastinter_ms: int
+    healthcheck_downinter_ms: int
+    healthcheck_rise: int
+    healthcheck_fall: int
+    log_mode: str
+    log_sample_rate: int
     retries: int
     allredisp: bool
     proxy_port: int
@@ -56,9 +70,25 @@ SynapseToolsConfig = TypedDict(
         'haproxy_captured_req_headers': str,
         'haproxy_config_path': str,
         'haproxy.defaults.inter': str,
+        'haproxy_close_spread_time_s': Optional[int],
+        'haproxy_compact_options': bool,
+        'haproxy_consolidated_frontends': bool,
+        'haproxy_hard_stop_after': bool,
+        'haproxy_legacy_header_rewrite': bool,
+        'haproxy_log_address': Optional[str],
+        'haproxy_log_max_length': Optional[int],
+        'haproxy_log_mode': str,
+        'haproxy_log_ring_size': int,
+        'haproxy_log_sample_rate': int,
+        'haproxy_log_sampling': bool,
+        'haproxy_log_target': str,
+        'haproxy_log_unix_dgram_qlen': Optional[int],
+        'haproxy_reap_age_s': int,
         'haproxy_reload_cmd_fmt': str,
         'haproxy_respect_allredisp': bool,
         'haproxy_restart_interval_s': int,
+        'haproxy_seamless_reload': bool,
+        'haproxy_seamless_reload_cmd_fmt': str,
         'haproxy_service_proxy_sockets_path_fmt': str,
         'haproxy_service_sockets_path_fmt': str,
         'haproxy_socket_file_path': str,
@@ -74,6 +104,7 @@ SynapseToolsConfig = TypedDict(
         'maxconn_per_server': int,
         'maximum_connections': int,
         'maxqueue_per_server': int,
+        'nginx_per_service_proxy_timeout': bool,
         'nginx_proxy_proto': bool,
         'reload_cmd_fmt': str,
         'stats_port': int,
@@ -41,6 +41,14 @@ class Logging(HAProxyConfigPlugin):
         if 'sample_rate' in self.plugin_opts:
             sample_rate = str(self.plugin_opts['sample_rate'])
             opts.append('setenv sample_rate {0}'.format(sample_rate))
+        # Count (source, destination) pairs in memory and log a summary
+        # every flush interval rather than one line per request
+        if self.plugin_opts.get('aggregate', False):
+            opts.append('setenv provenance_aggregate 1')
+            if 'flush_interval_s' in self.plugin_opts:
+                opts.append('setenv provenance_flush_interval {0}'.format(
+                    int(self.plugin_opts['flush_interval_s'])
+                ))
         return opts
 
     def defaults_options(self) -> Iterable[str]:
@@ -5,6 +5,7 @@ import copy
 import filecmp
 import hashlib
 import json
+import logging
 import os
 import shutil
 import socket
@@ -36,11 +37,64 @@ from synapse_tools.haproxy_synapse_reaper import DEFAULT_REAP_AGE_S
 from yaml import CLoader  # type: ignore
 
 
+log = logging.getLogger(__name__)
+
+
 # This is to keep track of the "default" haproxy section
 #  (eg no overridden timeout, and default advertise location).
 #  it is safe to use a str here since endpoint names must start with "/"
 HAPROXY_DEFAULT_SECTION: Final[str] = "default"
 
+# The client and server timeouts of services that don't set their own
+HAPROXY_DEFAULT_TIMEOUT_MS: Final[int] = 1000
+
+# Valid values of a service's http_reuse, see HAProxy's http-reuse
+HTTP_REUSE_MODES: Final[Tuple[str, ...]] = ('never', 'safe', 'aggressive', 'always')
+
+# Valid values of haproxy_log_mode and of a service's log_mode
+LOG_MODES: Final[Tuple[str, ...]] = ('all', 'errors', 'sampled', 'off')
+
+# Where HAProxy sends its syslog output by default, syslog2scribe
+HAPROXY_LOG_ADDRESS: Final[str] = '127.0.0.1:1514'
+
+# Bounds how many datagrams a unix socket queues, read when the receiving
+# socket is created
+UNIX_MAX_DGRAM_QLEN_PATH: Final[str] = '/proc/sys/net/unix/max_dgram_qlen'
+
+# Ring section buffering the logs with the 'ring' log target
+HAPROXY_LOG_RING: Final[str] = 'synapse_logs'
+
+# Socket id to backend maps of consolidated frontends, in map_dir, named
+# after a hash of their contents
+FRONTEND_MAP_PREFIX: Final[str] = 'so_id_to_backend.'
+FRONTEND_MAP_SUFFIX: Final[str] = '.map'
+
+# What HAProxy limits a frontend without maxconn to
+HAPROXY_DEFAULT_FRONTEND_MAXCONN: Final[int] = 2000
+
+# Options compact_options may move into the defaults section, with the
+# kind of sections they apply to.  Setting one where it doesn't apply,
+# even with 'no', makes HAProxy warn.  They must all be negatable:
+# HAProxy refuses 'no option httplog' or 'no option tcplog', and
+# 'no option http-keep-alive' doesn't bring back the 'option forceclose'
+# of the defaults section, so log formats and connection modes stay put.
+HOISTABLE_OPTIONS: Final[Mapping[str, Tuple[str, ...]]] = {
+    'option log-separate-errors': ('frontend',),
+    'option accept-invalid-http-request': ('frontend',),
+    'option dontlog-normal': ('frontend',),
+    'option allredisp': ('backend',),
+}
+
+# Lines that can't be negated, so compact_options only moves them into the
+# defaults section if every section they apply to has them
+HOISTABLE_UNIVERSAL_LINES: Final[Mapping[str, Tuple[str, ...]]] = {
+    # Has no effect on listen sections, which don't check servers
+    'http-check send-state': ('backend',),
+}
+
+# How much longer than HAProxy nginx keeps idle connections around
+NGINX_TIMEOUT_EPSILON_S: Final[int] = 10
+
 
 class DiscoveryDict(TypedDict, total=False):
     method: str
@@ -82,6 +136,8 @@ HAProxyTopLevelConfigExtraSections = TypedDict(
     {
         'listen stats': Iterable[str],
         'listen map.debug': Iterable[str],
+        # HAPROXY_LOG_RING
+        'ring synapse_logs': Iterable[str],
     },
     total=False,
 )
@@ -181,12 +237,56 @@ def set_defaults(
         ('haproxy_pid_file_path', '/var/run/synapse/haproxy.pid'),
         ('haproxy_state_file_path', None),
         ('haproxy_respect_allredisp', True),
+        # Share frontends between services, see consolidate_frontends
+        ('haproxy_consolidated_frontends', False),
+        # Move repeated options into defaults, see compact_options
+        ('haproxy_compact_options', False),
+        # HAProxy < 1.5 only knows reqidel/reqadd, which HAProxy >= 2.1
+        # no longer knows
+        ('haproxy_legacy_header_rewrite', False),
+        # What HAProxy logs of the services' traffic, which they can
+        # override: every request ('all'), only abnormal ones ('errors'),
+        # one in haproxy_log_sample_rate ('sampled') or nothing ('off')
+        ('haproxy_log_mode', 'all'),
+        ('haproxy_log_sample_rate', 100),
+        # HAProxy >= 2.0 only: allows the 'sampled' log mode, which older
+        # versions refuse to load the config with
+        ('haproxy_log_sampling', False),
+        # How HAProxy sends its logs to haproxy_log_address:
+        # * 'udp': a datagram per line to an IP:port, by default
+        #   HAPROXY_LOG_ADDRESS
+        # * 'unix': a datagram per line to an absolute unix socket path.
+        #   The socket queues up to haproxy_log_unix_dgram_qlen lines
+        #   (net.unix.max_dgram_qlen, which the receiver only picks up
+        #   when it recreates its socket).
+        # * 'ring': buffered in a ring section of haproxy_log_ring_size
+        #   bytes and forwarded in batches over a stream connection to an
+        #   IP:port or unix@<path> (HAProxy >= 2.2).  There is no default,
+        #   the usual receiver only takes udp.
+        ('haproxy_log_target', 'udp'),
+        ('haproxy_log_address', None),
+        ('haproxy_log_ring_size', 1024 * 1024),
+        ('haproxy_log_unix_dgram_qlen', None),
+        # Longest log line; HAProxy's default is 1024
+        ('haproxy_log_max_length', None),
         ('haproxy_reload_cmd_fmt', """touch {haproxy_pid_file_path} && PID=$(cat {haproxy_pid_file_path}) && {haproxy_path} -f {haproxy_config_path} -p {haproxy_pid_file_path} -sf $PID"""),
+        # HAProxy >= 1.8 only: the new instance takes over the listening
+        # sockets of the old one through the stats socket instead of
+        # binding its own, so no SYNs are dropped in between and there is
+        # no need to protect the reload with the qdisc plug
+        ('haproxy_seamless_reload', False),
+        ('haproxy_seamless_reload_cmd_fmt', """touch {haproxy_pid_file_path} && PID=$(cat {haproxy_pid_file_path}) && {haproxy_path} -f {haproxy_config_path} -p {haproxy_pid_file_path} -x {haproxy_socket_file_path} -sf $PID"""),
         ('haproxy_service_sockets_path_fmt',
             '/var/run/synapse/sockets/{service_name}.sock'),
         ('haproxy_service_proxy_sockets_path_fmt',
             '/var/run/synapse/sockets/{service_name}.prxy'),
         ('haproxy_restart_interval_s', 60),
+        # Bound how long old HAProxy instances linger after a reload from
+        # within HAProxy itself, using the same age the reaper enforces
+        ('haproxy_hard_stop_after', False),
+        ('haproxy_reap_age_s', DEFAULT_REAP_AGE_S),
+        # HAProxy >= 2.6 only
+        ('haproxy_close_spread_time_s', None),
         # Misc options
         ('file_output_path', '/var/run/synapse/services'),
         ('maximum_connections', 10000),
@@ -207,8 +307,13 @@ def set_defaults(
         ('nginx_prefix', '/var/run/synapse/nginx_temp'),
         ('nginx_config_path', '/var/run/synapse/nginx.cfg'),
         ('nginx_pid_file_path', '/var/run/synapse/nginx.pid'),
+        # Hosts opt in to /usr/bin/synapse_reload_nginx, which waits on events
+        # instead of polling
         ('nginx_reload_script', '/usr/bin/synapse-tools-reload-nginx'),
         ('nginx_proxy_proto', False),
+        # Time out idle listener connections shortly after HAProxy would
+        # for each service, instead of after the reap age for all of them
+        ('nginx_per_service_proxy_timeout', False),
         # http://nginx.org/en/docs/control.html#upgrade
         # This is apparently how you gracefully reload the binary ...
         ('nginx_reload_cmd_fmt',
@@ -294,17 +399,88 @@ def _generate_server_order_seed() -> int:
     )
 
 
+def get_haproxy_log_address(
+    synapse_tools_config: SynapseToolsConfig,
+) -> str:
+    """Returns where HAProxy sends its logs, or raises ValueError if that
+    doesn't go with haproxy_log_target
+    """
+    target = synapse_tools_config['haproxy_log_target']
+    address = synapse_tools_config['haproxy_log_address']
+    # HAProxy takes an absolute path for a unix datagram socket, whatever
+    # the target
+    is_path = address is not None and address.startswith('/')
+    if target == 'udp':
+        if is_path:
+            raise ValueError(
+                'haproxy_log_address %s is a unix socket, set haproxy_log_target '
+                'to unix' % address)
+        return address or HAPROXY_LOG_ADDRESS
+    if target == 'unix':
+        if address is None or not is_path:
+            raise ValueError(
+                'haproxy_log_target unix needs an absolute socket path in '
+                'haproxy_log_address, not %s' % address)
+        return address
+    if target == 'ring':
+        if address is None or is_path:
+            raise ValueError(
+                'haproxy_log_target ring needs the IP:port or unix@<path> of a '
+                'stream forwarder in haproxy_log_address, not %s' % address)
+        return address
+    raise ValueError('Unknown haproxy_log_target %s' % target)
+
+
+def _generate_haproxy_log_line(
+    synapse_tools_config: SynapseToolsConfig,
+    options: str = '',
+) -> str:
+    if synapse_tools_config['haproxy_log_target'] == 'ring':
+        target = 'ring@%s' % HAPROXY_LOG_RING
+    else:
+        target = get_haproxy_log_address(synapse_tools_config)
+    max_length = synapse_tools_config['haproxy_log_max_length']
+    if max_length is not None:
+        options = ' '.join(filter(None, ['len %d' % max_length, options]))
+    return ' '.join(filter(None, ['log', target, options, 'daemon info']))
+
+
+def _generate_haproxy_log_ring(
+    synapse_tools_config: SynapseToolsConfig,
+) -> List[str]:
+    ring = [
+        # The format syslog2scribe gets over udp
+        'format rfc3164',
+        'size %d' % synapse_tools_config['haproxy_log_ring_size'],
+    ]
+    max_length = synapse_tools_config['haproxy_log_max_length']
+    if max_length is not None:
+        ring.append('maxlen %d' % max_length)
+    ring.extend([
+        'timeout connect 1s',
+        'timeout server 10s',
+        'server syslog %s' % get_haproxy_log_address(synapse_tools_config),
+    ])
+    return ring
+
+
 def _generate_haproxy_top_level(
     synapse_tools_config: SynapseToolsConfig,
 ) -> HAProxyTopLevelConfig:
     haproxy_inter = synapse_tools_config['haproxy.defaults.inter']
+    if synapse_tools_config['haproxy_seamless_reload']:
+        reload_cmd_fmt = synapse_tools_config['haproxy_seamless_reload_cmd_fmt']
+        stats_socket_options = 'level admin expose-fd listeners'
+    else:
+        reload_cmd_fmt = synapse_tools_config['haproxy_reload_cmd_fmt']
+        stats_socket_options = 'level admin'
     top_level: HAProxyTopLevelConfig = {
         'bind_address': synapse_tools_config['bind_addr'],
         'restart_interval': synapse_tools_config['haproxy_restart_interval_s'],
         'restart_jitter': 0.1,
         'state_file_path': '/var/run/synapse/state.json',
         'state_file_ttl': 30 * 60,
-        'reload_command': synapse_tools_config['haproxy_reload_cmd_fmt'].format(**synapse_tools_config),
+        'reload_command': reload_cmd_fmt.format(**synapse_tools_config),
         'socket_file_path': synapse_tools_config['haproxy_socket_file_path'],
         'config_file_path': synapse_tools_config['haproxy_config_path'],
         'do_writes': True,
@@ -315,8 +491,9 @@ def _generate_haproxy_top_level(
         'global': [
             'daemon',
             'maxconn %d' % synapse_tools_config['maximum_connections'],
-            'stats socket {0} level admin'.format(
-                synapse_tools_config['haproxy_socket_file_path']
+            'stats socket {0} {1}'.format(
+                synapse_tools_config['haproxy_socket_file_path'],
+                stats_socket_options,
             ),
 
             # Default of 16k is too small and causes HTTP 400 errors
@@ -326,7 +503,7 @@ def _generate_haproxy_top_level(
             'spread-checks 50',
 
             # Send syslog output to syslog2scribe
-            'log 127.0.0.1:1514 daemon info',
+            _generate_haproxy_log_line(synapse_tools_config),
             'log-send-hostname',
             'unix-bind mode 666'
 
@@ -335,8 +512,8 @@ def _generate_haproxy_top_level(
         'defaults': [
             # Various timeout values
             'timeout connect 200ms',
-            'timeout client 1000ms',
-            'timeout server 1000ms',
+            'timeout client %dms' % HAPROXY_DEFAULT_TIMEOUT_MS,
+            'timeout server %dms' % HAPROXY_DEFAULT_TIMEOUT_MS,
 
             # On failure, try a different server
             'retries 1',
@@ -375,12 +552,18 @@ def _generate_haproxy_top_level(
             # * When 'on-error' triggers a check, it will only occur after
             #   <fastinter> delay.
             # * Under the assumption of 100 client machines each
-            #   healthchecking a service instance:
+            #   healthchecking a service instance through one backend:
             #
             #     10 minute <inter>     -> 0.2qps
             #     30 second <downinter> -> 3.3qps
             #     30 second <fastinter> -> 3.3qps
             #
+            #   Every backend of a service (one per advertise type and
+            #   endpoint timeout) checks its servers separately, so the
+            #   real load is a multiple of that; synapse_healthcheck_planner
+            #   works it out from the generated config.
+            # * Services can override <inter>, <fastinter>, <downinter>,
+            #   <rise> and <fall> on their server lines.
             # * The <downinter> checks should only occur when Zookeeper is
             #   down; ordinarily Nerve will quickly remove a backend if it
             #   fails its local healthcheck.
@@ -403,6 +586,13 @@ def _generate_haproxy_top_level(
         }
     }
 
+    # Lines that don't fit in the ring are dropped, and counted in
+    # DroppedLogs of 'show info' on the stats socket
+    if synapse_tools_config['haproxy_log_target'] == 'ring':
+        top_level['extra_sections']['ring synapse_logs'] = (
+            _generate_haproxy_log_ring(synapse_tools_config)
+        )
+
     # Add a map-debug endpoint if it is enabled in the configs (typically, only for itest)
     if synapse_tools_config.get('enable_map_debug', False):
         top_level['extra_sections']['listen map.debug'] = [
@@ -432,6 +622,19 @@ def _generate_haproxy_top_level(
         )
         top_level['defaults'].append('load-server-state-from-file global')
 
+    # Old instances exit by themselves once they reach the reap age, even
+    # if the reaper is late.  close-spread-time spreads closing their idle
+    # keep-alive connections over a window instead of all at once, so that
+    # clients don't reconnect to the new instance in a thundering herd.
+    reap_age_s = synapse_tools_config['haproxy_reap_age_s']
+    if synapse_tools_config['haproxy_hard_stop_after']:
+        top_level['global'].append('hard-stop-after %ds' % reap_age_s)
+    close_spread_time_s = synapse_tools_config['haproxy_close_spread_time_s']
+    if close_spread_time_s is not None:
+        if synapse_tools_config['haproxy_hard_stop_after']:
+            close_spread_time_s = min(close_spread_time_s, reap_age_s)
+        top_level['global'].append('close-spread-time %ds' % close_spread_time_s)
+
     return top_level
 
 
@@ -575,16 +778,221 @@ def generate_acls_for_service(
             path_acl_name = ''
             path_acl = []
 
-        # use connslots acl condition
         frontend_acl_configs.extend(
-            path_acl + [
-                f'acl {backend_identifier}_has_connslots connslots({backend_identifier}) gt 0',
-                f'use_backend {backend_identifier} if {backend_identifier}_has_connslots{path_acl_name}',
-            ]
+            path_acl + _generate_connslots_acls(backend_identifier, path_acl_name)
         )
     return frontend_acl_configs
 
 
+def _generate_connslots_acls(
+    backend_identifier: str,
+    path_acl_name: str = '',
+) -> List[str]:
+    # use connslots acl condition
+    return [
+        f'acl {backend_identifier}_has_connslots connslots({backend_identifier}) gt 0',
+        f'use_backend {backend_identifier} if {backend_identifier}_has_connslots{path_acl_name}',
+    ]
+
+
+def consolidate_frontends(
+    synapse_config: BaseConfig,
+    synapse_tools_config: SynapseToolsConfig,
+) -> Dict[int, str]:
+    """Merges the frontends of services that only differ in what they bind
+
+    Thousands of frontends make HAProxy slow to parse its config and to
+    reload.  The services whose frontends have the same options and only
+    route to their own backend instead share one frontend per set of
+    options, which picks the backend from the id of the socket the
+    connection came in on.
+
+    The ids shift whenever a service comes or goes, so the map is named
+    after its contents (see get_frontend_map_path): a config only ever
+    reads the map it was generated with, even when the previous Synapse
+    reloads HAProxy after the new map is written.
+
+    Updates `synapse_config` in place and returns the socket id to
+    backend map the shared frontends look up.
+    """
+    bind_address = synapse_config['haproxy']['bind_address']
+
+    groups: Dict[Tuple[str, ...], List[HAProxyServiceConfig]] = {}
+    for service_name, service in sorted(synapse_config['services'].items()):
+        haproxy = service.get('haproxy', {})
+        if haproxy.get('disabled') or 'frontend' not in haproxy:
+            continue
+        routing = _generate_connslots_acls(haproxy['backend_name'])
+        if not all(line in haproxy['frontend'] for line in routing):
+            continue
+        options = tuple(
+            line for line in haproxy['frontend']
+            if not line.startswith('bind ') and line not in routing
+        )
+        # Anything routing elsewhere, e.g. on the path, needs its own
+        # frontend
+        if any(line.startswith(('use_backend ', 'default_backend ')) for line in options):
+            continue
+        groups.setdefault(options, []).append(haproxy)
+
+    frontend_map: Dict[int, str] = {}
+    shared_frontends = []
+    for options, group in groups.items():
+        if len(group) < 2:
+            continue
+        # Each service had a frontend, and so a connection limit, of its own,
+        # which its listeners keep
+        maxconn = HAPROXY_DEFAULT_FRONTEND_MAXCONN
+        for line in options:
+            if line.startswith('maxconn '):
+                maxconn = int(line.split()[1])
+        options = tuple(line for line in options if not line.startswith('maxconn '))
+
+        binds = []
+        for haproxy in group:
+            service_binds = []
+            if haproxy.get('port') is not None:
+                service_binds.append('bind {0}:{1}'.format(bind_address, haproxy['port']))
+            elif 'bind_address' in haproxy:
+                service_binds.append('bind {0}'.format(haproxy['bind_address']))
+            service_binds.extend(
+                line for line in haproxy['frontend'] if line.startswith('bind '))
+            for bind in service_binds:
+                so_id = len(frontend_map) + 1
+                binds.append('{0} id {1} maxconn {2}'.format(bind, so_id, maxconn))
+                frontend_map[so_id] = haproxy['backend_name']
+
+            # Without a port or frontend Synapse only writes the backend
+            del haproxy['frontend']
+            haproxy.pop('port', None)
+            haproxy.pop('bind_address', None)
+
+        # Only an overall cap, so the frontend doesn't take more than the
+        # separate ones did
+        binds.append('maxconn %d' % (maxconn * len(group)))
+        shared_frontends.append(binds + list(options))
+
+    map_path = get_frontend_map_path(synapse_tools_config['map_dir'], frontend_map)
+    extra_sections = cast(Dict[str, Iterable[str]], synapse_config['haproxy']['extra_sections'])
+    for index, lines in enumerate(shared_frontends):
+        extra_sections['frontend consolidated_{0}'.format(index)] = lines + [
+            'use_backend %[so_id,map_int({0})]'.format(map_path),
+        ]
+    return frontend_map
+
+
+def compact_options(
+    synapse_config: BaseConfig,
+) -> List[str]:
+    """Moves the options most sections repeat into the defaults section
+
+    HAProxy >= 2.5 has named defaults sections, but Synapse writes the
+    frontend and backend headers itself, so they can't refer to one.
+    Instead an option most of the sections it applies to set goes into
+    the single defaults section, and the others turn it back off.
+
+    Updates `synapse_config` in place and returns the moved lines.
+    """
+    sections: Dict[str, List[List[str]]] = {'frontend': [], 'backend': [], 'listen': []}
+    for service in synapse_config['services'].values():
+        haproxy = service.get('haproxy', {})
+        if haproxy.get('disabled'):
+            continue
+        if 'frontend' in haproxy:
+            sections['frontend'].append(haproxy['frontend'])
+        if 'backend' in haproxy:
+            sections['backend'].append(haproxy['backend'])
+    for name, lines in synapse_config['haproxy']['extra_sections'].items():
+        # Other sections, e.g. peers, take no options
+        kind = name.split()[0]
+        if kind in sections:
+            sections[kind].append(cast(List[str], lines))
+
+    defaults = synapse_config['haproxy']['defaults']
+    hoisted = []
+    for line, kinds in sorted(HOISTABLE_OPTIONS.items()) + sorted(HOISTABLE_UNIVERSAL_LINES.items()):
+        if line in defaults:
+            continue
+        applicable = [lines for kind in kinds for lines in sections[kind]]
+        if line in HOISTABLE_UNIVERSAL_LINES:
+            if not applicable or not all(line in lines for lines in applicable):
+                continue
+        else:
+            # listen sections are both frontends and backends
+            applicable.extend(sections['listen'])
+        holders = [lines for lines in applicable if line in lines]
+        others = [lines for lines in applicable if line not in lines]
+        if len(holders) <= len(others):
+            continue
+
+        defaults.append(line)
+        hoisted.append(line)
+        for lines in holders:
+            lines.remove(line)
+        for lines in others:
+            lines.insert(0, 'no ' + line)
+    return hoisted
+
+
+def _format_frontend_map(
+    frontend_map: Mapping[int, str],
+) -> str:
+    return ''.join(
+        '{0} {1}\n'.format(so_id, backend_name)
+        for so_id, backend_name in sorted(frontend_map.items())
+    )
+
+
+def get_frontend_map_path(
+    map_dir: str,
+    frontend_map: Mapping[int, str],
+) -> str:
+    digest = hashlib.sha1(_format_frontend_map(frontend_map).encode('utf-8')).hexdigest()
+    return os.path.join(map_dir, FRONTEND_MAP_PREFIX + digest[:12] + FRONTEND_MAP_SUFFIX)
+
+
+def ensure_unix_dgram_qlen(
+    qlen: int,
+    sysctl_path: str = UNIX_MAX_DGRAM_QLEN_PATH,
+) -> None:
+    """Raises net.unix.max_dgram_qlen to at least `qlen`, never lowers it"""
+    with open(sysctl_path) as fp:
+        if int(fp.read().strip()) >= qlen:
+            return
+    with open(sysctl_path, 'w') as fp:
+        fp.write('%d\n' % qlen)
+
+
+def write_frontend_map(
+    map_path: str,
+    frontend_map: Mapping[int, str],
+) -> None:
+    map_dir = os.path.dirname(map_path)
+    os.makedirs(map_dir, exist_ok=True)
+    # HAProxy reads the map on start, so never let it see half of it
+    with tempfile.NamedTemporaryFile('w', dir=map_dir, delete=False) as fp:
+        fp.write(_format_frontend_map(frontend_map))
+    os.chmod(fp.name, 0o644)
+    os.rename(fp.name, map_path)
+
+
+def remove_stale_frontend_maps(
+    map_path: str,
+) -> None:
+    """Removes the maps of consolidated frontends other than `map_path`
+
+    Only safe once no Synapse config refers to them any more.
+    """
+    map_dir = os.path.dirname(map_path)
+    for name in os.listdir(map_dir):
+        path = os.path.join(map_dir, name)
+        if (
+            name.startswith(FRONTEND_MAP_PREFIX) and name.endswith(FRONTEND_MAP_SUFFIX) and
+            path != map_path
+        ):
+            os.remove(path)
+
+
 def generate_configuration(
     synapse_tools_config: SynapseToolsConfig,
     zookeeper_topology: Iterable[str],
@@ -832,6 +1240,70 @@ def _get_default_timeout(
     )
 
 
+def _quote_log_format(
+    value: str,
+) -> str:
+    """Makes `value` a literal HAProxy log-format string"""
+    value = value.replace('%', '%%')
+    if any(c in value for c in ' \t"\'\\#'):
+        value = '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+    return value
+
+
+def _is_positive_int(
+    value: object,
+) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def get_log_mode(
+    service_name: str,
+    service_info: ServiceInfo,
+    synapse_tools_config: SynapseToolsConfig,
+) -> Tuple[str, int]:
+    """Returns what HAProxy logs of a service's traffic, and one in how many
+    requests with the 'sampled' mode
+
+    Raises ValueError if the host's defaults are invalid.  An invalid
+    override of a service is reported, and the default used instead.
+    """
+    log_mode = synapse_tools_config['haproxy_log_mode']
+    log_sample_rate = synapse_tools_config['haproxy_log_sample_rate']
+    sampling = synapse_tools_config['haproxy_log_sampling']
+    if log_mode not in LOG_MODES:
+        raise ValueError('Unknown haproxy_log_mode %s, expected one of %s' % (
+            log_mode, ', '.join(LOG_MODES)))
+    if log_mode == 'sampled' and not sampling:
+        raise ValueError(
+            'haproxy_log_mode sampled needs HAProxy >= 2.0, set haproxy_log_sampling')
+    if not _is_positive_int(log_sample_rate):
+        raise ValueError(
+            'haproxy_log_sample_rate must be a positive integer, not %r' % (log_sample_rate,))
+
+    service_log_mode = service_info.get('log_mode')
+    if service_log_mode is None:
+        pass
+    elif service_log_mode not in LOG_MODES:
+        log.warning('Ignoring invalid log_mode %r of %s, expected one of %s' % (
+            service_log_mode, service_name, ', '.join(LOG_MODES)))
+    elif service_log_mode == 'sampled' and not sampling:
+        log.warning('Ignoring log_mode sampled of %s, which needs HAProxy >= 2.0 '
+                    'and haproxy_log_sampling' % service_name)
+    else:
+        log_mode = service_log_mode
+
+    service_log_sample_rate = service_info.get('log_sample_rate')
+    if service_log_sample_rate is None:
+        pass
+    elif not _is_positive_int(service_log_sample_rate):
+        log.warning('Ignoring invalid log_sample_rate %r of %s, expected a positive integer' % (
+            service_log_sample_rate, service_name))
+    else:
+        log_sample_rate = service_log_sample_rate
+
+    return log_mode, log_sample_rate
+
+
 def _generate_haproxy_for_watcher(
     service_name: str,
     service_info: ServiceInfo,
@@ -857,6 +1329,29 @@ def _generate_haproxy_for_watcher(
         synapse_tools_config['maxqueue_per_server'],
     )
 
+    # Bound the idle connections kept open to each server for reuse
+    # (HAProxy >= 1.9)
+    pool_max_conn = service_info.get('pool_max_conn')
+    if pool_max_conn is not None:
+        server_options += ' pool-max-conn %d' % pool_max_conn
+    pool_purge_delay_ms = service_info.get('pool_purge_delay_ms')
+    if pool_purge_delay_ms is not None:
+        server_options += ' pool-purge-delay %dms' % pool_purge_delay_ms
+
+    # Heavy services can check their servers less often than the
+    # default-server line in the defaults section, see
+    # synapse_healthcheck_planner for the load the checks put on them
+    healthcheck_options: List[Tuple[str, Optional[int], str]] = [
+        ('inter', service_info.get('healthcheck_inter_ms'), 'ms'),
+        ('fastinter', service_info.get('healthcheck_fastinter_ms'), 'ms'),
+        ('downinter', service_info.get('healthcheck_downinter_ms'), 'ms'),
+        ('rise', service_info.get('healthcheck_rise'), ''),
+        ('fall', service_info.get('healthcheck_fall'), ''),
+    ]
+    for option, option_value, unit in healthcheck_options:
+        if option_value is not None:
+            server_options += ' %s %d%s' % (option, option_value, unit)
+
     # Frontend options
     # All things related to the listening sockets on HAProxy
     # These are what clients connect to
@@ -874,6 +1369,21 @@ def _generate_haproxy_for_watcher(
         frontend_options.append('no option accept-invalid-http-request')
         frontend_options.append('option tcplog')
 
+    # Every logged request is a syslog packet that costs HAProxy and the
+    # syslog daemon CPU, so busy services can log less of them
+    log_mode, log_sample_rate = get_log_mode(service_name, service_info, synapse_tools_config)
+    if log_mode == 'errors':
+        frontend_options.append('option dontlog-normal')
+    elif log_mode == 'sampled':
+        # The frontend's own log line replaces the inherited 'log global'
+        frontend_options.extend([
+            'no log',
+            _generate_haproxy_log_line(
+                synapse_tools_config, 'sample 1:%d' % log_sample_rate),
+        ])
+    elif log_mode == 'off':
+        frontend_options.append('no log')
+
     # Backend options
     # All things related to load balancing to backend servers
     backend_options = []
@@ -882,12 +1392,31 @@ def _generate_haproxy_for_watcher(
     if balance is not None and balance in ('leastconn', 'roundrobin'):
         backend_options.append('balance %s' % balance)
 
+    # Reusing idle server connections across requests needs them kept
+    # alive in the first place
+    http_reuse: Optional[str] = service_info.get('http_reuse')
+    if http_reuse is not None and http_reuse not in HTTP_REUSE_MODES:
+        log.warning('Ignoring invalid http_reuse %r of %s, expected one of %s' % (
+            http_reuse, service_name, ', '.join(HTTP_REUSE_MODES)))
+        http_reuse = None
+    if mode != 'http':
+        http_reuse = None
+
     keepalive = service_info.get('keepalive', False)
-    if keepalive and mode == 'http':
+    if (keepalive or http_reuse is not None) and mode == 'http':
         backend_options.extend([
             'no option forceclose',
             'option http-keep-alive'
         ])
+    if http_reuse is not None:
+        backend_options.append('http-reuse %s' % http_reuse)
+        # HAProxy applies the stricter connection mode of the frontend and
+        # the backend, so the forceclose the frontend inherits would still
+        # close every server connection after its response
+        frontend_options.extend([
+            'no option forceclose',
+            'option http-keep-alive',
+        ])
 
     if mode == 'tcp':
         # We need to put the frontend and backend into tcp mode
@@ -895,10 +1424,17 @@ def _generate_haproxy_for_watcher(
         backend_options.append('mode tcp')
 
     extra_headers = service_info.get('extra_headers', {})
-    for header, value in extra_headers.items():
-        backend_options.append('reqidel ^%s:.*' % (header))
-    for header, value in extra_headers.items():
-        backend_options.append('reqadd %s:\ %s' % (header, value))
+    if synapse_tools_config['haproxy_legacy_header_rewrite']:
+        for header, value in extra_headers.items():
+            backend_options.append('reqidel ^%s:.*' % (header))
+        for header, value in extra_headers.items():
+            backend_options.append('reqadd %s:\ %s' % (header, value))
+    else:
+        # Replaces the header in place, without running a regex over
+        # every header line like reqidel does
+        for header, value in extra_headers.items():
+            backend_options.append('http-request set-header %s %s' % (
+                header, _quote_log_format(value)))
 
     # hacheck healthchecking
     # Note that we use a dummy port value of '0' here because HAProxy is
@@ -956,6 +1492,36 @@ def _generate_haproxy_for_watcher(
     }
 
 
+def _get_nginx_proxy_timeout_s(
+    service_info: ServiceInfo,
+    synapse_tools_config: SynapseToolsConfig,
+) -> int:
+    # For the nginx listener, we just want the highest possible timeout.
+    # To limit memory usage we cap this at the reap age (so HAProxy will
+    # always time out the connection, not NGINX). We add an epsilon of 10
+    # just to really really make sure that HAProxy does the error codes
+    max_timeout_s = int(synapse_tools_config['haproxy_reap_age_s']) + NGINX_TIMEOUT_EPSILON_S
+    if not synapse_tools_config['nginx_per_service_proxy_timeout']:
+        return max_timeout_s
+
+    # HAProxy closes idle connections once its own client and server
+    # timeouts expire, so nginx only has to outlast the longest of those
+    default_timeout = _get_default_timeout(service_info)
+    timeouts_ms: List[int] = [
+        HAPROXY_DEFAULT_TIMEOUT_MS if timeout_ms is None else timeout_ms
+        for timeout_ms in (
+            service_info.get('timeout_client_ms', default_timeout),
+            service_info.get('timeout_server_ms', default_timeout),
+        )
+    ]
+    # In http mode, path based backends may override the server timeout
+    if service_info.get('mode', 'http') == 'http':
+        timeouts_ms.extend(service_info.get('endpoint_timeouts', {}).values())
+
+    timeout_s = -(-max(timeouts_ms) // 1000) + NGINX_TIMEOUT_EPSILON_S
+    return min(timeout_s, max_timeout_s)
+
+
 def _generate_nginx_for_watcher(
     service_name: str,
     service_info: ServiceInfo,
@@ -968,11 +1534,7 @@ def _generate_nginx_for_watcher(
         proxy_proto=synapse_tools_config['nginx_proxy_proto'],
     )
 
-    # For the nginx listener, we just want the highest possible timeout.
-    # To limit memory usage we set this to the max reap age (so HAProxy will
-    # always time out the connection, not NGINX). We add an epsilon of 10
-    # just to really really make sure that HAProxy does the error codes
-    timeout = int(DEFAULT_REAP_AGE_S) + 10
+    timeout = _get_nginx_proxy_timeout_s(service_info, synapse_tools_config)
     server = ['proxy_timeout {0}s'.format(timeout)]
 
     # Send PROXY protocol to HAProxy proxy sockets only if enabled
@@ -1088,13 +1650,22 @@ def get_envoy_migration_config(path: str) -> EnvoyMigrationConfig:
         return yaml.load(f, Loader=yaml.CSafeLoader)  # type: ignore
 
 
-def main() -> None:
-    my_config = get_config(
+def get_host_config() -> SynapseToolsConfig:
+    return get_config(
         os.environ.get(
             'SYNAPSE_TOOLS_CONFIG_PATH', '/etc/synapse/synapse-tools.conf.json'
         )
     )
 
+
+def generate_host_configuration(
+    my_config: SynapseToolsConfig,
+) -> Tuple[BaseConfig, Optional[Dict[int, str]]]:
+    """Generates the Synapse config for the services of this host
+
+    Returns the config and, with consolidated frontends, the map they
+    route with.
+    """
     # Allow overriding the SOA directory
     soa_dir = os.environ.get(
         'SOA_DIR', DEFAULT_SOA_DIR,
@@ -1112,6 +1683,29 @@ def main() -> None:
         )),
     )
 
+    frontend_map = None
+    if my_config['haproxy_consolidated_frontends']:
+        frontend_map = consolidate_frontends(new_synapse_config, my_config)
+    if my_config['haproxy_compact_options']:
+        compact_options(new_synapse_config)
+    return new_synapse_config, frontend_map
+
+
+def main() -> None:
+    my_config = get_host_config()
+    new_synapse_config, frontend_map = generate_host_configuration(my_config)
+
+    unix_dgram_qlen = my_config['haproxy_log_unix_dgram_qlen']
+    if my_config['haproxy_log_target'] == 'unix' and unix_dgram_qlen is not None:
+        ensure_unix_dgram_qlen(unix_dgram_qlen)
+
+    frontend_map_path = None
+    if frontend_map is not None:
+        # The map has to be in place before HAProxy reloads with the
+        # frontends using it
+        frontend_map_path = get_frontend_map_path(my_config['map_dir'], frontend_map)
+        write_frontend_map(frontend_map_path, frontend_map)
+
     with tempfile.NamedTemporaryFile() as tmp_file:
         new_synapse_config_path = tmp_file.name
         with open(new_synapse_config_path, 'w') as fp:
@@ -1141,6 +1735,11 @@ def main() -> None:
                 subprocess.check_call(cmd + ['stop'])
                 subprocess.check_call(cmd + ['start'])
 
+    # Synapse runs with the new config now, so HAProxy never reloads with
+    # the older maps again
+    if frontend_map_path is not None:
+        remove_stale_frontend_maps(frontend_map_path)
+
 
 if __name__ == '__main__':
     main()
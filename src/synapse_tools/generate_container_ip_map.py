@@ -1,10 +1,15 @@
 #!/usr/bin/env python
+import abc
 import argparse
 import os
 import socket
 import sys
+import threading
+import time
 import requests
+from typing import Dict
 from typing import Iterable
+from typing import List
 from typing import Optional
 from typing import Mapping
 from typing import Tuple
@@ -15,6 +20,12 @@ from paasta_tools.utils import get_docker_client
 
 HAPROXY_STATS_SOCKET = '/var/run/synapse/haproxy.sock'
 
+KUBELET_PODS_URL = 'http://169.254.255.254:10255/pods/'
+
+# How long all inventory sources together may take before we give up on
+# the ones that haven't answered yet
+DEFAULT_INVENTORY_DEADLINE_S = 10.0
+
 
 def get_prev_file_contents(
     filename: str,
@@ -28,7 +39,8 @@ def get_prev_file_contents(
                 for line
                 in fp.readlines()
             ]
-            return {line[0]: line[1] for line in prev_lines}
+            # Skip blank lines and lines without both an IP and a task ID
+            return {line[0]: line[1] for line in prev_lines if len(line) >= 2}
     return {}
 
 
@@ -60,10 +72,12 @@ def extract_taskid_and_ip_mesos(
     return service_ips_and_ids
 
 
-def extract_taskid_and_ip_k8s() -> Iterable[Tuple[str, str]]:
+def extract_taskid_and_ip_k8s(
+    timeout: Optional[float] = None,
+) -> Iterable[Tuple[str, str]]:
     service_ips_and_ids = []
 
-    node_info = requests.get("http://169.254.255.254:10255/pods/").json()
+    node_info = requests.get(KUBELET_PODS_URL, timeout=timeout).json()
 
     for pod in node_info['items']:
         pod_name = pod['metadata']['name']
@@ -88,6 +102,148 @@ def extract_taskid_and_ip_k8s() -> Iterable[Tuple[str, str]]:
     return service_ips_and_ids
 
 
+class InventorySource(metaclass=abc.ABCMeta):
+    """A place we can learn (container IP, task ID) pairs from"""
+
+    name = 'unknown'
+
+    @abc.abstractmethod
+    def extract(
+        self,
+        timeout: float,
+    ) -> Iterable[Tuple[str, str]]:
+        """
+        Lists the containers known to this source
+        :param float timeout: seconds the source may spend answering
+        :return: iterable of (ip address, task id) tuples
+        """
+
+
+class DockerSource(InventorySource):
+    """Mesos tasks and tron/batch containers on the local docker daemon"""
+
+    name = 'docker'
+
+    def extract(
+        self,
+        timeout: float,
+    ) -> Iterable[Tuple[str, str]]:
+        docker_client = get_docker_client()
+        # get_docker_client() takes no timeout, but the client reads it from
+        # here for every request, so a hung daemon can't use up the deadline
+        docker_client.timeout = timeout
+        return extract_taskid_and_ip_mesos(docker_client)
+
+
+class KubeletSource(InventorySource):
+    """Pods known to the local kubelet"""
+
+    name = 'kubelet'
+
+    def extract(
+        self,
+        timeout: float,
+    ) -> Iterable[Tuple[str, str]]:
+        return extract_taskid_and_ip_k8s(timeout=timeout)
+
+
+class StaticFileSource(InventorySource):
+    """A file in the same '<ip> <task id>' format as the map file"""
+
+    def __init__(
+        self,
+        path: str,
+    ) -> None:
+        self.path = path
+        self.name = 'file:{}'.format(path)
+
+    def extract(
+        self,
+        timeout: float,
+    ) -> Iterable[Tuple[str, str]]:
+        if not os.path.isfile(self.path):
+            raise IOError('No such inventory file: {}'.format(self.path))
+        return list(get_prev_file_contents(self.path).items())
+
+
+def get_inventory_source(
+    spec: str,
+) -> InventorySource:
+    """Builds a source from a --source argument: docker, kubelet or file:PATH"""
+    if spec == 'docker':
+        return DockerSource()
+    if spec == 'kubelet':
+        return KubeletSource()
+    if spec.startswith('file:'):
+        return StaticFileSource(spec[len('file:'):])
+    raise argparse.ArgumentTypeError('Unknown inventory source: {}'.format(spec))
+
+
+def collect_inventory(
+    sources: Iterable[InventorySource],
+    deadline_s: float,
+) -> Tuple[List[Tuple[str, str]], List[str]]:
+    """Queries all sources concurrently under a shared deadline
+
+    Results are merged in source order; if two sources disagree about an IP
+    the first one wins and the conflict is reported on stderr.
+
+    :return: tuple of (merged (ip, task id) pairs, names of failed sources)
+    """
+    sources = list(sources)
+    results: Dict[str, List[Tuple[str, str]]] = {}
+    errors: Dict[str, str] = {}
+
+    def run(source: InventorySource) -> None:
+        try:
+            results[source.name] = list(source.extract(deadline_s))
+        except Exception as e:
+            errors[source.name] = str(e)
+
+    # Daemon threads, so that a source which hangs past the deadline does
+    # not keep the process alive after we are done
+    threads = [
+        threading.Thread(target=run, args=(source,), daemon=True)
+        for source in sources
+    ]
+    for thread in threads:
+        thread.start()
+    end = time.monotonic() + deadline_s
+    for thread in threads:
+        thread.join(max(0.0, end - time.monotonic()))
+
+    merged: Dict[str, str] = {}
+    owner: Dict[str, str] = {}
+    failed = []
+    for source in sources:
+        if source.name not in results:
+            failed.append(source.name)
+            print(
+                'Inventory source {} failed: {}'.format(
+                    source.name,
+                    errors.get(source.name, 'deadline exceeded'),
+                ),
+                file=sys.stderr,
+            )
+            continue
+        for ip_addr, task_id in results[source.name]:
+            if ip_addr not in merged:
+                merged[ip_addr] = task_id
+                owner[ip_addr] = source.name
+            elif merged[ip_addr] != task_id:
+                print(
+                    'Conflict for {}: {} says {}, {} says {}; keeping {}'.format(
+                        ip_addr,
+                        owner[ip_addr], merged[ip_addr],
+                        source.name, task_id,
+                        merged[ip_addr],
+                    ),
+                    file=sys.stderr,
+                )
+
+    return list(merged.items()), failed
+
+
 def send_to_haproxy(
     command: str,
     timeout: int,
@@ -167,6 +323,23 @@ def main() -> None:
         action='store_true',
         help='Use kubernetes api pod extraction rather than default mesos method',
     )
+    parser.add_argument(
+        '--source',
+        '-s',
+        action='append',
+        help=(
+            'Inventory source to read containers from: docker, kubelet or '
+            'file:PATH. May be given several times; sources are queried '
+            'concurrently and merged in the given order. Defaults to '
+            'docker, or kubelet with --k8s'
+        ),
+    )
+    parser.add_argument(
+        '--deadline',
+        type=float,
+        default=DEFAULT_INVENTORY_DEADLINE_S,
+        help='Seconds to wait for all inventory sources (default: %(default)s)',
+    )
     parser.add_argument(
         'map_file',
         nargs='?',
@@ -175,19 +348,35 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    if args.update_haproxy:
-        prev_ip_to_task_id = get_prev_file_contents(args.map_file)
+    if args.source:
+        source_specs = args.source
+    elif args.k8s:
+        source_specs = ['kubelet']
+    else:
+        source_specs = ['docker']
+    try:
+        sources = [get_inventory_source(spec) for spec in source_specs]
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    prev_ip_to_task_id = get_prev_file_contents(args.map_file)
 
     new_lines = []
     ip_addrs = []
-    if args.k8s:
-        try:
-            service_ips_and_ids = extract_taskid_and_ip_k8s()
-        except Exception as e:
-            print(e, file=sys.stderr)
-            return
-    else:
-        service_ips_and_ids = extract_taskid_and_ip_mesos(get_docker_client())
+    service_ips_and_ids, failed = collect_inventory(sources, args.deadline)
+    if len(failed) == len(sources):
+        # Better to keep a stale map than to wipe it, but make sure whoever
+        # runs us notices
+        sys.exit(1)
+    if failed:
+        # We can't tell which of the previous entries belonged to the
+        # failed sources, so keep every entry nobody else claimed
+        seen = {ip_addr for ip_addr, _ in service_ips_and_ids}
+        service_ips_and_ids.extend(
+            (ip_addr, task_id)
+            for ip_addr, task_id in prev_ip_to_task_id.items()
+            if ip_addr not in seen
+        )
 
     for ip_addr, task_id in service_ips_and_ids:
         ip_addrs.append(ip_addr)
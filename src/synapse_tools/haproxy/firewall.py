@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+""" Firewall backends marking the SYNs that go through the plug lane """
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import abc
+import ipaddress
+import logging
+from typing import Dict
+from typing import Sequence
+from typing import Type
+
+from plumbum import local
+
+
+log = logging.getLogger(__name__)
+
+# Packets with this mark end up in the plug lane, see qdisc_util
+SYN_MARK = '1'
+
+NFT_TABLE = 'synapse_qdisc'
+
+# iptables' mangle table, which nftables spells 'priority mangle' from
+# version 0.9.1 on
+NFT_MANGLE_PRIORITY = -150
+
+
+def is_ipv6(
+    source_ip: str,
+) -> bool:
+    return ipaddress.ip_address(source_ip).version == 6
+
+
+class FirewallBackend(metaclass=abc.ABCMeta):
+    name: str
+
+    @abc.abstractmethod
+    def has_rules(
+        self,
+        source_ips: Sequence[str],
+    ) -> bool:
+        """ Checks that SYNs from every source IP get marked """
+
+    @abc.abstractmethod
+    def apply(
+        self,
+        source_ips: Sequence[str],
+    ) -> None:
+        """ Starts marking SYNs from the source IPs """
+
+    @abc.abstractmethod
+    def clear(
+        self,
+        source_ips: Sequence[str],
+    ) -> None:
+        """ Stops marking SYNs from the source IPs """
+
+    @abc.abstractmethod
+    def show(self) -> str:
+        """ Returns the rules in a human readable form """
+
+
+class IptablesBackend(FirewallBackend):
+    """ One mangle rule per source IP, through iptables or ip6tables
+
+    Every call reloads the whole table, which gets slow on hosts with big
+    rulesets.
+    """
+    name = 'iptables'
+
+    RULE = (
+        'OUTPUT', '-p', 'tcp', '--syn', '-j', 'MARK', '--set-mark', SYN_MARK,
+    )
+
+    def _run(
+        self,
+        action: str,
+        source_ip: str,
+    ) -> int:
+        command = local['ip6tables' if is_ipv6(source_ip) else 'iptables']
+        retcode, _, _ = command[
+            ('-t', 'mangle', action) + self.RULE + ('-s', source_ip)
+        ].run(retcode=None)
+        return retcode
+
+    def has_rules(
+        self,
+        source_ips: Sequence[str],
+    ) -> bool:
+        return all(self._run('-C', source_ip) == 0 for source_ip in source_ips)
+
+    def apply(
+        self,
+        source_ips: Sequence[str],
+    ) -> None:
+        for source_ip in source_ips:
+            log.info('Creating iptables rule to mark outgoing syns on {0}'.format(
+                source_ip))
+            if self._run('-I', source_ip) != 0:
+                raise RuntimeError(
+                    'Failed to add iptables rule for {0}'.format(source_ip))
+
+    def clear(
+        self,
+        source_ips: Sequence[str],
+    ) -> None:
+        # Ensure all copies of the rule are purged; -D fails once there
+        # are none left
+        for source_ip in source_ips:
+            while self._run('-D', source_ip) == 0:
+                pass
+
+    def show(self) -> str:
+        return local['iptables']['-L', '-t', 'mangle']()
+
+
+class NftablesBackend(FirewallBackend):
+    """ All rules in a dedicated table, replaced in a single transaction
+
+    `nft -f` applies a whole file atomically, so declaring the table,
+    deleting it and declaring it again with the new rules swaps the
+    ruleset without a moment where SYNs go unmarked, and without touching
+    anyone else's tables.
+    """
+    name = 'nftables'
+
+    def ruleset(
+        self,
+        source_ips: Sequence[str],
+    ) -> str:
+        rules = []
+        for source_ip in source_ips:
+            rules.append(
+                '        {0} saddr {1} tcp flags & (fin | syn | rst | ack) == syn '
+                'meta mark set {2}\n'.format(
+                    'ip6' if is_ipv6(source_ip) else 'ip', source_ip, SYN_MARK))
+        return (
+            self._delete_table() +
+            'table inet {0} {{\n'
+            '    chain output {{\n'
+            '        type route hook output priority {1}; policy accept;\n'
+            '{2}'
+            '    }}\n'
+            '}}\n'
+        ).format(NFT_TABLE, NFT_MANGLE_PRIORITY, ''.join(rules))
+
+    def _delete_table(self) -> str:
+        # Declaring the table first makes deleting it work whether or not
+        # it exists
+        return 'table inet {0}\ndelete table inet {0}\n'.format(NFT_TABLE)
+
+    def _load(
+        self,
+        ruleset: str,
+    ) -> None:
+        (local['nft']['-f', '-'] << ruleset)()
+
+    def has_rules(
+        self,
+        source_ips: Sequence[str],
+    ) -> bool:
+        retcode, stdout, _ = local['nft'][
+            'list', 'table', 'inet', NFT_TABLE,
+        ].run(retcode=None)
+        if retcode != 0:
+            return False
+        marking = [line for line in stdout.splitlines() if 'mark set' in line]
+        for source_ip in source_ips:
+            # nft prints addresses in their canonical form
+            saddr = 'saddr {0} '.format(ipaddress.ip_address(source_ip))
+            if not any(saddr in line for line in marking):
+                return False
+        return True
+
+    def apply(
+        self,
+        source_ips: Sequence[str],
+    ) -> None:
+        log.info('Loading nftables table {0} to mark outgoing syns on {1}'.format(
+            NFT_TABLE, ', '.join(source_ips)))
+        self._load(self.ruleset(source_ips))
+
+    def clear(
+        self,
+        source_ips: Sequence[str],
+    ) -> None:
+        self._load(self._delete_table())
+
+    def show(self) -> str:
+        _, stdout, _ = local['nft'][
+            'list', 'table', 'inet', NFT_TABLE,
+        ].run(retcode=None)
+        return stdout
+
+
+FIREWALL_BACKENDS: Dict[str, Type[FirewallBackend]] = {
+    IptablesBackend.name: IptablesBackend,
+    NftablesBackend.name: NftablesBackend,
+}
+
+
+def get_firewall_backend(
+    name: str,
+) -> FirewallBackend:
+    return FIREWALL_BACKENDS[name]()
@@ -4,19 +4,36 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import ipaddress
+import json
 import logging
 import os
 import subprocess
 import sys
+import time
+from typing import FrozenSet
+from typing import Optional
+from typing import Tuple
 
 import argparse
+import psutil
+from mypy_extensions import TypedDict
 
+from synapse_tools.haproxy.firewall import FIREWALL_BACKENDS
 from synapse_tools.haproxy.qdisc_util import check_setup
+from synapse_tools.haproxy.qdisc_util import DEFAULT_SYN_BYTES
 from synapse_tools.haproxy.qdisc_util import clear
+from synapse_tools.haproxy.qdisc_util import DEFAULT_FIREWALL
 from synapse_tools.haproxy.qdisc_util import manage_plug
 from synapse_tools.haproxy.qdisc_util import needs_setup
+from synapse_tools.haproxy.qdisc_util import PFIFO_LIMIT
+from synapse_tools.haproxy.qdisc_util import PlugController
+from synapse_tools.haproxy.qdisc_util import PlugStats
 from synapse_tools.haproxy.qdisc_util import setup
+from synapse_tools.haproxy.qdisc_util import size_plug_limit
 from synapse_tools.haproxy.qdisc_util import stat
+from synapse_tools.inotify import IN_FILE_REPLACED
+from synapse_tools.inotify import Inotify
 from pwd import getpwnam
 
 
@@ -27,20 +44,43 @@ INTERFACE_NAME = 'lo'
 # Traffic comes from the yocalhost IP
 SOURCE_IP = '169.254.255.254'
 
+# How long protect --pidfile keeps the plug in at most
+DEFAULT_UNPLUG_TIMEOUT_S = 5.0
+
+# How often protect --pidfile checks on the command and the new listeners
+PIDFILE_POLL_INTERVAL_S = 0.1
+LISTENER_POLL_INTERVAL_S = 0.005
+
+# Plug counters from the previous protected reload
+DEFAULT_STATE_FILE = '/var/run/synapse/qdisc_plug.json'
+
+# Size the plug for at least this long a window
+MIN_EXPECTED_WINDOW_S = 1.0
+
 # Log format for logging to console
 CONSOLE_FORMAT = '%(asctime)s - %(name)-12s: %(levelname)-8s %(message)s'
 
 
+class PlugHistory(TypedDict):
+    time: float
+    # Plug qdisc counters at the end of the previous protected reload
+    packets: int
+    bytes: int
+    # How long the plug was in for
+    window_s: float
+
+
 def stat_cmd(
     args: argparse.Namespace,
 ) -> int:
-    return stat(INTERFACE_NAME)
+    return stat(INTERFACE_NAME, args.firewall)
 
 
 def check_setup_cmd(
     args: argparse.Namespace,
 ) -> int:
-    return check_setup(INTERFACE_NAME)
+    return check_setup(
+        INTERFACE_NAME, args.source_ips, args.band_limit, args.firewall)
 
 
 def manage_plug_cmd(
@@ -58,19 +98,25 @@ def manage_plug_cmd(
 def needs_setup_cmd(
     args: argparse.Namespace,
 ) -> int:
-    return needs_setup(INTERFACE_NAME)
+    return needs_setup(
+        INTERFACE_NAME, args.source_ips, args.band_limit, args.firewall)
 
 
 def setup_cmd(
     args: argparse.Namespace,
 ) -> int:
-    return setup(INTERFACE_NAME, SOURCE_IP)
+    plug_limit = None
+    if args.plug_limit not in (None, 'auto'):
+        plug_limit = int(args.plug_limit)
+    return setup(
+        INTERFACE_NAME, args.source_ips, args.band_limit, plug_limit,
+        args.firewall)
 
 
 def clear_cmd(
     args: argparse.Namespace,
 ) -> int:
-    return clear(INTERFACE_NAME, SOURCE_IP)
+    return clear(INTERFACE_NAME, args.source_ips, args.firewall)
 
 
 def drop_perms() -> None:
@@ -83,6 +129,177 @@ def drop_perms() -> None:
     os.setuid(uid)
 
 
+def parse_plug_limit(
+    value: str,
+) -> str:
+    if value != 'auto' and not value.isdigit():
+        raise argparse.ArgumentTypeError(
+            'Expected a number of bytes or auto: %s' % value)
+    return value
+
+
+def load_plug_history(
+    path: str,
+) -> Optional[PlugHistory]:
+    try:
+        with open(path) as fh:
+            raw = json.load(fh)
+        return {
+            'time': float(raw['time']),
+            'packets': int(raw['packets']),
+            'bytes': int(raw['bytes']),
+            'window_s': float(raw['window_s']),
+        }
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_plug_history(
+    path: str,
+    history: PlugHistory,
+) -> None:
+    try:
+        with open(path, 'w') as fh:
+            json.dump(history, fh, sort_keys=True)
+    except IOError:
+        log.exception('Failed to save plug history to %s' % path)
+
+
+def choose_plug_limit(
+    args: argparse.Namespace,
+    history: Optional[PlugHistory],
+    stats: Optional[PlugStats],
+    now: float,
+) -> Optional[int]:
+    """ Works out the plug limit for this reload, None to leave it alone
+
+    With `--plug-limit auto` the limit fits the SYN rate seen by the plug
+    lane since the previous reload, over the longest window we expect.
+    """
+    if args.plug_limit is None:
+        return None
+    if args.plug_limit != 'auto':
+        return int(args.plug_limit)
+
+    syn_rate = 0.0
+    syn_bytes = float(DEFAULT_SYN_BYTES)
+    window_s = MIN_EXPECTED_WINDOW_S
+    if history is not None and stats is not None:
+        packets = stats.packets - history['packets']
+        elapsed = now - history['time']
+        # Counters start over when the qdisc is recreated
+        if packets > 0 and elapsed > 0:
+            syn_rate = packets / elapsed
+            syn_bytes = (stats.bytes - history['bytes']) / packets
+        window_s = max(window_s, history['window_s'])
+    if args.pidfile is not None:
+        window_s = min(window_s, args.unplug_timeout)
+
+    limit = size_plug_limit(syn_rate, window_s, syn_bytes)
+    log.info('Sizing plug for %.1f SYNs/s over %.1fs: %d bytes' % (
+        syn_rate, window_s, limit))
+    return limit
+
+
+def report_plug_window(
+    window_s: float,
+    before: Optional[PlugStats],
+    after: Optional[PlugStats],
+) -> None:
+    """ Logs how long SYNs were held back and how many went through it """
+    if before is None or after is None:
+        log.info('Plug window lasted %.1fms' % (window_s * 1000))
+        return
+    log.info(
+        'Plug window lasted %.1fms, %d packets (%d bytes) went through the '
+        'plug lane, %d dropped, %d packets (%d bytes) still queued' % (
+            window_s * 1000,
+            after.packets - before.packets,
+            after.bytes - before.bytes,
+            after.drops - before.drops,
+            after.qlen,
+            after.backlog,
+        )
+    )
+    if after.drops > before.drops:
+        log.error(
+            'The plug overflowed and dropped %d packets; raise --plug-limit '
+            'or use --plug-limit auto' % (after.drops - before.drops))
+
+
+def read_pid(
+    pidfile: str,
+) -> Optional[int]:
+    try:
+        with open(pidfile) as fh:
+            return int(fh.readline().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def get_listeners(
+    pid: Optional[int],
+) -> FrozenSet[Tuple[str, int]]:
+    """ Returns the addresses a process is listening on """
+    if pid is None:
+        return frozenset()
+    try:
+        connections = psutil.Process(pid).connections(kind='inet')
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return frozenset()
+    return frozenset(
+        (conn.laddr[0], conn.laddr[1]) for conn in connections
+        if conn.status == psutil.CONN_LISTEN
+    )
+
+
+def wait_for_new_listeners(
+    proc: 'subprocess.Popen[bytes]',
+    pidfile: str,
+    old_pid: Optional[int],
+    old_listeners: FrozenSet[Tuple[str, int]],
+    timeout: float,
+) -> bool:
+    """ Waits until a new process in `pidfile` listens where the old one did
+
+    Returns False if that didn't happen within `timeout` seconds or before
+    the command exited.
+    """
+    deadline = time.monotonic() + timeout
+    pidfile_dir, pidfile_name = os.path.split(os.path.abspath(pidfile))
+    with Inotify() as inotify:
+        inotify.add_watch(pidfile_dir, IN_FILE_REPLACED)
+        new_pid = None
+        while True:
+            if new_pid is None:
+                pid = read_pid(pidfile)
+                if pid is not None and pid != old_pid:
+                    new_pid = pid
+            if new_pid is not None:
+                listeners = get_listeners(new_pid)
+                if listeners and listeners >= old_listeners:
+                    log.info('Process %d is listening on %d addresses' % (
+                        new_pid, len(listeners)))
+                    return True
+
+            if proc.poll() is not None:
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.warning('Timed out waiting for new listeners')
+                return False
+
+            # Binding a socket makes no noise, so once we know the new pid
+            # we have to poll its sockets. Until then, sleep until the
+            # pidfile changes, waking up now and then to notice the
+            # command exiting.
+            if new_pid is None:
+                wait = PIDFILE_POLL_INTERVAL_S
+            else:
+                wait = LISTENER_POLL_INTERVAL_S
+            inotify.read_events(min(wait, remaining))
+
+
 def protect_call_cmd(
     args: argparse.Namespace,
 ) -> int:
@@ -90,28 +307,99 @@ def protect_call_cmd(
         print('Only root can execute protected binaries')
         return 1
 
+    # Everything that can be done before plugging is, so that the plug
+    # window is as short as possible
+    controller = None
+    before = None
     try:
-        try:
-            manage_plug(INTERFACE_NAME, enable_plug=True)
-        except Exception:
-            # If we fail to plug, it is no big deal, we might
-            # drop some traffic but let's not fail to run the
-            # command
-            log.exception('Failed to enable plug')
-        subprocess.check_call(
-            [args.cmd] + args.args,
-            preexec_fn=drop_perms
-        )
-    finally:
+        controller = PlugController(INTERFACE_NAME)
+        before = controller.get_stats()
+    except Exception:
+        log.exception('Failed to open netlink socket')
+
+    history = load_plug_history(args.state_file)
+    try:
+        plug_limit = choose_plug_limit(args, history, before, time.time())
+        if controller is not None and plug_limit is not None:
+            controller.set_limit(plug_limit)
+    except Exception:
+        log.exception('Failed to set the plug limit')
+
+    old_pid = None
+    old_listeners: FrozenSet[Tuple[str, int]] = frozenset()
+    if args.pidfile is not None:
+        old_pid = read_pid(args.pidfile)
+        old_listeners = get_listeners(old_pid)
+
+    plugged_at = time.monotonic()
+    unplugged = False
+
+    def unplug() -> None:
+        nonlocal unplugged
+        if unplugged:
+            return
+        unplugged = True
         # Netlink comms can be unreliable according to the manpage,
         # so do some retries to ensure we really turn off the plug
         # It would be really bad if we do not turn off the plug
         for i in range(3):
             try:
-                manage_plug(INTERFACE_NAME, enable_plug=False)
+                if controller is not None and i == 0:
+                    controller.unplug()
+                else:
+                    manage_plug(INTERFACE_NAME, enable_plug=False)
                 break
             except Exception:
                 log.exception('Failed to disable plug, try #%d' % i)
+        window_s = time.monotonic() - plugged_at
+
+        if controller is not None:
+            try:
+                after = controller.get_stats()
+                report_plug_window(window_s, before, after)
+            except Exception:
+                log.exception('Failed to read plug statistics')
+                return
+            if after is not None:
+                save_plug_history(args.state_file, {
+                    'time': time.time(),
+                    'packets': after.packets,
+                    'bytes': after.bytes,
+                    'window_s': window_s,
+                })
+
+    try:
+        try:
+            if controller is not None:
+                controller.plug()
+                plugged_at = time.monotonic()
+        except Exception:
+            # If we fail to plug, it is no big deal, we might
+            # drop some traffic but let's not fail to run the
+            # command
+            log.exception('Failed to enable plug')
+        cmd = [args.cmd] + args.args
+        if args.pidfile is None:
+            subprocess.check_call(cmd, preexec_fn=drop_perms)
+        else:
+            # Unplug as soon as the new instance accepts connections, or
+            # after the timeout at the latest, rather than once the whole
+            # reload command is done
+            proc = subprocess.Popen(cmd, preexec_fn=drop_perms)
+            try:
+                wait_for_new_listeners(
+                    proc, args.pidfile, old_pid, old_listeners,
+                    args.unplug_timeout,
+                )
+            finally:
+                unplug()
+            retcode = proc.wait()
+            if retcode:
+                raise subprocess.CalledProcessError(retcode, cmd)
+    finally:
+        unplug()
+        if controller is not None:
+            controller.close()
     return 0
 
 
@@ -120,26 +408,48 @@ def parse_options() -> argparse.Namespace:
         'Setup QoS queueing disciplines for haproxy'
     ))
     parser.add_argument('--verbose', '-v', action='store_true')
+    parser.add_argument(
+        '--firewall', choices=sorted(FIREWALL_BACKENDS),
+        default=DEFAULT_FIREWALL,
+        help='How to mark SYNs for the plug lane; nftables swaps its rules '
+             'in atomically (default: %(default)s)')
+    parser.add_argument(
+        '--source-ip', dest='source_ips', action='append', default=None,
+        help='Mark SYNs from this IPv4 or IPv6 address, can be repeated '
+             '(default: {0})'.format(SOURCE_IP))
     subparsers = parser.add_subparsers()
 
     stat_parser = subparsers.add_parser(
-        'stat', help='Show current qdisc and iptables setup')
+        'stat', help='Show current qdisc and firewall setup')
     stat_parser.set_defaults(func=stat_cmd)
 
     check_parser = subparsers.add_parser(
-        'check', help='Check qdisc and iptables are as expected')
+        'check', help='Check qdisc and firewall are as expected')
+    check_parser.add_argument(
+        '--band-limit', type=int, default=PFIFO_LIMIT,
+        help='Expected packet limit of the regular bands (default: %(default)s)')
     check_parser.set_defaults(func=check_setup_cmd)
 
     needs_setup_parser = subparsers.add_parser(
-        'needs_setup', help='Check if qdisc and iptables need setup')
+        'needs_setup', help='Check if qdisc and firewall need setup')
+    needs_setup_parser.add_argument(
+        '--band-limit', type=int, default=PFIFO_LIMIT,
+        help='Expected packet limit of the regular bands (default: %(default)s)')
     needs_setup_parser.set_defaults(func=needs_setup_cmd)
 
     setup_parser = subparsers.add_parser(
         'setup', help='Setup the qdisc')
+    setup_parser.add_argument(
+        '--band-limit', type=int, default=PFIFO_LIMIT,
+        help='Packet limit of the regular bands (default: %(default)s)')
+    setup_parser.add_argument(
+        '--plug-limit', type=parse_plug_limit, default=None,
+        help='Bytes the plug holds before it drops SYNs (default: sized '
+             'by the kernel from the device)')
     setup_parser.set_defaults(func=setup_cmd)
 
     clear_parser = subparsers.add_parser(
-        'clear', help='Clear the qdisc and iptables')
+        'clear', help='Clear the qdisc and firewall rules')
     clear_parser.set_defaults(func=clear_cmd)
 
     plug_parser = subparsers.add_parser(
@@ -151,13 +461,39 @@ def parse_options() -> argparse.Namespace:
 
     protect_parser = subparsers.add_parser(
         'protect', help='Run a command while network traffic is blocked')
+    protect_parser.add_argument(
+        '--pidfile', default=None,
+        help='Unplug as soon as a new process in this pidfile listens on '
+             'at least the addresses the previous one did, instead of '
+             'when the command exits')
+    protect_parser.add_argument(
+        '--unplug-timeout', type=float, default=DEFAULT_UNPLUG_TIMEOUT_S,
+        help='With --pidfile, unplug after this many seconds at the latest '
+             '(default: %(default)s)')
+    protect_parser.add_argument(
+        '--plug-limit', type=parse_plug_limit, default=None,
+        help='Bytes the plug holds before it drops SYNs, or auto to size it '
+             'from the SYN rate seen since the previous reload (default: '
+             'leave it alone)')
+    protect_parser.add_argument(
+        '--state-file', default=DEFAULT_STATE_FILE,
+        help='Where to remember plug counters between reloads for '
+             '--plug-limit auto (default: %(default)s)')
     protect_parser.add_argument(
         dest='cmd', help='Command to run while traffic is blocked')
     protect_parser.add_argument(
         'args', nargs=argparse.REMAINDER)
     protect_parser.set_defaults(func=protect_call_cmd)
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.source_ips is None:
+        args.source_ips = [SOURCE_IP]
+    for source_ip in args.source_ips:
+        try:
+            ipaddress.ip_address(source_ip)
+        except ValueError:
+            parser.error('Invalid --source-ip: {0}'.format(source_ip))
+    return args
 
 
 def setup_logging(
@@ -5,252 +5,626 @@ from __future__ import division
 from __future__ import print_function
 
 import logging
+import socket
 import struct
-
-from plumbum.cmd import grep
-from plumbum.cmd import iptables
-from plumbum.cmd import tc
+from types import TracebackType
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Sequence
+from typing import Set
+from typing import Tuple
+from typing import Type
 
 import pyroute2
 from pyroute2 import IPRoute
 from pyroute2.iproute import transform_handle
 from pyroute2.netlink import NLM_F_ACK
+from pyroute2.netlink import NLM_F_CREATE
+from pyroute2.netlink import NLM_F_EXCL
 from pyroute2.netlink import NLM_F_REQUEST
 from pyroute2.netlink.rtnl.tcmsg import tcmsg
 
+from synapse_tools.haproxy.firewall import get_firewall_backend
+from synapse_tools.haproxy.firewall import is_ipv6
+from synapse_tools.haproxy.firewall import SYN_MARK
+
 
 log = logging.getLogger(__name__)
 
 
+"""
+Create a traffic control setup as follows
+           1: root qdisc
+         /-|-\--------\
+        /  |  \        |
+       /   |   \       |
+     1:1  1:2  1:3    1:4  classes
+      |    |    |      |
+     10:  20:  30:    40:  qdiscs
+   pfifo pfifo pfifo  plug
+band  0    1    2      4
+
+This in combination with a firewall rule marking SYNs (iptables or
+nftables, see firewall.py) allows us to
+redirect SYN packets to the plug during a restart of a
+process sensitivew to that (e.g. haproxy), and then
+unplug later
+"""
+ROOT = '1:'
+PRIO_CLASS_FASTEST = '1:1'
+PRIO_CLASS_FAST = '1:2'
+PRIO_CLASS_SLOW = '1:3'
+PLUG_CLASS = '1:4'
+PRIO_QDISC_FASTEST = '10:'
+PRIO_QDISC_FAST = '20:'
+PRIO_QDISC_SLOW = '30:'
+PLUG_QDISC = '40:'
+IPTABLES_MARK = SYN_MARK
+
+PRIO_BANDS = 4
+PFIFO_LIMIT = 1000
+FILTER_PRIO = 1
+FILTER_PRIO_IPV6 = 2
+TC_H_ROOT = 0xFFFFFFFF
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+
+# The same priority map tc uses when none is given, see
+# include/uapi/linux/pkt_sched.h
+PRIO_PRIOMAP = (1, 2, 2, 2, 1, 2, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1)
+
+# struct tc_prio_qopt and struct tc_fifo_qopt
+PRIO_QOPT = struct.Struct('i16B')
+FIFO_QOPT = struct.Struct('I')
+
+DEFAULT_FIREWALL = 'iptables'
+
+
+TcNode = NamedTuple('TcNode', [
+    # qdisc, class or filter
+    ('type', str),
+    ('kind', str),
+    # In tc notation, e.g. '1:4'
+    ('handle', str),
+    ('parent', str),
+    # What matters about the node's options, e.g. 'limit 1000'
+    ('options', str),
+])
+
+
+def format_handle(
+    handle: int,
+) -> str:
+    if handle == TC_H_ROOT:
+        return 'root'
+    return '{0:x}:{1}'.format(
+        handle >> 16, '{0:x}'.format(handle & 0xFFFF) if handle & 0xFFFF else '')
+
+
+def format_tc_node(
+    node: TcNode,
+) -> str:
+    return '{0} {1} {2} parent {3} {4}'.format(
+        node.type, node.kind, node.handle, node.parent, node.options,
+    ).rstrip()
+
+
+def expected_tc_tree(
+    band_limit: int = PFIFO_LIMIT,
+    ipv6: bool = False,
+) -> Set[TcNode]:
+    """The qdiscs, classes and filters that setup() creates
+
+    IPv6 SYNs need a filter of their own, which is only there when some
+    source IP is IPv6.
+    """
+    tree = {
+        TcNode('qdisc', 'prio', ROOT, 'root', 'bands %d' % PRIO_BANDS),
+        TcNode('qdisc', 'pfifo', PRIO_QDISC_FASTEST, PRIO_CLASS_FASTEST,
+               'limit %d' % band_limit),
+        TcNode('qdisc', 'pfifo', PRIO_QDISC_FAST, PRIO_CLASS_FAST,
+               'limit %d' % band_limit),
+        TcNode('qdisc', 'pfifo', PRIO_QDISC_SLOW, PRIO_CLASS_SLOW,
+               'limit %d' % band_limit),
+        TcNode('qdisc', 'plug', PLUG_QDISC, PLUG_CLASS, ''),
+        TcNode('filter', 'fw', '0:%s' % IPTABLES_MARK, ROOT,
+               'prio %d protocol ip classid %s' % (FILTER_PRIO, PLUG_CLASS)),
+    }
+    if ipv6:
+        tree.add(TcNode(
+            'filter', 'fw', '0:%s' % IPTABLES_MARK, ROOT,
+            'prio %d protocol ipv6 classid %s' % (FILTER_PRIO_IPV6, PLUG_CLASS)))
+    for band in range(1, PRIO_BANDS + 1):
+        tree.add(TcNode('class', 'prio', '1:%d' % band, ROOT, ''))
+    return tree
+
+
+def diff_tc_tree(
+    expected: Set[TcNode],
+    actual: Set[TcNode],
+) -> Tuple[List[TcNode], List[TcNode]]:
+    """Returns the (missing, unexpected) nodes of the actual tree
+
+    A pfifo in place of the plug is fine: that is what setup() falls back
+    to on kernels without sch_plug.
+    """
+    plugs = {
+        (node.handle, node.parent): node
+        for node in expected if node.kind == 'plug'
+    }
+    actual = {
+        plugs.get((node.handle, node.parent), node)
+        if node.type == 'qdisc' and node.kind == 'pfifo' else node
+        for node in actual
+    }
+    return sorted(expected - actual), sorted(actual - expected)
+
+
+def _raw_options(
+    msg: tcmsg,
+) -> bytes:
+    """Returns TCA_OPTIONS of a kind pyroute2 doesn't know how to decode
+
+    pyroute2 hands those over as a hexdump, e.g. '04:00:00:00'.
+    """
+    options = msg.get_attr('TCA_OPTIONS')
+    if isinstance(options, bytes):
+        return options
+    if isinstance(options, str):
+        return bytes.fromhex(options.replace(':', ''))
+    return b''
+
+
+PROTOCOL_NAMES = {
+    ETH_P_IP: 'ip',
+    ETH_P_IPV6: 'ipv6',
+}
+
+
+def _describe_options(
+    msg_type: str,
+    msg: tcmsg,
+) -> str:
+    kind = msg.get_attr('TCA_KIND')
+    if msg_type == 'qdisc' and kind == 'prio':
+        raw = _raw_options(msg)
+        if len(raw) >= PRIO_QOPT.size:
+            return 'bands %d' % PRIO_QOPT.unpack_from(raw)[0]
+    elif msg_type == 'qdisc' and kind in ('pfifo', 'bfifo'):
+        raw = _raw_options(msg)
+        if len(raw) >= FIFO_QOPT.size:
+            return 'limit %d' % FIFO_QOPT.unpack_from(raw)[0]
+    elif msg_type == 'filter':
+        options = msg.get_attr('TCA_OPTIONS')
+        classid = options.get_attr('TCA_FW_CLASSID') if options else None
+        protocol = socket.ntohs(msg['info'] & 0xFFFF)
+        return 'prio %d protocol %s classid %s' % (
+            msg['info'] >> 16,
+            PROTOCOL_NAMES.get(protocol, '0x%04x' % protocol),
+            format_handle(classid) if classid is not None else 'none',
+        )
+    return ''
+
+
+def _to_tc_nodes(
+    msg_type: str,
+    msgs: Iterable[tcmsg],
+) -> Set[TcNode]:
+    nodes: Set[TcNode] = set()
+    for msg in msgs:
+        kind = msg.get_attr('TCA_KIND')
+        if kind is None:
+            continue
+        if msg_type == 'filter':
+            # The kernel also dumps the filter's head, which has no handle
+            if msg['handle'] == 0:
+                continue
+            handle = '0:%x' % msg['handle']
+        else:
+            handle = format_handle(msg['handle'])
+        nodes.add(TcNode(
+            msg_type, kind, handle, format_handle(msg['parent']),
+            _describe_options(msg_type, msg),
+        ))
+    return nodes
+
+
+def get_tc_tree(
+    ip: IPRoute,
+    index: int,
+) -> Set[TcNode]:
+    """Dumps the qdiscs, classes and filters of an interface"""
+    tree = _to_tc_nodes('qdisc', ip.get_qdiscs(index))
+    # Only look below our own root: the kernel's default qdisc may be
+    # classless, and dumping its classes or filters is an error
+    if any(node.handle == ROOT for node in tree):
+        tree |= _to_tc_nodes('class', ip.get_classes(index))
+        tree |= _to_tc_nodes(
+            'filter', ip.get_filters(index, parent=transform_handle(ROOT)))
+    return tree
+
+
 def stat(
     interface_name: str,
+    firewall: str = DEFAULT_FIREWALL,
 ) -> int:
-    """ Show status of existing qdisc and iptables rules """
-    for tc_type in ('qdisc', 'class', 'filter'):
-        print('=' * 20 + ' tc {0} '.format(tc_type) + '=' * 20)
-        print(tc['-s', tc_type, 'show', 'dev', interface_name]())
-
-    print('=' * 20 + ' iptables rules ' + '=' * 20)
-    print(iptables['-L', '-t', 'mangle']())
+    """ Show status of existing qdisc and firewall rules """
+    ip = IPRoute()
+    try:
+        index = ip.link_lookup(ifname=interface_name)[0]
+        for msg_type, msgs in (
+            ('qdisc', ip.get_qdiscs(index)),
+            ('class', ip.get_classes(index)),
+            ('filter', ip.get_filters(index, parent=transform_handle(ROOT))),
+        ):
+            print('=' * 20 + ' tc {0} '.format(msg_type) + '=' * 20)
+            for msg in msgs:
+                print(_format_tc_msg(msg_type, msg))
+    finally:
+        ip.close()
+
+    backend = get_firewall_backend(firewall)
+    print('=' * 20 + ' {0} rules '.format(backend.name) + '=' * 20)
+    print(backend.show())
     return 0
 
 
+def _format_tc_msg(
+    msg_type: str,
+    msg: tcmsg,
+) -> str:
+    line = '{0} {1} {2} parent {3} {4}'.format(
+        msg_type, msg.get_attr('TCA_KIND'), format_handle(msg['handle']),
+        format_handle(msg['parent']), _describe_options(msg_type, msg),
+    ).rstrip()
+    stats = msg.get_attr('TCA_STATS')
+    if stats is not None:
+        line += '\n Sent {0} bytes {1} pkt (dropped {2}, overlimits {3}) ' \
+            'backlog {4}b {5}p'.format(
+                stats['bytes'], stats['packets'], stats['drop'],
+                stats['overlimits'], stats['backlog'], stats['qlen'])
+    return line
+
+
 def check_setup(
     interface_name: str,
+    source_ips: Sequence[str],
+    band_limit: int = PFIFO_LIMIT,
+    firewall: str = DEFAULT_FIREWALL,
 ) -> int:
-    """ Checks the existing qdisc and iptables rules """
-    tc_cmd = tc['-s', 'qdisc', 'show', 'dev', interface_name]
-    tc_grep_cmd = grep['qdisc']
-    tc_chain = (tc_cmd | tc_grep_cmd)
-
-    iptables_cmd = iptables['-L', '-t', 'mangle']
-    iptables_grep_cmd = grep['MARK xset 0x' + IPTABLES_MARK]
-    iptables_chain = (iptables_cmd | iptables_grep_cmd)
+    """ Checks the existing qdisc and firewall rules
 
-    tc_run = tc_chain.run(retcode=None)
-    iptables_run = iptables_chain.run(retcode=None)
+    Returns 0 if the setup is exactly what setup() creates, 1 if there is
+    none and 2 if there is something else.
+    """
+    ip = IPRoute()
+    try:
+        index = ip.link_lookup(ifname=interface_name)[0]
+        actual = get_tc_tree(ip, index)
+    finally:
+        ip.close()
 
-    if tc_run[0] != 0 or iptables_run[0] != 0:
+    if (not any(node.handle == ROOT for node in actual) or
+            not get_firewall_backend(firewall).has_rules(source_ips)):
         log.info('No existing setup for {0}'.format(interface_name))
         return 1
 
-    tc_result = tc_run[1].count('\n')
-    iptables_result = iptables_run[1].count('\n')
-
-    if tc_result == 5 and iptables_result > 0:
-        log.info('Expected setup exists for {0}'.format(interface_name))
-    else:
+    expected = expected_tc_tree(
+        band_limit, ipv6=any(is_ipv6(source_ip) for source_ip in source_ips))
+    missing, unexpected = diff_tc_tree(expected, actual)
+    if missing or unexpected:
+        for node in missing:
+            log.error('Missing {0}'.format(format_tc_node(node)))
+        for node in unexpected:
+            log.error('Unexpected {0}'.format(format_tc_node(node)))
         log.error('An unexpected setup exists for {0}'.format(interface_name))
         return 2
+
+    log.info('Expected setup exists for {0}'.format(interface_name))
     return 0
 
 
 def needs_setup(
     interface_name: str,
+    source_ips: Sequence[str],
+    band_limit: int = PFIFO_LIMIT,
+    firewall: str = DEFAULT_FIREWALL,
 ) -> int:
-    """ Checks if there are no existing qdisc and iptables rules """
-    check_result = check_setup(interface_name)
+    """ Checks if there are no existing qdisc and firewall rules """
+    check_result = check_setup(interface_name, source_ips, band_limit, firewall)
     if check_result == 0:
         return 1
     return 0
 
 
-"""
-Create a traffic control setup as follows
-           1: root qdisc
-         /-|-\--------\
-        /  |  \        |
-       /   |   \       |
-     1:1  1:2  1:3    1:4  classes
-      |    |    |      |
-     10:  20:  30:    40:  qdiscs
-   pfifo pfifo pfifo  plug
-band  0    1    2      4
-
-This in combination with an iptables rule allows us to
-redirect SYN packets to the plug during a restart of a
-process sensitivew to that (e.g. haproxy), and then
-unplug later
-"""
-ROOT = '1:'
-PRIO_CLASS_FASTEST = '1:1'
-PRIO_CLASS_FAST = '1:2'
-PRIO_CLASS_SLOW = '1:3'
-PLUG_CLASS = '1:4'
-PRIO_QDISC_FASTEST = '10:'
-PRIO_QDISC_FAST = '20:'
-PRIO_QDISC_SLOW = '30:'
-PLUG_QDISC = '40:'
-IPTABLES_MARK = '1'
+def _add_qdisc(
+    ip: IPRoute,
+    index: int,
+    kind: str,
+    handle: str,
+    parent: str,
+    opts: Optional[bytes] = None,
+) -> None:
+    # pyroute2 has no helpers for these kinds, so build the message like
+    # tc would
+    msg = tcmsg()
+    msg['index'] = index
+    msg['handle'] = transform_handle(handle)
+    msg['parent'] = TC_H_ROOT if parent == 'root' else transform_handle(parent)
+    msg['attrs'] = [['TCA_KIND', kind]]
+    if opts is not None:
+        msg['attrs'].append(['TCA_OPTIONS', opts])
+    ip.nlm_request(
+        msg, msg_type=pyroute2.netlink.rtnl.RTM_NEWQDISC,
+        msg_flags=NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL,
+    )
 
 
 def _apply_tc_rules(
     interface_name: str,
+    band_limit: int = PFIFO_LIMIT,
+    plug_limit: Optional[int] = None,
+    ipv6: bool = False,
 ) -> None:
     log.info('Creating prio qdisc with a plug lane for {0}'.format(
         interface_name))
-    tc['qdisc', 'add', 'dev', interface_name,
-       'root', 'handle', ROOT, 'prio', 'bands', '4']()
-    tc['qdisc', 'add', 'dev', interface_name,
-       'parent', PRIO_CLASS_FASTEST,
-       'handle', PRIO_QDISC_FASTEST,
-       'pfifo', 'limit', '1000']()
-    tc['qdisc', 'add', 'dev', interface_name,
-       'parent', PRIO_CLASS_FAST,
-       'handle', PRIO_QDISC_FAST,
-       'pfifo', 'limit', '1000']()
-    tc['qdisc', 'add', 'dev', interface_name,
-       'parent', PRIO_CLASS_SLOW,
-       'handle', PRIO_QDISC_SLOW,
-       'pfifo', 'limit', '1000']()
+    ip = IPRoute()
     try:
-        tc['qdisc', 'add', 'dev', interface_name,
-           'parent', PLUG_CLASS,
-           'handle', PLUG_QDISC, 'plug']()
-    except Exception:
-        # If we can't create a plug because of an older
-        # kernel, just make a fifo
-        tc['qdisc', 'add', 'dev', interface_name,
-           'parent', PLUG_CLASS,
-           'handle', PLUG_QDISC,
-           'pfifo', 'limit', '1000']()
-
-    tc['filter', 'add', 'dev', interface_name,
-       'protocol', 'ip', 'parent', ROOT, 'prio', '1',
-       'handle', IPTABLES_MARK, 'fw', 'classid', PLUG_CLASS]()
+        index = ip.link_lookup(ifname=interface_name)[0]
+        _add_qdisc(ip, index, 'prio', ROOT, 'root',
+                   PRIO_QOPT.pack(PRIO_BANDS, *PRIO_PRIOMAP))
+        fifo_opts = FIFO_QOPT.pack(band_limit)
+        for handle, parent in (
+            (PRIO_QDISC_FASTEST, PRIO_CLASS_FASTEST),
+            (PRIO_QDISC_FAST, PRIO_CLASS_FAST),
+            (PRIO_QDISC_SLOW, PRIO_CLASS_SLOW),
+        ):
+            _add_qdisc(ip, index, 'pfifo', handle, parent, fifo_opts)
+        # Without options the kernel sizes the plug from the device's
+        # txqueuelen and MTU
+        plug_opts = None
+        if plug_limit is not None:
+            plug_opts = struct.pack('iI', TCQ_PLUG_LIMIT, plug_limit)
+        try:
+            _add_qdisc(ip, index, 'plug', PLUG_QDISC, PLUG_CLASS, plug_opts)
+        except pyroute2.netlink.NetlinkError:
+            # If we can't create a plug because of an older
+            # kernel, just make a fifo
+            _add_qdisc(ip, index, 'pfifo', PLUG_QDISC, PLUG_CLASS, fifo_opts)
+
+        filters = [(FILTER_PRIO, ETH_P_IP)]
+        if ipv6:
+            filters.append((FILTER_PRIO_IPV6, ETH_P_IPV6))
+        for prio, protocol in filters:
+            ip.tc('add-filter', 'fw', index, int(IPTABLES_MARK),
+                  parent=transform_handle(ROOT),
+                  prio=prio,
+                  protocol=protocol,
+                  classid=transform_handle(PLUG_CLASS))
+    finally:
+        ip.close()
     # Ensure the device is unplugged by default
     manage_plug(interface_name, enable_plug=False)
 
 
-def _apply_iptables_rule(
-    source_ip: str,
-) -> None:
-    log.info('Creating iptables rule to mark outgoing syns on {0}'.format(
-        source_ip))
-    iptables[
-        '-t', 'mangle', '-I', 'OUTPUT', '-p', 'tcp',
-        '-s', source_ip, '--syn', '-j', 'MARK', '--set-mark', IPTABLES_MARK
-    ]()
-
-
 def setup(
     interface_name: str,
-    source_ip: str,
+    source_ips: Sequence[str],
+    band_limit: int = PFIFO_LIMIT,
+    plug_limit: Optional[int] = None,
+    firewall: str = DEFAULT_FIREWALL,
 ) -> int:
-    """ Sets up qdisc and iptables rules on the provided devices
+    """ Sets up qdisc and firewall rules on the provided devices
 
     This effectively creates a normal prio qdisc with an extra plug lane.
-    The plug lane always gets traffic based on iptables marks.
+    The plug lane always gets traffic based on firewall marks.
     The extra lane can be plugged or unplugged using manage_plug.
     """
-    status = check_setup(interface_name)
+    status = check_setup(interface_name, source_ips, band_limit, firewall)
     if status != 0:
         log.info('Clearing any existing config before attempting setup')
-        clear(interface_name, source_ip)
+        clear(interface_name, source_ips, firewall)
     else:
         log.info('Doing nothing')
         return 0
-    _apply_tc_rules(interface_name)
-    _apply_iptables_rule(source_ip)
+    _apply_tc_rules(
+        interface_name, band_limit, plug_limit,
+        ipv6=any(is_ipv6(source_ip) for source_ip in source_ips))
+    get_firewall_backend(firewall).apply(source_ips)
     return 0
 
 
 def clear(
     interface_name: str,
-    source_ip: str,
+    source_ips: Sequence[str],
+    firewall: str = DEFAULT_FIREWALL,
 ) -> int:
+    ip = IPRoute()
     try:
-        tc['qdisc', 'del', 'dev', interface_name, 'root']()
-    except Exception:
+        index = ip.link_lookup(ifname=interface_name)[0]
+        # Deleting the root qdisc takes everything below it along
+        msg = tcmsg()
+        msg['index'] = index
+        msg['handle'] = 0
+        msg['parent'] = TC_H_ROOT
+        ip.nlm_request(
+            msg, msg_type=pyroute2.netlink.rtnl.RTM_DELQDISC,
+            msg_flags=NLM_F_REQUEST | NLM_F_ACK,
+        )
+    except pyroute2.netlink.NetlinkError:
+        # There was nothing to delete
         pass
+    finally:
+        ip.close()
 
-    # Ensure all iptables rules are purged on the output device
-    while True:
-        try:
-            iptables[
-                '-t', 'mangle', '-D', 'OUTPUT', '-p', 'tcp',
-                '-s', source_ip, '--syn', '-j',
-                'MARK', '--set-mark', IPTABLES_MARK
-            ]()
-        except Exception:
-            break
+    get_firewall_backend(firewall).clear(source_ips)
     return 0
 
 
-def _manage_plug_via_netlink(
-    interface_name: str,
-    action_name: str = 'unplug',
-) -> None:
-    """ Manipulates the plug qdisc via netlink
+# See the linux source at include/uapi/linux/pkt_sched.h
+TCQ_PLUG_BUFFER = 0
+TCQ_PLUG_RELEASE_ONE = 1
+TCQ_PLUG_RELEASE_INDEFINITE = 2
+TCQ_PLUG_LIMIT = 3
+
+# The kernel only looks at the limit for TCQ_PLUG_LIMIT; it is in bytes
+PLUG_PACKET_LIMIT = 10000
+
+# Bounds and headroom for sizing the plug from the observed SYN rate
+MIN_PLUG_LIMIT_BYTES = 1024 * 1024
+MAX_PLUG_LIMIT_BYTES = 256 * 1024 * 1024
+PLUG_LIMIT_HEADROOM = 4
+
+# A SYN with the usual options, including link layer header, as seen on lo
+DEFAULT_SYN_BYTES = 74
+
+
+PlugStats = NamedTuple('PlugStats', [
+    # Cumulative counters of the plug qdisc
+    ('packets', int),
+    ('bytes', int),
+    ('drops', int),
+    # What is queued right now
+    ('qlen', int),
+    ('backlog', int),
+])
+
+
+class PlugController(object):
+    """ Plugs and unplugs the plug lane over a single netlink socket
+
+    Opening the socket, looking up the interface and building the messages
+    all happen up front, so that plugging and unplugging only cost one
+    netlink round trip each. That matters because every SYN arriving in
+    between waits in the queue.
 
     FIXME: Once we have a modern userpace, replace this with appropriate
     calls to nl-qdisc-add
     """
-    ip = IPRoute()
-    index = ip.link_lookup(ifname=interface_name)[0]
-    # See the linux source at include/uapi/linux/pkt_sched.h
-    # #define TCQ_PLUG_BUFFER                0
-    # #define TCQ_PLUG_RELEASE_ONE           1
-    # #define TCQ_PLUG_RELEASE_INDEFINITE    2
-    # #define TCQ_PLUG_LIMIT                 3
-    action = {'unplug': 2, 'plug': 0}[action_name]
-    packet_limit = 10000
-    handle = transform_handle(PLUG_QDISC)
-    parent = transform_handle(PLUG_CLASS)
-    flags = NLM_F_REQUEST | NLM_F_ACK
-    command = pyroute2.netlink.rtnl.RTM_NEWQDISC
-    # This is a bit of magic sauce, inspired by xen's remus project
-    opts = struct.pack('iI', action, packet_limit)
 
-    msg = tcmsg()
-    msg['index'] = index
-    msg['handle'] = handle
-    msg['parent'] = parent
-    msg['attrs'] = [['TCA_KIND', 'plug']]
-    msg['attrs'].append(['TCA_OPTIONS', opts])
-    try:
-        nlm_response = ip.nlm_request(msg, msg_type=command, msg_flags=flags)
-    except pyroute2.netlink.NetlinkError as nle:
-        if nle.code == 22:
-            # This is an old kernel and we're talking to a qfifo, chill
-            log.warn('Detected a non plug qdisc, likely due to an old kernel. '
-                     'If you wish to have zero downtime haproxy restarts, '
-                     'upgrade your kernel. '
-                     'Doing nothing to the SYN traffic lane...')
-            return
-        else:
+    def __init__(
+        self,
+        interface_name: str,
+    ) -> None:
+        self.ip = IPRoute()
+        try:
+            self.index = self.ip.link_lookup(ifname=interface_name)[0]
+        except Exception:
+            self.ip.close()
             raise
+        self._plug_msg = self._build_plug_msg(TCQ_PLUG_BUFFER)
+        self._unplug_msg = self._build_plug_msg(TCQ_PLUG_RELEASE_INDEFINITE)
+        self._stats_msg = tcmsg()
+        self._stats_msg['index'] = self.index
+
+    def _build_plug_msg(
+        self,
+        action: int,
+        limit: int = PLUG_PACKET_LIMIT,
+    ) -> tcmsg:
+        msg = tcmsg()
+        msg['index'] = self.index
+        msg['handle'] = transform_handle(PLUG_QDISC)
+        msg['parent'] = transform_handle(PLUG_CLASS)
+        msg['attrs'] = [['TCA_KIND', 'plug']]
+        # This is a bit of magic sauce, inspired by xen's remus project
+        msg['attrs'].append(
+            ['TCA_OPTIONS', struct.pack('iI', action, limit)])
+        return msg
+
+    def _send(
+        self,
+        msg: tcmsg,
+    ) -> None:
+        try:
+            nlm_response = self.ip.nlm_request(
+                msg,
+                msg_type=pyroute2.netlink.rtnl.RTM_NEWQDISC,
+                msg_flags=NLM_F_REQUEST | NLM_F_ACK,
+            )
+        except pyroute2.netlink.NetlinkError as nle:
+            if nle.code == 22:
+                # This is an old kernel and we're talking to a qfifo, chill
+                log.warn('Detected a non plug qdisc, likely due to an old kernel. '
+                         'If you wish to have zero downtime haproxy restarts, '
+                         'upgrade your kernel. '
+                         'Doing nothing to the SYN traffic lane...')
+                return
+            else:
+                raise
+
+        # As per the netlink manpage (man 7 netlink), we expect an
+        # acknowledgment as a NLMSG_ERROR packet with the error field being 0,
+        # which it looks like pyroute2 treats as None. Really we want it to be
+        # non negative.
+        if not (len(nlm_response) > 0 and
+                nlm_response[0]['event'] == 'NLMSG_ERROR' and
+                nlm_response[0]['header']['error'] is None):
+            raise RuntimeError(
+                'Had an error while communicating with netlink: {0}'.format(
+                    nlm_response))
+
+    def plug(self) -> None:
+        self._send(self._plug_msg)
+
+    def set_limit(
+        self,
+        limit_bytes: int,
+    ) -> None:
+        """ Sets how many bytes the plug holds before dropping packets """
+        self._send(self._build_plug_msg(TCQ_PLUG_LIMIT, limit_bytes))
+
+    def unplug(self) -> None:
+        self._send(self._unplug_msg)
+
+    def get_stats(self) -> Optional[PlugStats]:
+        """ Reads TCA_STATS of the plug qdisc, None if there is none """
+        handle = transform_handle(PLUG_QDISC)
+        for msg in self.ip.nlm_request(
+            self._stats_msg, msg_type=pyroute2.netlink.rtnl.RTM_GETQDISC,
+        ):
+            if msg['index'] != self.index or msg['handle'] != handle:
+                continue
+            stats = msg.get_attr('TCA_STATS')
+            if stats is None:
+                return None
+            return PlugStats(
+                packets=stats['packets'],
+                bytes=stats['bytes'],
+                drops=stats['drop'],
+                qlen=stats['qlen'],
+                backlog=stats['backlog'],
+            )
+        return None
+
+    def close(self) -> None:
+        self.ip.close()
+
+    def __enter__(self) -> 'PlugController':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+
+def size_plug_limit(
+    syn_rate: float,
+    window_s: float,
+    syn_bytes: float = DEFAULT_SYN_BYTES,
+) -> int:
+    """ Returns a plug limit in bytes that holds `window_s` seconds of SYNs
 
-    # As per the netlink manpage (man 7 netlink), we expect an
-    # acknowledgment as a NLMSG_ERROR packet with the error field being 0,
-    # which it looks like pyroute2 treats as None. Really we want it to be
-    # non negative.
-    if not(len(nlm_response) > 0 and
-           nlm_response[0]['event'] == 'NLMSG_ERROR' and
-           nlm_response[0]['header']['error'] is None):
-        raise RuntimeError(
-            'Had an error while communicating with netlink: {0}'.format(
-                nlm_response))
+    With some headroom for bursts, and within sane bounds.
+    """
+    limit = int(syn_rate * window_s * syn_bytes * PLUG_LIMIT_HEADROOM)
+    return max(MIN_PLUG_LIMIT_BYTES, min(MAX_PLUG_LIMIT_BYTES, limit))
 
 
 def manage_plug(
@@ -262,12 +636,13 @@ def manage_plug(
     Note that when enable_plug is True, traffic is queued, and when
     enable_plug is False, traffic flows normally.
     """
-    if enable_plug:
-        log.info('Plugging traffic on the plug lane ...')
-        _manage_plug_via_netlink(interface, 'plug')
-        log.info('Done.')
-    else:
-        log.info('Unplugging traffic on the plug lane ...')
-        _manage_plug_via_netlink(interface, 'unplug')
-        log.info('Done.')
+    with PlugController(interface) as controller:
+        if enable_plug:
+            log.info('Plugging traffic on the plug lane ...')
+            controller.plug()
+            log.info('Done.')
+        else:
+            log.info('Unplugging traffic on the plug lane ...')
+            controller.unplug()
+            log.info('Done.')
     return 0
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+"""Reports how many log lines HAProxy dropped, through its stats socket.
+
+HAProxy counts every line it couldn't send in DroppedLogs of `show info`:
+datagrams the kernel refused with the 'udp' and 'unix' log targets, and
+lines that didn't fit in the ring with the 'ring' one.  With --events the
+lines still buffered in the ring are printed too, which shows how far
+behind the forwarder is.
+"""
+import argparse
+import socket
+import sys
+from typing import Dict
+
+from synapse_tools.configure_synapse import HAPROXY_LOG_RING
+
+
+DEFAULT_STATS_SOCKET = '/var/run/synapse/haproxy.sock'
+DEFAULT_TIMEOUT_S = 5.0
+
+RECV_BYTES = 65536
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--socket', default=DEFAULT_STATS_SOCKET,
+                        help='HAProxy stats socket (default: %(default)s).')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT_S,
+                        help='Seconds to wait for HAProxy (default: %(default)s).')
+    parser.add_argument('--events', action='store_true',
+                        help='Print the lines buffered in the log ring.')
+    parser.add_argument('--max-dropped', type=int, default=None,
+                        help='Exit non-zero if HAProxy dropped more lines than this.')
+    return parser.parse_args()
+
+
+def query_stats_socket(
+    socket_path: str,
+    command: str,
+    timeout: float,
+) -> str:
+    s = socket.socket(socket.AF_UNIX)
+    s.settimeout(timeout)
+    try:
+        s.connect(socket_path)
+        s.sendall((command + '\n').encode())
+        # HAProxy closes the connection once it has answered
+        chunks = []
+        while True:
+            chunk = s.recv(RECV_BYTES)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        s.close()
+    return b''.join(chunks).decode('utf-8', 'replace')
+
+
+def parse_info(
+    output: str,
+) -> Dict[str, str]:
+    info = {}
+    for line in output.splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            info[key.strip()] = value.strip()
+    return info
+
+
+def get_dropped_logs(
+    socket_path: str,
+    timeout: float,
+) -> int:
+    info = parse_info(query_stats_socket(socket_path, 'show info', timeout))
+    # HAProxy < 1.9 doesn't count them
+    return int(info.get('DroppedLogs', 0))
+
+
+def main() -> None:
+    args = parse_args()
+    dropped_logs = get_dropped_logs(args.socket, args.timeout)
+    print('DroppedLogs: %d' % dropped_logs)
+
+    if args.events:
+        sys.stdout.write(query_stats_socket(
+            args.socket, 'show events %s' % HAPROXY_LOG_RING, args.timeout))
+
+    if args.max_dropped is not None and dropped_logs > args.max_dropped:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,84 +11,662 @@ instance can spend in the alumnus state by killing such processes after a
 specified period of time.
 
 How do we know how long a process has spent in the alumnus state?  The first
-time we see a non-main haproxy instance, we create an entry for it in the
-specified state directory.  Once an entry reaches the specified 'reap age',
-the associated haproxy instance is killed.
+time we see a non-main haproxy instance, we record the time in a state file.
+Once an alumnus reaches the specified 'reap age', it is killed.
+
+Run from cron, the reaper only notices a reload the next time it runs.  With
+--daemon it instead watches the pidfile with inotify, records the exact time
+each main instance turned into an alumnus, and wakes up exactly when the
+next alumnus is due to be reaped.
+
+The same applies to nginx: on reload the old master renames its pidfile to
+`.oldbin` and keeps its workers around until their streams finish.  With
+--config the reaper handles a list of proxies, each with its own pidfile and
+policy.  An alumnus is any process with the proxy's name that isn't the
+main instance nor a worker forked from another one; with `kill_children`
+its children (nginx workers) are killed along with it.
 
 See SRV-1404 for more background info.
 """
 
 
 import errno
+import json
 import logging
 import operator
 import os
+import pwd
+import signal
+import tempfile
 import time
+from typing import Dict
+from typing import FrozenSet
 from typing import Iterator
 from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
 
 import argparse
 import psutil
+from mypy_extensions import TypedDict
+
+from synapse_tools.inotify import IN_FILE_REPLACED
+from synapse_tools.inotify import Inotify
 
 
 DEFAULT_USERNAME = 'nobody'
 
+# Legacy per-alumnus pidfile directory, migrated into DEFAULT_STATE_FILE
 DEFAULT_STATE_DIR = '/var/run/synapse_alumni'
 
+DEFAULT_STATE_FILE = '/var/run/synapse_alumni.json'
+
 DEFAULT_REAP_AGE_S = 60 * 60
 
 DEFAULT_MAX_PROCS = 10
 
+# In daemon mode, how often we rescan even without a reload or a pending
+# reap, so that we notice alumni exiting on their own
+DEFAULT_POLL_INTERVAL_S = 60
+
+# Don't spin if a reaped alumnus takes a moment to disappear
+MIN_WAKEUP_INTERVAL_S = 1.0
+
 HAPROXY_SYNAPSE_PIDFILE = '/var/run/synapse/haproxy.pid'
 
+HAPROXY_SYNAPSE_PROCESS_NAME = 'haproxy-synapse'
+
+# Name of the proxy configured by the command line flags when there is no
+# --config, and of the proxy owning a state file from older versions
+DEFAULT_PROXY_NAME = 'haproxy-synapse'
+
+PROC_ROOT = '/proc'
+
+# The kernel truncates /proc/<pid>/comm to TASK_COMM_LEN - 1 characters
+TASK_COMM_LEN = 16
+
+SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# In drain mode, how long before the reap deadline busy alumni are asked
+# to shut down gracefully
+DEFAULT_DRAIN_GRACE_S = 5 * 60
+
+# Columns of /proc/net/unix: a SOCK_STREAM socket in state SS_CONNECTED
+UNIX_SOCK_STREAM = '0001'
+UNIX_SS_CONNECTED = '03'
+
 LOG_FORMAT = '%(levelname)s %(message)s'
 
 log = logging.getLogger()
 
 
+class _AlumnusStateBase(TypedDict):
+    # Used to detect pid reuse
+    create_time: float
+    # When the process stopped being the main instance
+    alumnus_since: float
+
+
+class AlumnusState(_AlumnusStateBase, total=False):
+    # When we sent the soft shutdown signal in drain mode
+    soft_stop_at: float
+
+
+AlumniState = Dict[int, AlumnusState]
+
+# Alumni of every proxy, keyed by proxy name
+ReaperState = Dict[str, AlumniState]
+
+
+DrainPolicy = NamedTuple('DrainPolicy', [
+    # Alumni with at most this many open connections are reaped right away
+    ('idle_connections', int),
+    # Busy alumni get the soft signal this many seconds before they are due
+    ('grace', int),
+    # None for proxies whose reload already soft stops the alumni, like
+    # haproxy -sf (USR1) or synapse_reload_nginx (QUIT)
+    ('soft_signal', Optional[int]),
+])
+
+
+ProxyConfig = NamedTuple('ProxyConfig', [
+    ('name', str),
+    ('pidfile', str),
+    ('process_name', str),
+    ('username', str),
+    ('reap_age', int),
+    ('max_procs', int),
+    ('max_alumni_rss', Optional[int]),
+    ('drain', Optional[DrainPolicy]),
+    # Kill the alumnus' children (nginx workers) along with it
+    ('kill_children', bool),
+    # Tells apart shards sharing a process name
+    ('cmdline_contains', Optional[str]),
+])
+
+
+class ProxyConfigDict(TypedDict, total=False):
+    """One entry of the "proxies" list in the --config file
+
+    Only name, pidfile and process_name are required; everything else
+    defaults to the corresponding command line flag.
+    """
+    name: str
+    pidfile: str
+    process_name: str
+    username: str
+    reap_age: int
+    max_procs: int
+    max_alumni_rss: str
+    drain: bool
+    idle_connections: int
+    drain_grace: int
+    soft_signal: str
+    kill_children: bool
+    cmdline_contains: str
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default=None,
+                        help='JSON file listing the proxies to reap, as '
+                             '{"proxies": [{"name": ..., "pidfile": ..., '
+                             '"process_name": ..., ...}]}. The other flags '
+                             'provide the defaults (default: haproxy-synapse '
+                             'only).')
+    parser.add_argument('-s', '--state-file', default=DEFAULT_STATE_FILE,
+                        help='State file (default: %(default)s).')
     parser.add_argument('-d', '--state-dir', default=DEFAULT_STATE_DIR,
-                        help='State directory (default: %(default)s).')
+                        help='Legacy state directory; its pidfiles are imported '
+                             'into the state file and removed (default: %(default)s).')
     parser.add_argument('-r', '--reap-age', type=int, default=DEFAULT_REAP_AGE_S,
                         help='Reap age (default: %(default)s).')
     parser.add_argument('-p', '--max-procs', type=int, default=DEFAULT_MAX_PROCS,
                         help='Maximum processes (default: %(default)s).')
+    parser.add_argument('-m', '--max-alumni-rss', type=parse_size, default=None,
+                        help='Memory budget for all alumni together, e.g. 2G. '
+                             'The oldest alumni are reaped until the rest fit '
+                             '(default: no budget).')
+    parser.add_argument('--drain', action='store_true',
+                        help='Reap idle alumni immediately and ask busy ones to '
+                             'shut down gracefully before killing them.')
+    parser.add_argument('--idle-connections', type=int, default=0,
+                        help='In drain mode, alumni with at most this many open '
+                             'connections are idle (default: %(default)s).')
+    parser.add_argument('--drain-grace', type=int, default=DEFAULT_DRAIN_GRACE_S,
+                        help='In drain mode, seconds between the soft signal and '
+                             'the kill (default: %(default)s).')
+    parser.add_argument('--soft-signal', type=parse_signal, default=None,
+                        help='In drain mode, signal asking an alumnus to shut '
+                             'down gracefully (default: none, since reloading '
+                             'haproxy with -sf already sent it USR1).')
     parser.add_argument('-u', '--username', default=DEFAULT_USERNAME,
                         help='Username that haproxy-synapse runs under (default: %(default)s).')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and react to reloads as they happen.')
+    parser.add_argument('--poll-interval', type=int, default=DEFAULT_POLL_INTERVAL_S,
+                        help='Daemon mode rescan interval (default: %(default)s).')
     return parser.parse_args()
 
 
-def get_main_pid() -> int:
-    with open(HAPROXY_SYNAPSE_PIDFILE) as fh:
+def parse_size(
+    value: str,
+) -> int:
+    """Parses a byte count with an optional K, M or G suffix"""
+    value = value.strip().upper().rstrip('B')
+    suffix = value[-1:] if value[-1:] in SIZE_SUFFIXES else ''
+    try:
+        return int(float(value[:len(value) - len(suffix)]) * SIZE_SUFFIXES[suffix])
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid size: %s' % value)
+
+
+def parse_signal(
+    value: str,
+) -> int:
+    name = value.upper()
+    if not name.startswith('SIG'):
+        name = 'SIG' + name
+    try:
+        return int(getattr(signal, name))
+    except AttributeError:
+        raise argparse.ArgumentTypeError('Invalid signal: %s' % value)
+
+
+def get_drain_policy(
+    args: argparse.Namespace,
+) -> Optional[DrainPolicy]:
+    if not args.drain:
+        return None
+    return DrainPolicy(
+        idle_connections=args.idle_connections,
+        grace=args.drain_grace,
+        soft_signal=args.soft_signal,
+    )
+
+
+def get_default_proxy(
+    args: argparse.Namespace,
+) -> ProxyConfig:
+    return ProxyConfig(
+        name=DEFAULT_PROXY_NAME,
+        pidfile=HAPROXY_SYNAPSE_PIDFILE,
+        process_name=HAPROXY_SYNAPSE_PROCESS_NAME,
+        username=args.username,
+        reap_age=args.reap_age,
+        max_procs=args.max_procs,
+        max_alumni_rss=args.max_alumni_rss,
+        drain=get_drain_policy(args),
+        kill_children=False,
+        cmdline_contains=None,
+    )
+
+
+def parse_proxy_config(
+    raw: ProxyConfigDict,
+    args: argparse.Namespace,
+) -> ProxyConfig:
+    """Builds a proxy's policy, falling back to the command line flags"""
+    for key in ('name', 'pidfile', 'process_name'):
+        if key not in raw:
+            raise ValueError('Proxy config %r is missing %r' % (raw, key))
+
+    max_alumni_rss = args.max_alumni_rss
+    if 'max_alumni_rss' in raw:
+        max_alumni_rss = parse_size(str(raw['max_alumni_rss']))
+
+    drain = None
+    if raw.get('drain', args.drain):
+        drain = DrainPolicy(
+            idle_connections=raw.get('idle_connections', args.idle_connections),
+            grace=raw.get('drain_grace', args.drain_grace),
+            soft_signal=(
+                parse_signal(raw['soft_signal']) if 'soft_signal' in raw
+                else args.soft_signal
+            ),
+        )
+
+    return ProxyConfig(
+        name=raw['name'],
+        pidfile=raw['pidfile'],
+        process_name=raw['process_name'],
+        username=raw.get('username', args.username),
+        reap_age=raw.get('reap_age', args.reap_age),
+        max_procs=raw.get('max_procs', args.max_procs),
+        max_alumni_rss=max_alumni_rss,
+        drain=drain,
+        kill_children=raw.get('kill_children', False),
+        cmdline_contains=raw.get('cmdline_contains'),
+    )
+
+
+def get_proxies(
+    args: argparse.Namespace,
+) -> List[ProxyConfig]:
+    if args.config is None:
+        return [get_default_proxy(args)]
+
+    with open(args.config) as fh:
+        raw = json.load(fh)
+    proxies = [parse_proxy_config(entry, args) for entry in raw['proxies']]
+
+    names = [proxy.name for proxy in proxies]
+    if len(set(names)) != len(names):
+        raise ValueError('Proxy names must be unique: %s' % ', '.join(names))
+    return proxies
+
+
+def format_size(
+    size: int,
+) -> str:
+    return '%.1fMiB' % (size / SIZE_SUFFIXES['M'])
+
+
+def get_process_memory(
+    proc: psutil.Process,
+    proc_root: str = PROC_ROOT,
+) -> int:
+    """Returns the memory attributable to a process, in bytes
+
+    We prefer PSS from smaps_rollup (Linux >= 4.14), which splits shared
+    pages fairly between the processes mapping them; reading it is cheap,
+    unlike the full smaps. Otherwise we fall back to RSS.
+    """
+    try:
+        with open(os.path.join(proc_root, str(proc.pid), 'smaps_rollup')) as fh:
+            for line in fh:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return proc.memory_info().rss
+
+
+def count_connections(
+    proc: psutil.Process,
+    proc_root: str = PROC_ROOT,
+) -> int:
+    """Counts the connections an alumnus still carries
+
+    That is every established TCP connection, and every unix stream
+    connection it accepted (nginx hands us clients over unix sockets).
+    """
+    tcp = [
+        conn for conn in proc.connections(kind='tcp')
+        if conn.status == psutil.CONN_ESTABLISHED
+    ]
+    return len(tcp) + count_unix_connections(proc.pid, proc_root)
+
+
+def count_unix_connections(
+    pid: int,
+    proc_root: str = PROC_ROOT,
+) -> int:
+    """Counts the unix stream connections a process accepted
+
+    psutil doesn't tell the state of unix sockets, so we look the sockets
+    /proc/<pid>/fd points at up in /proc/<pid>/net/unix (that of the
+    process' network namespace).  Accepted connections carry the path of
+    the socket they came in on, unlike the socketpairs between nginx
+    masters and their workers, and datagram sockets, like a unix log
+    target, never connect.
+    """
+    fd_dir = os.path.join(proc_root, str(pid), 'fd')
+    inodes = set()
+    try:
+        fds = os.listdir(fd_dir)
+    except OSError as e:
+        if e.errno in (errno.EACCES, errno.EPERM):
+            raise psutil.AccessDenied(pid)
+        raise psutil.NoSuchProcess(pid)
+    for fd in fds:
+        try:
+            target = os.readlink(os.path.join(fd_dir, fd))
+        except OSError:
+            # Closed while we were looking
+            continue
+        if target.startswith('socket:['):
+            inodes.add(target[len('socket:['):-1])
+
+    count = 0
+    try:
+        with open(os.path.join(proc_root, str(pid), 'net', 'unix')) as fh:
+            next(fh, None)
+            for line in fh:
+                # Num RefCount Protocol Flags Type St Inode Path
+                fields = line.split()
+                if (
+                    len(fields) >= 8 and fields[6] in inodes and
+                    fields[4] == UNIX_SOCK_STREAM and fields[5] == UNIX_SS_CONNECTED
+                ):
+                    count += 1
+    except (IOError, OSError):
+        raise psutil.NoSuchProcess(pid)
+    return count
+
+
+def get_family(
+    proc: psutil.Process,
+    kill_children: bool,
+    spare_pids: FrozenSet[int] = frozenset(),
+) -> List[psutil.Process]:
+    """Returns the alumnus together with the children that go down with it
+
+    While nginx upgrades, the new master is a child of the old one, so the
+    main instance and the other alumni (`spare_pids`) are never part of it.
+    """
+    if not kill_children:
+        return [proc]
+    try:
+        children = proc.children()
+    except psutil.NoSuchProcess:
+        children = []
+    return [proc] + [child for child in children if child.pid not in spare_pids]
+
+
+def kill_process(
+    proc: psutil.Process,
+    kill_children: bool = False,
+    spare_pids: FrozenSet[int] = frozenset(),
+) -> None:
+    """Kills an alumnus, children first so the master can't respawn them"""
+    family = get_family(proc, kill_children, spare_pids)
+    for child in family[1:]:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+    proc.kill()
+
+
+def get_main_pid(
+    pidfile: str = HAPROXY_SYNAPSE_PIDFILE,
+) -> int:
+    with open(pidfile) as fh:
         return int(fh.readline().strip())
 
 
+def find_pids_by_name(
+    name: str,
+    uid: int,
+    proc_root: str = PROC_ROOT,
+) -> Iterator[int]:
+    """Finds processes called `name` whose real uid is `uid`
+
+    This only reads /proc/<pid>/comm for every process on the box (and
+    the status of the ones that match), which is much cheaper than
+    building a psutil.Process and asking it for its name and username.
+    The kernel truncates comm, so with a name that long the full one is
+    confirmed from the command line.
+    """
+    comm = name[:TASK_COMM_LEN - 1]
+    truncated = len(name) >= TASK_COMM_LEN - 1
+    for entry in os.listdir(proc_root):
+        if not entry.isdigit():
+            continue
+
+        proc_dir = os.path.join(proc_root, entry)
+        try:
+            with open(os.path.join(proc_dir, 'comm')) as fh:
+                if fh.read().rstrip('\n') != comm:
+                    continue
+            if get_real_uid(proc_dir) != uid:
+                continue
+            if truncated and get_full_name(proc_dir) != name:
+                continue
+        except (IOError, OSError):
+            # The process went away while we were looking at it
+            continue
+
+        yield int(entry)
+
+
+def get_real_uid(
+    proc_dir: str,
+) -> int:
+    """The real uid of a process, like psutil's username() uses
+
+    The owner of /proc/<pid> is the effective uid instead, or root once the
+    process drops privileges or otherwise becomes non-dumpable.
+    """
+    with open(os.path.join(proc_dir, 'status')) as fh:
+        for line in fh:
+            if line.startswith('Uid:'):
+                return int(line.split()[1])
+    raise IOError('No Uid in %s/status' % proc_dir)
+
+
+def get_full_name(
+    proc_dir: str,
+) -> str:
+    """The untruncated name of a process: its argv[0], or failing that the
+    executable it runs
+    """
+    with open(os.path.join(proc_dir, 'cmdline')) as fh:
+        argv0 = fh.read().split('\0')[0]
+    if argv0:
+        return os.path.basename(argv0)
+    # Kernel threads have no command line
+    return os.path.basename(os.readlink(os.path.join(proc_dir, 'exe')))
+
+
+def cmdline_contains(
+    pid: int,
+    needle: str,
+    proc_root: str = PROC_ROOT,
+) -> bool:
+    try:
+        with open(os.path.join(proc_root, str(pid), 'cmdline')) as fh:
+            return needle in fh.read().replace('\0', ' ')
+    except (IOError, OSError):
+        return False
+
+
 def get_alumni(
-    username: str,
+    proxy: ProxyConfig,
+    main_pid: int,
+    proc_root: str = PROC_ROOT,
 ) -> Iterator[psutil.Process]:
-    main_pid = get_main_pid()
-
-    for proc in psutil.process_iter():
-        if proc.name() != 'haproxy-synapse':
+    uid = pwd.getpwnam(proxy.username).pw_uid
+
+    pids: FrozenSet[int] = frozenset(
+        pid for pid in find_pids_by_name(proxy.process_name, uid, proc_root)
+        if proxy.cmdline_contains is None or
+        cmdline_contains(pid, proxy.cmdline_contains, proc_root)
+    )
+    procs = {}
+    ppids = {}
+    for pid in pids:
+        try:
+            procs[pid] = psutil.Process(pid)
+            ppids[pid] = procs[pid].ppid()
+        except psutil.NoSuchProcess:
             continue
 
-        if proc.username() != username:
+    parents = frozenset(ppids.values())
+    for pid, proc in procs.items():
+        if pid == main_pid:
+            continue
+        # Workers belong to whichever master they were forked from.  A
+        # master forked from an older one (nginx upgrades) is told apart
+        # by having children of its own.
+        if ppids[pid] in pids and pid not in parents:
             continue
+        yield proc
+
+
+def parse_alumni_state(
+    raw: Dict[str, Dict[str, float]],
+) -> AlumniState:
+    state: AlumniState = {}
+    for pid, entry in raw.items():
+        state[int(pid)] = {
+            'create_time': float(entry['create_time']),
+            'alumnus_since': float(entry['alumnus_since']),
+        }
+        if 'soft_stop_at' in entry:
+            state[int(pid)]['soft_stop_at'] = float(entry['soft_stop_at'])
+    return state
+
+
+def load_state(
+    state_file: str,
+) -> ReaperState:
+    try:
+        with open(state_file) as fh:
+            proxies = json.load(fh)['proxies']
+    except (IOError, ValueError, KeyError, TypeError) as e:
+        if not (isinstance(e, IOError) and e.errno == errno.ENOENT):
+            log.warning('Ignoring unreadable state file %s: %s', state_file, e)
+        return {}
+
+    return {
+        name: parse_alumni_state(alumni)
+        for name, alumni in proxies.items()
+    }
+
+
+def save_state(
+    state_file: str,
+    state: ReaperState,
+) -> None:
+    """Atomically replaces the state file"""
+    state_dir = os.path.dirname(os.path.abspath(state_file))
+    with tempfile.NamedTemporaryFile(
+        'w', dir=state_dir, prefix='.alumni', delete=False,
+    ) as fh:
+        json.dump({
+            'proxies': {
+                name: {str(pid): entry for pid, entry in alumni.items()}
+                for name, alumni in state.items()
+            },
+        }, fh, sort_keys=True)
+    os.rename(fh.name, state_file)
+
+
+def import_legacy_state_dir(
+    state_dir: str,
+    state: AlumniState,
+) -> None:
+    """Imports the ctimes of pidfiles written by older versions of the reaper"""
+    if not os.path.isdir(state_dir):
+        return
+
+    for pidfile in os.listdir(state_dir):
+        path = os.path.join(state_dir, pidfile)
+        try:
+            pid = int(pidfile)
+            proc = psutil.Process(pid)
+            state.setdefault(pid, {
+                'create_time': proc.create_time(),
+                'alumnus_since': os.path.getctime(path),
+            })
+        except (ValueError, psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+        os.remove(path)
+
+    try:
+        os.rmdir(state_dir)
+    except OSError:
+        pass
 
-        if proc.pid == main_pid:
+
+def record_alumni(
+    alumni: Iterable[psutil.Process],
+    state: AlumniState,
+    now: float,
+) -> None:
+    for proc in alumni:
+        entry = state.get(proc.pid)
+        if entry is not None and entry['create_time'] == proc.create_time():
             continue
 
-        yield proc
+        log.info('Recording new alumnus: %d', proc.pid)
+        state[proc.pid] = {
+            'create_time': proc.create_time(),
+            'alumnus_since': now,
+        }
 
 
 def kill_alumni(
     alumni: Iterable[psutil.Process],
-    state_dir: str,
+    state: AlumniState,
     reap_age: int,
     max_procs: int,
+    now: Optional[float] = None,
+    max_alumni_rss: Optional[int] = None,
+    drain: Optional[DrainPolicy] = None,
+    kill_children: bool = False,
+    spare_pids: FrozenSet[int] = frozenset(),
 ) -> int:
+    if now is None:
+        now = time.time()
     reap_count = 0
+    survivors = []
+
+    record_alumni(alumni, state, now)
 
     # Sort by oldest process creation time (= youngest) first
     alumni = sorted(
@@ -97,47 +675,318 @@ def kill_alumni(
         reverse=True)
 
     for index, proc in enumerate(alumni):
-        pidfile = os.path.join(state_dir, str(proc.pid))
-
-        # Create pidfile if necessary
-        if not os.path.exists(pidfile):
-            log.info('Creating pidfile for new alumnus: %d', proc.pid)
-            open(pidfile, 'w').close()
-
-        age = time.time() - os.path.getctime(pidfile)
-        if age < reap_age and index < max_procs:
-            continue
+        entry = state[proc.pid]
+        age = now - entry['alumnus_since']
+
+        if drain is None:
+            if age < reap_age and index < max_procs:
+                survivors.append(proc)
+                continue
+        else:
+            try:
+                # nginx masters carry no sessions themselves, their workers do
+                connections = sum(
+                    count_connections(member)
+                    for member in get_family(proc, kill_children, spare_pids)
+                )
+            except psutil.NoSuchProcess:
+                continue
+            except psutil.AccessDenied:
+                # Don't know, so treat it as busy
+                connections = drain.idle_connections + 1
+
+            if connections <= drain.idle_connections:
+                log.info('Process %d is idle with %d connections' %
+                         (proc.pid, connections))
+            elif not should_reap_busy_alumnus(
+                proc, entry, age, index, reap_age, max_procs, now, drain,
+            ):
+                survivors.append(proc)
+                continue
 
         # Teletubby bye bye
         log.info('Reaping process %d with age %ds and index %d' %
                  (proc.pid, age, index))
         try:
-            proc.kill()
+            kill_process(proc, kill_children, spare_pids)
             reap_count += 1
         except psutil.NoSuchProcess:
             log.warn('Process %d has disappeared' % proc.pid)
 
+    if max_alumni_rss is not None:
+        reap_count += kill_alumni_over_budget(
+            survivors, max_alumni_rss, kill_children, spare_pids)
+
     return reap_count
 
 
-def remove_stale_alumni_pidfiles(
+def should_reap_busy_alumnus(
+    proc: psutil.Process,
+    entry: AlumnusState,
+    age: float,
+    index: int,
+    reap_age: int,
+    max_procs: int,
+    now: float,
+    drain: DrainPolicy,
+) -> bool:
+    """Decides whether an alumnus with live sessions is killed yet
+
+    It first gets the soft signal, `drain.grace` seconds before its reap
+    deadline (or as soon as there are too many alumni), and is only killed
+    once the deadline, or the grace period after an early soft stop, passes.
+    """
+    if 'soft_stop_at' in entry:
+        deadline = max(
+            entry['alumnus_since'] + reap_age,
+            entry['soft_stop_at'] + drain.grace,
+        )
+        if index >= max_procs:
+            deadline = entry['soft_stop_at'] + drain.grace
+        return now >= deadline
+
+    if drain.soft_signal is None:
+        # Its reload already soft stopped it, so just honour the deadline
+        return age >= reap_age or index >= max_procs
+
+    if age < reap_age - drain.grace and index < max_procs:
+        return False
+
+    log.info('Asking process %d with age %ds and index %d to shut down' %
+             (proc.pid, age, index))
+    try:
+        proc.send_signal(drain.soft_signal)
+    except psutil.NoSuchProcess:
+        return False
+    entry['soft_stop_at'] = now
+    return False
+
+
+def kill_alumni_over_budget(
     alumni: Iterable[psutil.Process],
-    state_dir: str,
+    max_alumni_rss: int,
+    kill_children: bool = False,
+    spare_pids: FrozenSet[int] = frozenset(),
+) -> int:
+    """Kills the oldest alumni until the rest fit in max_alumni_rss bytes"""
+    reap_count = 0
+    usage: List[Tuple[psutil.Process, int]] = []
+    for proc in sorted(alumni, key=operator.methodcaller('create_time')):
+        try:
+            usage.append((proc, sum(
+                get_process_memory(member)
+                for member in get_family(proc, kill_children, spare_pids)
+            )))
+        except psutil.NoSuchProcess:
+            continue
+
+    total = sum(memory for _, memory in usage)
+    log.info('Alumni use %s of a %s budget' % (
+        format_size(total), format_size(max_alumni_rss)))
+
+    for proc, memory in usage:
+        if total <= max_alumni_rss:
+            break
+
+        log.info('Reaping process %d to reclaim %s' % (
+            proc.pid, format_size(memory)))
+        try:
+            kill_process(proc, kill_children, spare_pids)
+            reap_count += 1
+        except psutil.NoSuchProcess:
+            log.warn('Process %d has disappeared' % proc.pid)
+        total -= memory
+
+    return reap_count
+
+
+def remove_stale_alumni(
+    alumni: Iterable[psutil.Process],
+    state: AlumniState,
 ) -> None:
     alumni_pids = [proc.pid for proc in alumni]
 
-    for pidfile in os.listdir(state_dir):
-        try:
-            pid = int(pidfile)
-        except ValueError:
-            log.warn('Ignoring invalid filename: %s' % pidfile)
+    for pid in list(state):
+        if pid in alumni_pids:
             continue
 
-        if pid in alumni_pids:
+        log.info('Forgetting stale alumnus %d', pid)
+        del state[pid]
+
+
+def next_reap_delay(
+    state: AlumniState,
+    reap_age: int,
+    now: float,
+    drain_grace: Optional[int] = None,
+    max_procs: Optional[int] = None,
+) -> Optional[float]:
+    """Seconds until we next need to signal or kill a known alumnus"""
+    if not state:
+        return None
+
+    # Indexed like kill_alumni does, youngest first
+    entries = sorted(
+        state.values(),
+        key=operator.itemgetter('create_time'),
+        reverse=True)
+
+    due = []
+    for index, entry in enumerate(entries):
+        deadline = entry['alumnus_since'] + reap_age
+        if drain_grace is not None:
+            if 'soft_stop_at' in entry:
+                deadline = max(deadline, entry['soft_stop_at'] + drain_grace)
+                if max_procs is not None and index >= max_procs:
+                    # One too many only gets its grace period
+                    deadline = entry['soft_stop_at'] + drain_grace
+            else:
+                deadline -= drain_grace
+        due.append(deadline)
+    return max(0.0, min(due) - now)
+
+
+def reap_proxy(
+    proxy: ProxyConfig,
+    state: AlumniState,
+) -> int:
+    try:
+        main_pid = get_main_pid(proxy.pidfile)
+    except (IOError, ValueError) as e:
+        # Without a main instance we can't tell alumni apart, so leave them
+        # (and what we know about them) alone until it comes back
+        log.warning('Skipping %s: cannot read %s: %s' % (
+            proxy.name, proxy.pidfile, e))
+        return 0
+
+    alumni = list(get_alumni(proxy, main_pid))
+    if proxy.max_alumni_rss is not None:
+        try:
+            main_proc = psutil.Process(main_pid)
+            log.info('Main %s process %d uses %s' % (
+                proxy.name, main_proc.pid,
+                format_size(get_process_memory(main_proc))))
+        except psutil.NoSuchProcess:
+            pass
+    spare_pids = frozenset([main_pid] + [proc.pid for proc in alumni])
+    reap_count = kill_alumni(
+        alumni, state, proxy.reap_age, proxy.max_procs,
+        max_alumni_rss=proxy.max_alumni_rss,
+        drain=proxy.drain,
+        kill_children=proxy.kill_children,
+        spare_pids=spare_pids,
+    )
+    remove_stale_alumni(alumni, state)
+    return reap_count
+
+
+def reap(
+    args: argparse.Namespace,
+    proxies: List[ProxyConfig],
+    state: ReaperState,
+) -> int:
+    reap_count = 0
+    for proxy in proxies:
+        reap_count += reap_proxy(proxy, state.setdefault(proxy.name, {}))
+
+    # Forget about proxies that are no longer configured
+    names = {proxy.name for proxy in proxies}
+    for name in list(state):
+        if name not in names:
+            del state[name]
+
+    save_state(args.state_file, state)
+    return reap_count
+
+
+def next_wakeup_delay(
+    proxies: List[ProxyConfig],
+    state: ReaperState,
+    now: float,
+) -> Optional[float]:
+    delays = []
+    for proxy in proxies:
+        delay = next_reap_delay(
+            state.get(proxy.name, {}), proxy.reap_age, now,
+            drain_grace=(
+                proxy.drain.grace
+                if proxy.drain and proxy.drain.soft_signal is not None else None
+            ),
+            max_procs=proxy.max_procs,
+        )
+        if delay is not None:
+            delays.append(delay)
+    return min(delays) if delays else None
+
+
+def get_nearest_existing_dir(
+    path: str,
+) -> str:
+    while not os.path.isdir(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def watch_pidfile_dirs(
+    inotify: Inotify,
+    pidfile_dirs: Iterable[str],
+    watched_dirs: Dict[int, str],
+) -> None:
+    """Watches the directories of the proxies' pidfiles for replaced files
+
+    Watches the directories rather than the files, since the pidfiles may
+    be replaced rather than rewritten.  A proxy that hasn't started yet may
+    not have created its directory either, which isn't ours to create, so
+    until it does its nearest existing parent is watched instead; that
+    tells us when to call this again.
+
+    :param watched_dirs: the watched directories by watch descriptor,
+        updated in place
+    """
+    for pidfile_dir in pidfile_dirs:
+        if pidfile_dir in watched_dirs.values():
             continue
+        watch_dir = get_nearest_existing_dir(pidfile_dir)
+        if watch_dir not in watched_dirs.values():
+            watched_dirs[inotify.add_watch(watch_dir, IN_FILE_REPLACED)] = watch_dir
+
 
-        log.info('Removing stale pidfile for %d', pid)
-        os.remove(os.path.join(state_dir, pidfile))
+def run_daemon(
+    args: argparse.Namespace,
+    proxies: List[ProxyConfig],
+    state: ReaperState,
+) -> None:
+    pidfile_names: Dict[str, Dict[str, str]] = {}
+    for proxy in proxies:
+        pidfile_dir, pidfile_name = os.path.split(os.path.abspath(proxy.pidfile))
+        pidfile_names.setdefault(pidfile_dir, {})[pidfile_name] = proxy.name
+
+    watched_dirs: Dict[int, str] = {}
+    with Inotify() as inotify:
+        while True:
+            # Whatever goes wrong, e.g. a user that doesn't exist yet or a
+            # process we may not kill, may be fixed by the next pass
+            try:
+                watch_pidfile_dirs(inotify, pidfile_names, watched_dirs)
+                reap_count = reap(args, proxies, state)
+                if reap_count:
+                    log.info('Reaped %d processes' % reap_count)
+            except Exception:
+                log.exception('Reaping failed')
+
+            timeout = float(args.poll_interval)
+            delay = next_wakeup_delay(proxies, state, time.time())
+            if delay is not None:
+                timeout = min(timeout, max(delay, MIN_WAKEUP_INTERVAL_S))
+
+            # Whatever woke us up, the next reap() records any new alumni at
+            # the current time, which for a reload is the moment the
+            # pidfile was rewritten
+            for event in inotify.read_events(timeout):
+                watched_dir = watched_dirs.get(event.wd, '')
+                name = pidfile_names.get(watched_dir, {}).get(event.name)
+                if name is not None:
+                    log.info('Detected %s reload' % name)
 
 
 def ensure_path_exists(
@@ -154,11 +1003,17 @@ def main() -> None:
     logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 
     args = parse_args()
-    ensure_path_exists(args.state_dir)
-    alumni = list(get_alumni(args.username))
-    reap_count = kill_alumni(
-        alumni, args.state_dir, args.reap_age, args.max_procs)
-    remove_stale_alumni_pidfiles(alumni, args.state_dir)
+    proxies = get_proxies(args)
+    ensure_path_exists(os.path.dirname(os.path.abspath(args.state_file)))
+    state = load_state(args.state_file)
+    import_legacy_state_dir(
+        args.state_dir, state.setdefault(DEFAULT_PROXY_NAME, {}))
+
+    if args.daemon:
+        run_daemon(args, proxies, state)
+        return
+
+    reap_count = reap(args, proxies, state)
 
     log.info('Reaped %d processes' % reap_count)
 
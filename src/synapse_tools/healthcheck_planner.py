@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""Estimates how many healthchecks per second each server of a service gets
+from a fleet of hosts running the same Synapse config.
+
+Every backend checks each of its servers once per `inter`, so a server
+taking traffic for a service gets
+
+    clients * backends of the service / inter
+
+checks per second, where a service has a backend per advertise type and
+endpoint timeout override it discovers.  While a server is failing user
+traffic it is checked every `fastinter` instead, and while it is down
+every `downinter`; the planner prints those rates too, as if every client
+saw it failing at once.
+"""
+import argparse
+import os
+import re
+import sys
+from typing import cast
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from synapse_tools.capacity_planner import load_synapse_config
+from synapse_tools.configure_synapse import BaseConfig
+from synapse_tools.configure_synapse import DiscoveryDictZookeeper
+from synapse_tools.configure_synapse import ServiceConfig
+
+
+# HAProxy's own default for inter; fastinter and downinter default to inter
+DEFAULT_INTER_S = 2.0
+
+CHECK_INTERVAL_OPTIONS = ('inter', 'fastinter', 'downinter')
+
+HAPROXY_TIME_RE = re.compile(r'^(?P<value>\d+)(?P<unit>us|ms|s|m|h|d)?$')
+
+# HAProxy takes times without a unit as milliseconds
+HAPROXY_TIME_UNITS_S = {
+    None: 0.001, 'us': 0.000001, 'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400,
+}
+
+
+CheckLoad = NamedTuple('CheckLoad', [
+    ('service', str),
+    ('backends', int),
+    # Checks per second each client sends each server of the service
+    ('inter_rate', float),
+    ('fastinter_rate', float),
+    ('downinter_rate', float),
+])
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--synapse-config', default=None,
+                        help='Synapse JSON config to plan for (default: generate '
+                             'it like configure_synapse would).')
+    parser.add_argument('--clients', type=int, required=True,
+                        help='Hosts running this config, which all check the '
+                             'same servers.')
+    parser.add_argument('--max-qps', type=float, default=None,
+                        help='Exit non-zero if any server gets more checks per '
+                             'second than this at its regular inter.')
+    return parser.parse_args()
+
+
+def parse_haproxy_time(
+    value: str,
+) -> float:
+    """Returns an HAProxy time, like 10m or 500, in seconds"""
+    match = HAPROXY_TIME_RE.match(value)
+    if not match:
+        raise ValueError('Invalid HAProxy time: %s' % value)
+    return int(match.group('value')) * HAPROXY_TIME_UNITS_S[match.group('unit')]
+
+
+def check_intervals(
+    server_options: str,
+) -> Dict[str, float]:
+    """The check intervals set on a server or default-server line"""
+    intervals = {}
+    tokens = server_options.split()
+    for previous, option, value in zip([''] + tokens, tokens, tokens[1:]):
+        # `on-error fastinter` names the interval rather than setting it
+        if option in CHECK_INTERVAL_OPTIONS and previous != 'on-error':
+            intervals[option] = parse_haproxy_time(value)
+    return intervals
+
+
+def default_check_intervals(
+    config: BaseConfig,
+) -> Dict[str, float]:
+    for line in config['haproxy']['defaults']:
+        if line.startswith('default-server '):
+            return check_intervals(line)
+    return {}
+
+
+def service_name(
+    backend_name: str,
+    service: ServiceConfig,
+) -> str:
+    # Every backend of a service discovers the same path
+    path = cast(DiscoveryDictZookeeper, service.get('discovery', {})).get('path')
+    if path is None:
+        return backend_name
+    return os.path.basename(path)
+
+
+def check_loads(
+    config: BaseConfig,
+) -> List[CheckLoad]:
+    defaults = default_check_intervals(config)
+    loads: Dict[str, CheckLoad] = {}
+    for backend_name, service in sorted(config['services'].items()):
+        haproxy = service.get('haproxy', {})
+        if haproxy.get('disabled') or 'backend' not in haproxy:
+            continue
+        server_options = haproxy.get('server_options', '')
+        if 'check' not in server_options.split():
+            continue
+
+        intervals = dict(defaults)
+        intervals.update(check_intervals(server_options))
+        inter = intervals.get('inter', DEFAULT_INTER_S)
+
+        name = service_name(backend_name, service)
+        load = loads.get(name, CheckLoad(name, 0, 0.0, 0.0, 0.0))
+        loads[name] = CheckLoad(
+            service=name,
+            backends=load.backends + 1,
+            inter_rate=load.inter_rate + 1 / inter,
+            fastinter_rate=load.fastinter_rate + 1 / intervals.get('fastinter', inter),
+            downinter_rate=load.downinter_rate + 1 / intervals.get('downinter', inter),
+        )
+    return sorted(loads.values(), key=lambda load: (-load.inter_rate, load.service))
+
+
+def format_loads(
+    loads: Iterable[CheckLoad],
+    clients: int,
+) -> List[str]:
+    lines = ['%-40s %8s %12s %12s %12s' % (
+        'service', 'backends', 'inter qps', 'fastinter qps', 'downinter qps')]
+    for load in loads:
+        lines.append('%-40s %8d %12.2f %12.2f %12.2f' % (
+            load.service, load.backends, clients * load.inter_rate,
+            clients * load.fastinter_rate, clients * load.downinter_rate))
+    return lines
+
+
+def over_limit(
+    loads: Iterable[CheckLoad],
+    clients: int,
+    max_qps: Optional[float],
+) -> List[CheckLoad]:
+    if max_qps is None:
+        return []
+    return [load for load in loads if clients * load.inter_rate > max_qps]
+
+
+def main() -> None:
+    args = parse_args()
+    loads = check_loads(load_synapse_config(args.synapse_config))
+
+    for line in format_loads(loads, args.clients):
+        print(line)
+
+    too_many = over_limit(loads, args.clients, args.max_qps)
+    for load in too_many:
+        print('TOO MANY CHECKS: %s servers get %.2f checks per second' % (
+            load.service, args.clients * load.inter_rate))
+    sys.exit(1 if too_many else 0)
+
+
+if __name__ == '__main__':
+    main()
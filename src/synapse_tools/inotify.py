@@ -0,0 +1,106 @@
+"""Minimal ctypes wrapper around the Linux inotify API
+
+We only need to know when a handful of pidfiles get rewritten, which does
+not justify pulling in a third party inotify library.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+from types import TracebackType
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Type
+
+
+# See include/uapi/linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# Events that mean a file in a watched directory has new contents, whether
+# it was written in place or renamed over
+IN_FILE_REPLACED = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+InotifyEvent = NamedTuple('InotifyEvent', [
+    ('wd', int),
+    ('mask', int),
+    ('name', str),
+])
+
+
+class Inotify(object):
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(
+        self,
+        path: str,
+        mask: int,
+    ) -> int:
+        wd = self._add_watch(self.fd, path.encode(), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def read_events(
+        self,
+        timeout: Optional[float] = None,
+    ) -> List[InotifyEvent]:
+        """Waits up to `timeout` seconds (forever if None) for events"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].rstrip(b'\0').decode()
+            offset += length
+            events.append(InotifyEvent(wd, mask, name))
+        return events
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self) -> 'Inotify':
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
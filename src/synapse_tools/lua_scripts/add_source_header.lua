@@ -3,6 +3,20 @@ map_file = nil
 refresh_interval = nil
 map_disabled = false
 
+-- Bookkeeping reported by the map-debug summary
+map_entries = 0
+map_size_bytes = 0
+map_refreshes = 0
+last_refresh_ms = 0
+
+-- The map's keys in order, for stable map-debug paging, and the refresh
+-- they were sorted for
+sorted_keys = {}
+sorted_refresh = -1
+
+-- Number of entries the map-debug endpoint buffers before each send
+DEBUG_CHUNK_SIZE = 500
+
 -- Splits the given string on spaces
 function split(s)
   local result = {}
@@ -23,13 +37,59 @@ end
 function refresh_map()
   local f = io.open(map_file)
   local tmp_map = {}
+  local entries = 0
   if f ~= nil then
     for line in f:lines() do
       local parts = split(line)
+      if tmp_map[parts[1]] == nil then
+        entries = entries + 1
+      end
       tmp_map[parts[1]] = parts[2]
     end
+    map_size_bytes = f:seek('end')
+    f:close()
     svc_map = tmp_map
+    map_entries = entries
+    map_refreshes = map_refreshes + 1
+  end
+end
+
+-- Wall clock time in milliseconds.  core.now() is the time HAProxy's event
+-- loop last woke up at, so it only moves across a yield.
+function now_ms()
+  local now = core.now()
+  return now.sec * 1000 + now.usec / 1000
+end
+
+-- Refreshes the map, and records how long that took: up to and including
+-- the next pass of the event loop, which refresh_map holds up
+function timed_refresh_map()
+  local started = now_ms()
+  refresh_map()
+  core.yield()
+  last_refresh_ms = now_ms() - started
+end
+
+-- Returns the keys of svc_map starting with prefix (if any), sorted
+function get_sorted_keys(prefix)
+  if sorted_refresh ~= map_refreshes then
+    sorted_keys = {}
+    for k in pairs(svc_map) do
+      sorted_keys[#sorted_keys + 1] = k
+    end
+    table.sort(sorted_keys)
+    sorted_refresh = map_refreshes
+  end
+  if prefix == nil then
+    return sorted_keys
   end
+  local keys = {}
+  for _, k in ipairs(sorted_keys) do
+    if string.sub(k, 1, #prefix) == prefix then
+      keys[#keys + 1] = k
+    end
+  end
+  return keys
 end
 
 function init_vars()
@@ -54,20 +114,70 @@ if map_disabled ~= true then
   -- to run every 5 seconds
   core.register_task(function()
     while true do
-      xpcall(refresh_map, log_error)
+      xpcall(timed_refresh_map, log_error)
       core.sleep(refresh_interval)
     end
   end)
 
   -- Debug endpoint for map file: this is config driven
   -- and is currently enabled for only itests
+  --
+  -- Supported query parameters:
+  --   summary=1     only report the entry count, the size of the map file,
+  --                 how often it was loaded and how long that last took
+  --   prefix=<str>  only return entries whose IP starts with <str>
+  --   offset=<n>    skip the first <n> matching entries
+  --   limit=<n>     return at most <n> matching entries
+  --
+  -- Entries come sorted by IP so pages line up across refreshes.
+  --
+  -- The body is streamed in chunks (no content-length, so haproxy uses
+  -- chunked transfer encoding) to avoid building it all in memory.
   core.register_service("map-debug", "http", function(applet)
-    local response = dump(svc_map)
+    local args = parse_qs(applet.qs)
     applet:set_status(200)
-    applet:add_header("content-length", string.len(response))
-    applet:add_header("content-type", "text/plain")
+    applet:add_header("content-type", "application/json")
     applet:start_response()
-    applet:send(response)
+
+    if args['summary'] == '1' then
+      applet:send(string.format(
+        '{"entries":%d,"size_bytes":%d,"refreshes":%d,"last_refresh_ms":%.3f,"map_file":"%s"}',
+        map_entries, map_size_bytes, map_refreshes, last_refresh_ms,
+        json_escape(map_file or '')
+      ))
+      return
+    end
+
+    local prefix = args['prefix']
+    -- keys[i] is nil for anything but a whole number of entries
+    local offset = math.max(0, math.floor(tonumber(args['offset']) or 0))
+    local limit = tonumber(args['limit'])
+    if limit ~= nil then
+      limit = math.max(0, math.floor(limit))
+    end
+    local keys = get_sorted_keys(prefix)
+    local map = svc_map
+    local buf = {}
+    local sent = 0
+    local sep = '{'
+    for i = offset + 1, #keys do
+      if limit ~= nil and sent >= limit then
+        break
+      end
+      local k = keys[i]
+      buf[#buf + 1] = sep .. '"' .. json_escape(k) .. '":"' .. json_escape(map[k]) .. '"'
+      sep = ','
+      sent = sent + 1
+      if #buf >= DEBUG_CHUNK_SIZE then
+        applet:send(table.concat(buf))
+        buf = {}
+      end
+    end
+    if sent == 0 then
+      buf[#buf + 1] = '{'
+    end
+    buf[#buf + 1] = '}'
+    applet:send(table.concat(buf))
   end)
 end
 
@@ -97,13 +207,23 @@ function add_source_header(txn)
 end
 core.register_action('add_source_header', {'http-req'}, add_source_header)
 
--- table to str in lua
--- not very generic, meant only for the map file (do no reuse)
-function dump(o)
-  local s = '{'
-  for k,v in pairs(o) do
-    if s ~= '{' then s = s .. ',' end
-    s = s .. '"'..k..'":"' .. v .. '"'
+-- Escapes backslashes and double quotes so map entries can be embedded
+-- in a JSON string
+function json_escape(s)
+  return (string.gsub(s, '[\\"]', '\\%0'))
+end
+
+-- Parses a query string into a table, e.g. 'a=1&b=2' -> {a='1', b='2'}
+function parse_qs(qs)
+  local args = {}
+  if qs == nil then
+    return args
+  end
+  for k, v in string.gmatch(qs, '([^&=]+)=([^&]*)') do
+    args[k] = string.gsub(v, '%%(%x%x)', function(h)
+      return string.char(tonumber(h, 16))
+    end)
   end
-  return s .. '}'
+  return args
 end
+
@@ -1,6 +1,14 @@
 -- Log where requests are sent from and to
 sample_rate = 0
 
+-- In aggregation mode we count (source, destination) pairs in memory and
+-- periodically flush one summary line per pair instead of logging every
+-- request.  Counting is cheap, so every request is counted regardless of
+-- sample_rate and the counts are exact.
+aggregate = false
+flush_interval = 60
+provenance_counts = {}
+
 -- Loads map into Lua script and sets sample rate
 function init_logging(txn)
 
@@ -24,8 +32,13 @@ core.register_action("init_logging", {"tcp-req","http-req"}, init_logging)
 -- Logs source and destination service of request
 function log_provenance(txn)
 
-  -- Don't log if map doesn't exist or sampled out
-  if (map == nil) or (sample_rate == 0) or (math.random() > sample_rate) then
+  -- Don't log if map doesn't exist or logging is off
+  if (map == nil) or (sample_rate == 0) then
+    return
+  end
+
+  -- Only individual lines are sampled
+  if (not aggregate) and (math.random() > sample_rate) then
     return
   end
 
@@ -41,8 +54,47 @@ function log_provenance(txn)
 
   -- Get destination service
   dest_svc = txn.f:be_name()
+
+  if aggregate then
+    local key = src_svc .. ' ' .. dest_svc
+    provenance_counts[key] = (provenance_counts[key] or 0) + 1
+    return
+  end
+
   local log_text = 'provenance ' .. src_svc .. ' ' .. dest_svc .. '\n'
   txn.Info(txn, log_text)
 end
 
-core.register_action("log_provenance", {"tcp-req","http-req"}, log_provenance)
\ No newline at end of file
+core.register_action("log_provenance", {"tcp-req","http-req"}, log_provenance)
+
+
+-- Emits one 'provenance_summary <src> <dst> <count> <interval>' line per
+-- pair seen since the last flush and resets the counters
+function flush_provenance()
+  local counts = provenance_counts
+  provenance_counts = {}
+  for key, count in pairs(counts) do
+    core.Info('provenance_summary ' .. key .. ' ' .. count .. ' ' .. flush_interval)
+  end
+end
+
+function init_aggregation()
+  aggregate = os.getenv('provenance_aggregate') == '1'
+  local interval = tonumber(os.getenv('provenance_flush_interval'))
+  if interval ~= nil and interval > 0 then
+    flush_interval = interval
+  end
+end
+
+-- The environment is only fully populated once haproxy has parsed the whole
+-- global section, so read the aggregation settings at init time
+core.register_init(init_aggregation)
+
+core.register_task(function()
+  while true do
+    core.sleep(flush_interval)
+    if aggregate then
+      flush_provenance()
+    end
+  end
+end)
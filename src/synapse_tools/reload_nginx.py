@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+"""Gracefully upgrades a running nginx to a new master, see
+http://nginx.org/en/docs/control.html#upgrade
+
+At the start there is the current master, whose pid is in the pidfile, and
+maybe the old master of the previous reload, whose pid is in
+`<pidfile>.oldbin`, still draining its connections.
+
+ 1. Stop the previous old master, if any (TERM, then KILL).  With
+    --keep-old-masters it is instead left for the reaper to bound.
+ 2. Send USR2 to the current master.  It renames the pidfile to
+    `.oldbin` and starts a new master, which writes its own pid.
+ 3. Send WINCH to the current master, which is now the old one, so its
+    workers stop accepting connections.
+ 4. Send QUIT to it so it exits once its workers are done.
+
+This replaces synapse-tools-reload-nginx.sh, which polled every 100ms for
+each step.  Here the pidfile is watched with inotify and exits are waited
+for on a pidfd, so each step finishes as soon as nginx is done with it.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import signal
+import sys
+import time
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+import psutil
+
+from synapse_tools.inotify import IN_FILE_REPLACED
+from synapse_tools.inotify import Inotify
+
+
+LOG_FORMAT = '%(levelname)s %(message)s'
+
+log = logging.getLogger()
+
+# Exit codes, the same as synapse-tools-reload-nginx.sh where it had one
+EXIT_OK = 0
+EXIT_NEW_MASTER_FAILED = 1
+EXIT_NO_MASTER = 2
+
+# How long the previous old master gets to exit after TERM, and after KILL
+DEFAULT_OLD_MASTER_TIMEOUT_S = 5.0
+KILL_TIMEOUT_S = 1.0
+
+# How long the new master gets to write its pid
+DEFAULT_NEW_MASTER_TIMEOUT_S = 5.0
+
+# pidfd_open(2), Linux >= 5.3; the syscall number is the same on every
+# architecture
+SYS_PIDFD_OPEN = 434
+
+# What nginx calls its master process, see ngx_master_process_cycle
+NGINX_MASTER_TITLE = 'nginx: master'
+
+
+PhaseTiming = NamedTuple('PhaseTiming', [
+    ('phase', str),
+    ('duration_s', float),
+])
+
+
+class ReloadError(Exception):
+    def __init__(
+        self,
+        phase: str,
+        exit_code: int,
+        message: str,
+    ) -> None:
+        super(ReloadError, self).__init__(message)
+        self.phase = phase
+        self.exit_code = exit_code
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pidfile', help='Pidfile of the running nginx master.')
+    parser.add_argument('--old-master-timeout', type=float,
+                        default=DEFAULT_OLD_MASTER_TIMEOUT_S,
+                        help='Seconds the old master of the previous reload gets '
+                             'to exit after TERM before it is killed '
+                             '(default: %(default)s).')
+    parser.add_argument('--new-master-timeout', type=float,
+                        default=DEFAULT_NEW_MASTER_TIMEOUT_S,
+                        help='Seconds the new master gets to write its pid '
+                             '(default: %(default)s).')
+    parser.add_argument('--keep-old-masters', action='store_true',
+                        help="Don't stop the old master of the previous reload; "
+                             'leave it to drain and to haproxy_synapse_reaper.')
+    return parser.parse_args()
+
+
+def read_pid(
+    pidfile: str,
+) -> Optional[int]:
+    try:
+        with open(pidfile) as fh:
+            return int(fh.readline().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def is_nginx_master(
+    pid: int,
+) -> bool:
+    try:
+        cmdline = ' '.join(psutil.Process(pid).cmdline())
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return False
+    return NGINX_MASTER_TITLE in cmdline
+
+
+def pidfd_open(
+    pid: int,
+) -> Optional[int]:
+    """Returns a pidfd for `pid`, or None where the kernel has none
+
+    Raises ProcessLookupError if the process is already gone.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.syscall(SYS_PIDFD_OPEN, pid, 0)
+    if fd >= 0:
+        return fd
+    err = ctypes.get_errno()
+    if err == errno.ESRCH:
+        raise ProcessLookupError(err, os.strerror(err))
+    return None
+
+
+def wait_for_exit(
+    pid: int,
+    timeout: float,
+) -> bool:
+    """Waits up to `timeout` seconds for `pid` to exit, which need not be
+    our child
+
+    Returns whether it did.
+    """
+    try:
+        fd = pidfd_open(pid)
+    except ProcessLookupError:
+        return True
+    if fd is None:
+        # psutil polls, but only on kernels too old for pidfds
+        try:
+            psutil.Process(pid).wait(timeout)
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.TimeoutExpired:
+            return False
+        return True
+    try:
+        readable, _, _ = select.select([fd], [], [], timeout)
+        return bool(readable)
+    finally:
+        os.close(fd)
+
+
+def wait_for_new_pid(
+    pidfile: str,
+    old_pid: int,
+    timeout: float,
+) -> Optional[int]:
+    """Waits up to `timeout` seconds for a pid other than `old_pid` to
+    show up in `pidfile`
+    """
+    deadline = time.monotonic() + timeout
+    pidfile_dir = os.path.dirname(os.path.abspath(pidfile))
+    with Inotify() as inotify:
+        inotify.add_watch(pidfile_dir, IN_FILE_REPLACED)
+        while True:
+            pid = read_pid(pidfile)
+            if pid is not None and pid != old_pid:
+                return pid
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            inotify.read_events(remaining)
+
+
+def signal_process(
+    pid: int,
+    signum: int,
+    group: bool = False,
+) -> bool:
+    """Returns False if the process is already gone"""
+    try:
+        if group:
+            os.killpg(pid, signum)
+        else:
+            os.kill(pid, signum)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def stop_previous_old_master(
+    oldbin_pidfile: str,
+    timeout: float,
+) -> None:
+    old_pid = read_pid(oldbin_pidfile)
+    if old_pid is None or not is_nginx_master(old_pid):
+        return
+
+    # Like `kill -TERM -pid`: the old master and its workers share a
+    # process group
+    log.info('Stopping previous old master %d' % old_pid)
+    if not signal_process(old_pid, signal.SIGTERM, group=True):
+        return
+    if wait_for_exit(old_pid, timeout):
+        return
+    log.warning('Previous old master %d is still running after %.1fs, killing it' % (
+        old_pid, timeout))
+    signal_process(old_pid, signal.SIGKILL, group=True)
+    wait_for_exit(old_pid, KILL_TIMEOUT_S)
+
+
+def start_new_master(
+    pidfile: str,
+    current_pid: int,
+    timeout: float,
+) -> int:
+    if not signal_process(current_pid, signal.SIGUSR2):
+        raise ReloadError(
+            'start_new_master', EXIT_NO_MASTER,
+            'Master %d exited before the reload' % current_pid)
+    new_pid = wait_for_new_pid(pidfile, current_pid, timeout)
+    if new_pid is None:
+        # Most likely an invalid config file
+        raise ReloadError(
+            'start_new_master', EXIT_NEW_MASTER_FAILED,
+            'No new master wrote %s within %.1fs' % (pidfile, timeout))
+    return new_pid
+
+
+def reload_nginx(
+    args: argparse.Namespace,
+    timings: List[PhaseTiming],
+) -> None:
+    """Runs the upgrade, appending how long each phase took to `timings`"""
+    pidfile = args.pidfile
+    oldbin_pidfile = pidfile + '.oldbin'
+
+    current_pid = read_pid(pidfile)
+    if current_pid is None:
+        raise ReloadError(
+            'read_pidfile', EXIT_NO_MASTER, 'Cannot read %s' % pidfile)
+
+    start = time.monotonic()
+    if not args.keep_old_masters:
+        stop_previous_old_master(oldbin_pidfile, args.old_master_timeout)
+    timings.append(PhaseTiming('stop_previous_old_master', time.monotonic() - start))
+
+    start = time.monotonic()
+    new_pid = start_new_master(pidfile, current_pid, args.new_master_timeout)
+    timings.append(PhaseTiming('start_new_master', time.monotonic() - start))
+    log.info('New master %d replaced %d' % (new_pid, current_pid))
+
+    # The current master is the old one now, with its pid in .oldbin.
+    # Both accept connections until its workers are told to shut down
+    # gracefully, and it exits once they are done.
+    start = time.monotonic()
+    signal_process(current_pid, signal.SIGWINCH)
+    signal_process(current_pid, signal.SIGQUIT)
+    timings.append(PhaseTiming('stop_old_master', time.monotonic() - start))
+
+
+def format_timings(
+    timings: List[PhaseTiming],
+) -> str:
+    return ' '.join(
+        '%s=%.1fms' % (timing.phase, timing.duration_s * 1000)
+        for timing in timings
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    args = parse_args()
+
+    timings: List[PhaseTiming] = []
+    exit_code = EXIT_OK
+    try:
+        reload_nginx(args, timings)
+    except ReloadError as e:
+        log.error('Reload failed in %s: %s' % (e.phase, e))
+        exit_code = e.exit_code
+
+    log.info('Reload exited with %d: %s' % (exit_code, format_timings(timings)))
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
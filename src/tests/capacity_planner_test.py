@@ -0,0 +1,91 @@
+import mock
+
+from synapse_tools import capacity_planner
+from synapse_tools import configure_synapse
+
+
+def generate_config(**options):
+    location_types = ['superregion', 'region']
+    with mock.patch('environment_tools.type_utils.available_location_types',
+                    return_value=location_types), \
+            mock.patch('synapse_tools.configure_synapse.available_location_types',
+                       return_value=location_types), \
+            mock.patch('synapse_tools.configure_synapse.get_current_location',
+                       return_value='my_region'):
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults(dict(bind_addr='0.0.0.0', **options)),
+            zookeeper_topology=['1.2.3.4'],
+            services=[
+                ('service_a', {'proxy_port': 1001, 'advertise': ['region'], 'discover': 'region'}),
+                ('service_b', {'proxy_port': 1002, 'advertise': ['region'], 'discover': 'region',
+                               'mode': 'tcp'}),
+            ],
+            envoy_migration_config={'migration_enabled': False, 'namespaces': {}},
+        )
+
+
+def test_estimate_haproxy():
+    config = generate_config(maximum_connections=1000)
+
+    # 32k buffers in each direction plus the default captured headers
+    stream_bytes = capacity_planner.haproxy_stream_bytes(config)
+    assert stream_bytes == 2 * 32768 + capacity_planner.STREAM_OVERHEAD_BYTES + 3 * 65 + 2 * 11
+    # Two frontends, two backends and the stats listener
+    fixed_bytes = capacity_planner.haproxy_fixed_bytes(config, servers_per_backend=10)
+    assert fixed_bytes == 5 * capacity_planner.PROXY_BYTES + 20 * capacity_planner.SERVER_BYTES
+
+    estimate = capacity_planner.estimate_haproxy(config, servers_per_backend=10, utilization=0.5)
+
+    assert estimate.worst_case_bytes == fixed_bytes + 1000 * stream_bytes
+    # 2 backends * 10 servers * (maxconn 50 + maxqueue 10) = 1200 > maxconn
+    assert estimate.typical_bytes == fixed_bytes + 500 * stream_bytes
+    # port, socket and proxy socket for each service, plus the stats port
+    assert estimate.fds == 2000 + 7 + 20 + capacity_planner.HAPROXY_SPARE_FDS
+
+
+def test_max_connections_for_budget():
+    config = generate_config()
+    budget = 1024 ** 3
+
+    maxconn = capacity_planner.max_connections_for_budget(config, budget, servers_per_backend=10)
+
+    sized = generate_config(maximum_connections=maxconn)
+    assert capacity_planner.estimate_haproxy(sized, 10, 0.1).worst_case_bytes <= budget
+    bigger = generate_config(maximum_connections=maxconn + 1)
+    assert capacity_planner.estimate_haproxy(bigger, 10, 0.1).worst_case_bytes > budget
+
+
+def test_stick_table_bytes():
+    config = generate_config()
+    config['services']['service_a']['haproxy']['backend'].append(
+        'stick-table type ip size 100k expire 30s store conn_cur')
+
+    assert capacity_planner.stick_table_bytes(config) == 100 * 1024 * (capacity_planner.STICK_ENTRY_BYTES + 4)
+
+
+def test_ring_bytes():
+    assert capacity_planner.ring_bytes(generate_config()) == 0
+
+    config = generate_config(
+        haproxy_log_target='ring', haproxy_log_address='127.0.0.1:1515', haproxy_log_ring_size=4194304)
+
+    assert capacity_planner.ring_bytes(config) == 4194304
+    assert capacity_planner.haproxy_fixed_bytes(config, servers_per_backend=10) == (
+        capacity_planner.haproxy_fixed_bytes(generate_config(), servers_per_backend=10) + 4194304
+    )
+
+
+def test_check_fits():
+    config = generate_config(listen_with_nginx=True, maximum_connections=10000)
+    estimates = [
+        capacity_planner.estimate_haproxy(config, 10, 0.1),
+        capacity_planner.estimate_nginx(config, 0.1),
+    ]
+    # worker_rlimit_nofile is 4 * maximum_connections
+    assert estimates[1].fds == 40000
+
+    assert capacity_planner.check_fits(estimates, host_memory=64 * 1024 ** 3, fd_limit=1048576) == []
+    problems = capacity_planner.check_fits(estimates, host_memory=512 * 1024 ** 2, fd_limit=30000)
+    assert len(problems) == 2
+    assert problems[0].startswith('Worst case memory')
+    assert problems[1] == 'nginx needs 40000 file descriptors, more than the limit of 30000'
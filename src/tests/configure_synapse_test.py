@@ -156,8 +156,7 @@ def test_generate_configuration(mock_get_current_location, mock_available_locati
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -190,8 +189,7 @@ def test_generate_configuration(mock_get_current_location, mock_available_locati
                 'listen': [],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -344,8 +342,7 @@ def test_generate_configuration_single_advertise_per_endpoint_timeouts(mock_get_
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 3',
@@ -377,8 +374,7 @@ def test_generate_configuration_single_advertise_per_endpoint_timeouts(mock_get_
                 'listen': [],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 3',
@@ -409,8 +405,7 @@ def test_generate_configuration_single_advertise_per_endpoint_timeouts(mock_get_
                 'listen': [],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 3',
@@ -441,8 +436,7 @@ def test_generate_configuration_single_advertise_per_endpoint_timeouts(mock_get_
                 'listen': [],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 3',
@@ -563,8 +557,7 @@ def test_generate_configuration_single_advertise_per_endpoint_timeouts_with_defa
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 3',
@@ -595,8 +588,7 @@ def test_generate_configuration_single_advertise_per_endpoint_timeouts_with_defa
                 'listen': [],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 3',
@@ -626,8 +618,7 @@ def test_generate_configuration_single_advertise_per_endpoint_timeouts_with_defa
                 'listen': [],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 3',
@@ -738,8 +729,7 @@ def test_generate_configuration_single_advertise(mock_get_current_location, mock
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 3',
@@ -902,8 +892,7 @@ def test_generate_configuration_with_proxied_through(mock_get_current_location,
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -997,8 +986,7 @@ def test_generate_configuration_with_nginx(mock_get_current_location, mock_avail
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -1034,8 +1022,7 @@ def test_generate_configuration_with_nginx(mock_get_current_location, mock_avail
                 'listen': [],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -1147,8 +1134,7 @@ def test_generate_configuration_only_nginx(mock_get_current_location, mock_avail
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -1185,8 +1171,7 @@ def test_generate_configuration_only_nginx(mock_get_current_location, mock_avail
                 'listen': [],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -1297,8 +1282,7 @@ def test_generate_configuration_with_source_required_plugin(mock_get_current_loc
                 'backend': [
                     'http-request lua.add_source_header',
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -1460,8 +1444,7 @@ def test_generate_configuration_with_logging_plugin(mock_get_current_location, m
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -1493,6 +1476,68 @@ def test_generate_configuration_with_logging_plugin(mock_get_current_location, m
     assert 'setenv sample_rate' in actual_global[-1]
 
 
+def test_generate_configuration_with_hard_stop_after(mock_get_current_location, mock_available_location_types):
+    def generate_global(**options):
+        synapse_tools_config = configure_synapse.set_defaults(
+            dict(bind_addr='0.0.0.0', **options))
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=synapse_tools_config,
+            zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+            services=[],
+            envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+        )['haproxy']['global']
+
+    actual_global = generate_global()
+    assert not any(line.startswith('hard-stop-after') for line in actual_global)
+    assert not any(line.startswith('close-spread-time') for line in actual_global)
+
+    actual_global = generate_global(haproxy_hard_stop_after=True)
+    assert actual_global[-1] == 'hard-stop-after 3600s'
+
+    actual_global = generate_global(
+        haproxy_hard_stop_after=True,
+        haproxy_reap_age_s=600,
+        haproxy_close_spread_time_s=900,
+    )
+    assert actual_global[-2:] == ['hard-stop-after 600s', 'close-spread-time 600s']
+
+
+def test_generate_configuration_with_aggregated_logging(mock_get_current_location, mock_available_location_types):
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+        zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+        services=[
+            (
+                'test_service',
+                {
+                    'proxy_port': 1234,
+                    'advertise': ['region'],
+                    'discover': 'region',
+                    'plugins': {
+                        'logging': {
+                            'enabled': True,
+                            'aggregate': True,
+                            'flush_interval_s': 30,
+                        }
+                    }
+                }
+            )
+        ],
+        envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+    )
+
+    actual_global = actual_configuration['haproxy']['global']
+    assert 'log_requests' in actual_global[-3]
+    assert actual_global[-2:] == [
+        'setenv provenance_aggregate 1',
+        'setenv provenance_flush_interval 30',
+    ]
+    assert actual_configuration['services']['test_service']['haproxy']['backend'][-2:] == [
+        'http-request lua.init_logging',
+        'http-request lua.log_provenance',
+    ]
+
+
 def test_generate_configuration_with_multiple_plugins(mock_get_current_location, mock_available_location_types):
     actual_configuration = configure_synapse.generate_configuration(
         synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
@@ -1634,8 +1679,7 @@ def test_generate_configuration_with_multiple_plugins(mock_get_current_location,
                 ],
                 'backend': [
                     'balance roundrobin',
-                    'reqidel ^X-Mode:.*',
-                    'reqadd X-Mode:\\ ro',
+                    'http-request set-header X-Mode ro',
                     'option httpchk GET /http/test_service/0/status HTTP/1.1\\r\\nX-Mode:\\ ro',
                     'http-check send-state',
                     'retries 2',
@@ -2146,3 +2190,473 @@ def test_nginx_proxy_proto(mock_get_current_location, mock_available_location_ty
     nginx = actual_configuration['services']['test_service.nginx_listener']
     assert nginx['default_servers'][0]['port'] == '/var/run/synapse/sockets/test_service.prxy'
     assert 'proxy_protocol on' in nginx['nginx']['server']
+
+
+def test_generate_configuration_with_seamless_reload(mock_get_current_location, mock_available_location_types):
+    def generate_haproxy(**options):
+        synapse_tools_config = configure_synapse.set_defaults(
+            dict(bind_addr='0.0.0.0', **options))
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=synapse_tools_config,
+            zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+            services=[],
+            envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+        )['haproxy']
+
+    actual_haproxy = generate_haproxy()
+    assert 'stats socket /var/run/synapse/haproxy.sock level admin' in actual_haproxy['global']
+    assert ' -x ' not in actual_haproxy['reload_command']
+
+    actual_haproxy = generate_haproxy(haproxy_seamless_reload=True)
+    assert (
+        'stats socket /var/run/synapse/haproxy.sock level admin expose-fd listeners'
+        in actual_haproxy['global']
+    )
+    # The new instance must ask the socket of the old one for the
+    # listeners, before telling it to finish
+    assert actual_haproxy['reload_command'] == (
+        'touch /var/run/synapse/haproxy.pid && '
+        'PID=$(cat /var/run/synapse/haproxy.pid) && '
+        '/usr/bin/haproxy-synapse -f /var/run/synapse/haproxy.cfg '
+        '-p /var/run/synapse/haproxy.pid '
+        '-x /var/run/synapse/haproxy.sock -sf $PID'
+    )
+
+
+def test_get_nginx_proxy_timeout_s():
+    def get_timeout(service_info, **options):
+        synapse_tools_config = configure_synapse.set_defaults(dict(**options))
+        return configure_synapse._get_nginx_proxy_timeout_s(service_info, synapse_tools_config)
+
+    # Off by default: always outlast the reap age
+    assert get_timeout({'timeout_server_ms': 3000}) == 3610
+    assert get_timeout({'timeout_server_ms': 3000}, haproxy_reap_age_s=600) == 610
+
+    # Otherwise just outlast HAProxy's own timeouts
+    assert get_timeout({}, nginx_per_service_proxy_timeout=True) == 11
+    assert get_timeout({'timeout_server_ms': 3000}, nginx_per_service_proxy_timeout=True) == 13
+    assert get_timeout(
+        {'timeout_client_ms': 2500, 'endpoint_timeouts': {'/slow': 60000}},
+        nginx_per_service_proxy_timeout=True,
+    ) == 70
+    # Path based backends only exist in http mode
+    assert get_timeout(
+        {'mode': 'tcp', 'endpoint_timeouts': {'/slow': 60000}},
+        nginx_per_service_proxy_timeout=True,
+    ) == 11
+    # ... and never past the reap age
+    assert get_timeout(
+        {'timeout_server_ms': 7200000},
+        nginx_per_service_proxy_timeout=True,
+        haproxy_reap_age_s=600,
+    ) == 610
+
+
+def test_generate_configuration_with_connection_reuse(mock_get_current_location, mock_available_location_types, caplog):
+    def generate_service(**service_info):
+        service_info.update(proxy_port=1234, advertise=['region'], discover='region')
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+            zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+            services=[('test_service', service_info)],
+            envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+        )['services']['test_service']['haproxy']
+
+    actual_haproxy = generate_service()
+    assert not any(option.startswith('http-reuse') for option in actual_haproxy['backend'])
+    assert 'pool-' not in actual_haproxy['server_options']
+
+    actual_haproxy = generate_service(
+        http_reuse='safe', pool_max_conn=20, pool_purge_delay_ms=5000)
+    assert actual_haproxy['backend'][:3] == [
+        'no option forceclose',
+        'option http-keep-alive',
+        'http-reuse safe',
+    ]
+    assert actual_haproxy['server_options'] == (
+        'check port 6666 observe layer7 maxconn 50 maxqueue 10 '
+        'pool-max-conn 20 pool-purge-delay 5000ms'
+    )
+    # The frontend has to keep connections alive too
+    assert 'no option forceclose' in actual_haproxy['frontend']
+    assert 'option http-keep-alive' in actual_haproxy['frontend']
+    assert 'option http-keep-alive' not in generate_service()['frontend']
+
+    # ... including frontends shared between services
+    synapse_tools_config = configure_synapse.set_defaults({'bind_addr': '0.0.0.0'})
+    synapse_config = configure_synapse.generate_configuration(
+        synapse_tools_config=synapse_tools_config,
+        zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+        services=[
+            (name, {'proxy_port': port, 'advertise': ['region'], 'discover': 'region', 'http_reuse': 'safe'})
+            for name, port in (('service_a', 1001), ('service_b', 1002))
+        ],
+        envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+    )
+    configure_synapse.consolidate_frontends(synapse_config, synapse_tools_config)
+    shared_frontend = synapse_config['haproxy']['extra_sections']['frontend consolidated_0']
+    assert 'no option forceclose' in shared_frontend
+    assert 'option http-keep-alive' in shared_frontend
+
+    # Connection reuse is an http thing
+    actual_haproxy = generate_service(mode='tcp', http_reuse='always')
+    assert not any(option.startswith('http-reuse') for option in actual_haproxy['backend'])
+    assert 'option http-keep-alive' not in actual_haproxy['backend']
+
+    # A typo is reported, rather than silently leaving reuse off
+    actual_haproxy = generate_service(http_reuse='allways')
+    assert not any(option.startswith('http-reuse') for option in actual_haproxy['backend'])
+    assert "Ignoring invalid http_reuse 'allways' of test_service" in caplog.text
+
+
+def test_generate_configuration_with_healthcheck_overrides(mock_get_current_location, mock_available_location_types):
+    actual_configuration = configure_synapse.generate_configuration(
+        synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+        zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+        services=[(
+            'test_service',
+            {
+                'proxy_port': 1234,
+                'advertise': ['region'],
+                'discover': 'region',
+                'healthcheck_inter_ms': 3600000,
+                'healthcheck_fastinter_ms': 60000,
+                'healthcheck_downinter_ms': 120000,
+                'healthcheck_rise': 2,
+                'healthcheck_fall': 3,
+            },
+        )],
+        envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+    )
+
+    assert actual_configuration['services']['test_service']['haproxy']['server_options'] == (
+        'check port 6666 observe layer7 maxconn 50 maxqueue 10 '
+        'inter 3600000ms fastinter 60000ms downinter 120000ms rise 2 fall 3'
+    )
+
+
+def test_generate_configuration_with_log_modes(mock_get_current_location, mock_available_location_types):
+    def generate_frontend(service_info, **options):
+        service_info.update(proxy_port=1234, advertise=['region'], discover='region')
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults(dict(bind_addr='0.0.0.0', **options)),
+            zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+            services=[('test_service', service_info)],
+            envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+        )['services']['test_service']['haproxy']['frontend']
+
+    def log_options(frontend):
+        return [
+            option for option in frontend
+            if option.startswith(('log ', 'no log', 'option dontlog'))
+        ]
+
+    assert log_options(generate_frontend({})) == []
+    assert log_options(generate_frontend({'log_mode': 'errors'})) == ['option dontlog-normal']
+    assert log_options(generate_frontend({'log_mode': 'off', 'mode': 'tcp'})) == ['no log']
+    assert log_options(generate_frontend(
+        {}, haproxy_log_mode='sampled', haproxy_log_sampling=True,
+    )) == [
+        'no log',
+        'log 127.0.0.1:1514 sample 1:100 daemon info',
+    ]
+    # Services override the global mode and rate
+    assert log_options(generate_frontend(
+        {'log_mode': 'sampled', 'log_sample_rate': 10}, haproxy_log_mode='off', haproxy_log_sampling=True,
+    )) == [
+        'no log',
+        'log 127.0.0.1:1514 sample 1:10 daemon info',
+    ]
+    assert log_options(generate_frontend({'log_mode': 'all'}, haproxy_log_mode='off')) == []
+
+
+def test_get_log_mode(caplog):
+    def get_log_mode(service_info, **options):
+        synapse_tools_config = configure_synapse.set_defaults(options)
+        return configure_synapse.get_log_mode('test_service', service_info, synapse_tools_config)
+
+    assert get_log_mode({}) == ('all', 100)
+    assert get_log_mode({'log_mode': 'off', 'log_sample_rate': 5}) == ('off', 5)
+
+    # Typos in a service's config fall back to the host's defaults
+    assert get_log_mode({'log_mode': 'error', 'log_sample_rate': 0}, haproxy_log_mode='errors') == ('errors', 100)
+    assert "Ignoring invalid log_mode 'error' of test_service" in caplog.text
+    assert 'Ignoring invalid log_sample_rate 0 of test_service' in caplog.text
+    assert get_log_mode({'log_sample_rate': 2.5}) == ('all', 100)
+
+    # HAProxy < 2.0 doesn't load a config with sampled logs
+    assert get_log_mode({'log_mode': 'sampled'}) == ('all', 100)
+    assert 'Ignoring log_mode sampled of test_service' in caplog.text
+    assert get_log_mode({'log_mode': 'sampled'}, haproxy_log_sampling=True) == ('sampled', 100)
+
+    for options in (
+        {'haproxy_log_mode': 'everything'},
+        {'haproxy_log_mode': 'sampled'},
+        {'haproxy_log_sample_rate': 0},
+        {'haproxy_log_sample_rate': '100'},
+    ):
+        with pytest.raises(ValueError):
+            get_log_mode({}, **options)
+
+
+def test_generate_configuration_with_log_targets(mock_get_current_location, mock_available_location_types):
+    def generate_haproxy(**options):
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults(dict(bind_addr='0.0.0.0', **options)),
+            zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+            services=[(
+                'test_service',
+                {'proxy_port': 1234, 'advertise': ['region'], 'discover': 'region', 'log_mode': 'sampled'},
+            )],
+            envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+        )['haproxy']
+
+    def log_lines(haproxy):
+        return (
+            [line for line in haproxy['global'] if line.startswith('log ')],
+            haproxy['extra_sections'].get('ring synapse_logs'),
+        )
+
+    assert log_lines(generate_haproxy()) == (['log 127.0.0.1:1514 daemon info'], None)
+    assert log_lines(generate_haproxy(
+        haproxy_log_target='unix',
+        haproxy_log_address='/var/run/synapse/log.sock',
+        haproxy_log_max_length=4096,
+    )) == (['log /var/run/synapse/log.sock len 4096 daemon info'], None)
+
+    haproxy = generate_haproxy(
+        haproxy_log_target='ring',
+        haproxy_log_address='unix@/var/run/synapse/log_stream.sock',
+        haproxy_log_ring_size=4194304,
+        haproxy_log_max_length=4096,
+    )
+    assert log_lines(haproxy) == (
+        ['log ring@synapse_logs len 4096 daemon info'],
+        [
+            'format rfc3164',
+            'size 4194304',
+            'maxlen 4096',
+            'timeout connect 1s',
+            'timeout server 10s',
+            'server syslog unix@/var/run/synapse/log_stream.sock',
+        ],
+    )
+    # Sampled services log to the same target
+    test_service = configure_synapse.generate_configuration(
+        synapse_tools_config=configure_synapse.set_defaults({
+            'bind_addr': '0.0.0.0',
+            'haproxy_log_target': 'ring',
+            'haproxy_log_address': '127.0.0.1:1515',
+            'haproxy_log_sampling': True,
+        }),
+        zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+        services=[(
+            'test_service',
+            {'proxy_port': 1234, 'advertise': ['region'], 'discover': 'region', 'log_mode': 'sampled'},
+        )],
+        envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+    )['services']['test_service']
+    assert 'log ring@synapse_logs sample 1:100 daemon info' in test_service['haproxy']['frontend']
+
+
+@pytest.mark.parametrize('target,address', [
+    # Would quietly send udp
+    ('unix', None),
+    ('unix', '127.0.0.1:1514'),
+    ('unix', 'log.sock'),
+    # The default receiver only takes udp
+    ('ring', None),
+    ('ring', '/var/run/synapse/log_stream.sock'),
+    ('udp', '/var/run/synapse/log.sock'),
+    ('tcp', '127.0.0.1:1514'),
+])
+def test_get_haproxy_log_address_rejects_mismatches(target, address):
+    synapse_tools_config = configure_synapse.set_defaults({
+        'haproxy_log_target': target,
+        'haproxy_log_address': address,
+    })
+    with pytest.raises(ValueError):
+        configure_synapse.get_haproxy_log_address(synapse_tools_config)
+
+
+def test_ensure_unix_dgram_qlen(tmpdir):
+    sysctl = tmpdir.join('max_dgram_qlen')
+    sysctl.write('512\n')
+
+    configure_synapse.ensure_unix_dgram_qlen(4096, str(sysctl))
+    assert sysctl.read() == '4096\n'
+    # Never lowered
+    configure_synapse.ensure_unix_dgram_qlen(1024, str(sysctl))
+    assert sysctl.read() == '4096\n'
+
+
+def test_generate_configuration_with_legacy_header_rewrite(mock_get_current_location, mock_available_location_types):
+    def generate_backend(**options):
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults(dict(bind_addr='0.0.0.0', **options)),
+            zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+            services=[(
+                'test_service',
+                {
+                    'proxy_port': 1234,
+                    'advertise': ['region'],
+                    'discover': 'region',
+                    'extra_headers': {'X-Mode': 'ro', 'X-Note': '100% "odd" value'},
+                },
+            )],
+            envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+        )['services']['test_service']['haproxy']['backend']
+
+    assert generate_backend()[:2] == [
+        'http-request set-header X-Mode ro',
+        'http-request set-header X-Note "100%% \\"odd\\" value"',
+    ]
+    assert generate_backend(haproxy_legacy_header_rewrite=True)[:4] == [
+        'reqidel ^X-Mode:.*',
+        'reqidel ^X-Note:.*',
+        'reqadd X-Mode:\\ ro',
+        'reqadd X-Note:\\ 100% "odd" value',
+    ]
+
+
+def test_consolidate_frontends(mock_get_current_location, mock_available_location_types):
+    synapse_tools_config = configure_synapse.set_defaults({'bind_addr': '0.0.0.0'})
+    synapse_config = configure_synapse.generate_configuration(
+        synapse_tools_config=synapse_tools_config,
+        zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+        services=[
+            ('service_a', {'proxy_port': 1001, 'advertise': ['region'], 'discover': 'region'}),
+            ('service_b', {'proxy_port': 1002, 'advertise': ['region'], 'discover': 'region'}),
+            # Routes on the path
+            ('service_c', {'proxy_port': 1003, 'advertise': ['region'], 'discover': 'region',
+                           'endpoint_timeouts': {'/slow': 10000}}),
+            # Nothing to share its frontend with
+            ('service_d', {'proxy_port': 1004, 'advertise': ['region'], 'discover': 'region',
+                           'mode': 'tcp'}),
+        ],
+        envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+    )
+    frontend_b = synapse_config['services']['service_b']['haproxy']['frontend']
+
+    frontend_map = configure_synapse.consolidate_frontends(synapse_config, synapse_tools_config)
+
+    assert frontend_map == {
+        1: 'service_a', 2: 'service_a', 3: 'service_a',
+        4: 'service_b', 5: 'service_b', 6: 'service_b',
+    }
+    for name in ('service_a', 'service_b'):
+        haproxy = synapse_config['services'][name]['haproxy']
+        assert 'frontend' not in haproxy
+        assert 'port' not in haproxy
+        assert haproxy['backend_name'] == name
+    for name in ('service_c', 'service_d'):
+        assert 'frontend' in synapse_config['services'][name]['haproxy']
+
+    map_path = configure_synapse.get_frontend_map_path('/var/run/synapse/maps/', frontend_map)
+    assert synapse_config['haproxy']['extra_sections']['frontend consolidated_0'] == [
+        # Each service keeps its own limit
+        'bind 0.0.0.0:1001 id 1 maxconn 2000',
+        'bind /var/run/synapse/sockets/service_a.sock id 2 maxconn 2000',
+        'bind /var/run/synapse/sockets/service_a.prxy accept-proxy id 3 maxconn 2000',
+        'bind 0.0.0.0:1002 id 4 maxconn 2000',
+        'bind /var/run/synapse/sockets/service_b.sock id 5 maxconn 2000',
+        'bind /var/run/synapse/sockets/service_b.prxy accept-proxy id 6 maxconn 2000',
+        # Two services' worth of connections
+        'maxconn 4000',
+    ] + [
+        line for line in frontend_b
+        if not line.startswith('bind ') and 'service_b' not in line
+    ] + [
+        'use_backend %[so_id,map_int({0})]'.format(map_path),
+    ]
+
+
+def test_frontend_map_path():
+    map_path = configure_synapse.get_frontend_map_path('/maps', {1: 'service_a', 2: 'service_b'})
+
+    assert map_path.startswith('/maps/so_id_to_backend.')
+    assert map_path.endswith('.map')
+    assert configure_synapse.get_frontend_map_path('/maps', {2: 'service_b', 1: 'service_a'}) == map_path
+    # Ids pointing elsewhere get a map of their own
+    assert configure_synapse.get_frontend_map_path('/maps', {1: 'service_b', 2: 'service_a'}) != map_path
+
+
+def test_write_frontend_map(tmpdir):
+    frontend_map = {2: 'service_a', 1: 'service_a', 4: 'service_b'}
+    map_path = configure_synapse.get_frontend_map_path(str(tmpdir.join('maps')), frontend_map)
+    tmpdir.join('maps', 'so_id_to_backend.0123456789ab.map').write('1 service_b\n', ensure=True)
+    tmpdir.join('maps', 'ip_to_service.map').write('', ensure=True)
+
+    configure_synapse.write_frontend_map(map_path, frontend_map)
+
+    with open(map_path) as fp:
+        assert fp.read() == '1 service_a\n2 service_a\n4 service_b\n'
+
+    configure_synapse.remove_stale_frontend_maps(map_path)
+    assert sorted(str(path) for path in tmpdir.join('maps').listdir()) == sorted([
+        str(tmpdir.join('maps', 'ip_to_service.map')), map_path,
+    ])
+
+
+# Options HAProxy accepts with 'no'
+NEGATABLE_OPTIONS = {
+    'accept-invalid-http-request',
+    'allredisp',
+    'dontlog-normal',
+    'forceclose',
+    'http-keep-alive',
+    'log-separate-errors',
+}
+
+
+def test_compact_options(mock_get_current_location, mock_available_location_types):
+    synapse_config = configure_synapse.generate_configuration(
+        synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+        zookeeper_topology=['1.2.3.4', '2.3.4.5'],
+        services=[
+            ('service_a', {'proxy_port': 1001, 'advertise': ['region'], 'discover': 'region',
+                           'log_mode': 'errors'}),
+            ('service_b', {'proxy_port': 1002, 'advertise': ['region'], 'discover': 'region',
+                           'log_mode': 'errors', 'keepalive': True}),
+            ('service_c', {'proxy_port': 1003, 'advertise': ['region'], 'discover': 'region',
+                           'mode': 'tcp'}),
+            ('service_d', {'proxy_port': 1004, 'advertise': ['region'], 'discover': 'region',
+                           'log_mode': 'errors', 'keepalive': True}),
+        ],
+        envoy_migration_config=STATUS_QUO_ENVOY_MIGRATION_CONFIG,
+    )
+    services = synapse_config['services']
+    before_a = list(services['service_a']['haproxy']['frontend'])
+
+    assert configure_synapse.compact_options(synapse_config) == [
+        'option dontlog-normal', 'http-check send-state',
+    ]
+
+    assert synapse_config['haproxy']['defaults'][-2:] == ['option dontlog-normal', 'http-check send-state']
+    assert services['service_a']['haproxy']['frontend'] == [
+        line for line in before_a if line != 'option dontlog-normal'
+    ]
+    # Turned back off where it wasn't on
+    assert services['service_c']['haproxy']['frontend'][0] == 'no option dontlog-normal'
+    assert synapse_config['haproxy']['extra_sections']['listen stats'][0] == 'no option dontlog-normal'
+    # Log formats and connection modes stay where they are
+    assert 'option httplog' in services['service_a']['haproxy']['frontend']
+    assert 'option tcplog' in services['service_c']['haproxy']['frontend']
+    assert 'option http-keep-alive' in services['service_b']['haproxy']['backend']
+    assert 'option forceclose' in synapse_config['haproxy']['defaults']
+    for service in services.values():
+        assert 'http-check send-state' not in service['haproxy']['backend']
+        assert 'no http-check send-state' not in service['haproxy']['backend']
+
+    sections = list(synapse_config['haproxy']['extra_sections'].values())
+    for service in services.values():
+        sections.extend([service['haproxy']['frontend'], service['haproxy']['backend']])
+    for lines in sections:
+        for line in lines:
+            if line.startswith('no option '):
+                assert line.split()[2] in NEGATABLE_OPTIONS, line
+    for option in configure_synapse.HOISTABLE_OPTIONS:
+        assert option.split()[1] in NEGATABLE_OPTIONS
+
+    # Nothing left to move
+    assert configure_synapse.compact_options(synapse_config) == []
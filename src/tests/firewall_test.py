@@ -0,0 +1,62 @@
+import mock
+import pytest
+
+from synapse_tools.haproxy import firewall
+
+
+def test_get_firewall_backend():
+    assert isinstance(firewall.get_firewall_backend('iptables'), firewall.IptablesBackend)
+    assert isinstance(firewall.get_firewall_backend('nftables'), firewall.NftablesBackend)
+
+    with pytest.raises(KeyError):
+        firewall.get_firewall_backend('bogus')
+
+
+@mock.patch.object(firewall, 'local', autospec=True)
+def test_iptables_uses_ip6tables_for_ipv6(mock_local):
+    mock_local.__getitem__.return_value.__getitem__.return_value.run.return_value = (0, '', '')
+
+    assert firewall.IptablesBackend().has_rules(['169.254.255.254', 'fd00::1'])
+
+    assert mock_local.__getitem__.call_args_list == [
+        mock.call('iptables'), mock.call('ip6tables'),
+    ]
+    assert mock_local.__getitem__.return_value.__getitem__.call_args == mock.call(
+        ('-t', 'mangle', '-C') + firewall.IptablesBackend.RULE + ('-s', 'fd00::1'))
+
+
+def test_nftables_ruleset():
+    ruleset = firewall.NftablesBackend().ruleset(['169.254.255.254', 'fd00::1'])
+
+    assert ruleset == (
+        'table inet synapse_qdisc\n'
+        'delete table inet synapse_qdisc\n'
+        'table inet synapse_qdisc {\n'
+        '    chain output {\n'
+        '        type route hook output priority -150; policy accept;\n'
+        '        ip saddr 169.254.255.254 tcp flags & (fin | syn | rst | ack) == syn meta mark set 1\n'
+        '        ip6 saddr fd00::1 tcp flags & (fin | syn | rst | ack) == syn meta mark set 1\n'
+        '    }\n'
+        '}\n'
+    )
+
+
+@mock.patch.object(firewall, 'local', autospec=True)
+def test_nftables_has_rules(mock_local):
+    run = mock_local.__getitem__.return_value.__getitem__.return_value.run
+    run.return_value = (0, (
+        'table inet synapse_qdisc {\n'
+        '\tchain output {\n'
+        '\t\ttype route hook output priority mangle; policy accept;\n'
+        '\t\tip saddr 169.254.255.254 tcp flags & (fin | syn | rst | ack) == syn meta mark set 0x00000001\n'
+        '\t\tip6 saddr fd00::1 tcp flags & (fin | syn | rst | ack) == syn meta mark set 0x00000001\n'
+        '\t}\n'
+        '}\n'
+    ), '')
+    backend = firewall.NftablesBackend()
+
+    assert backend.has_rules(['169.254.255.254', 'fd00:0::1'])
+    assert not backend.has_rules(['169.254.255.254', 'fd00::2'])
+
+    run.return_value = (1, '', 'No such file or directory')
+    assert not backend.has_rules(['169.254.255.254'])
@@ -0,0 +1,134 @@
+import threading
+
+import mock
+import pytest
+
+from synapse_tools import generate_container_ip_map
+
+
+class FakeSource(generate_container_ip_map.InventorySource):
+    def __init__(self, name, entries=(), error=None, block=None):
+        self.name = name
+        self.entries = entries
+        self.error = error
+        self.block = block
+
+    def extract(self, timeout):
+        if self.block is not None:
+            self.block.wait()
+        if self.error is not None:
+            raise self.error
+        return self.entries
+
+
+def test_get_inventory_source():
+    assert isinstance(
+        generate_container_ip_map.get_inventory_source('docker'),
+        generate_container_ip_map.DockerSource,
+    )
+    assert isinstance(
+        generate_container_ip_map.get_inventory_source('kubelet'),
+        generate_container_ip_map.KubeletSource,
+    )
+    source = generate_container_ip_map.get_inventory_source('file:/tmp/foo.map')
+    assert source.path == '/tmp/foo.map'
+    assert source.name == 'file:/tmp/foo.map'
+
+    with pytest.raises(Exception):
+        generate_container_ip_map.get_inventory_source('bogus')
+
+
+def test_collect_inventory_merges_in_source_order(capsys):
+    docker = FakeSource('docker', [('10.0.0.1', 'a.main'), ('10.0.0.2', 'b.main')])
+    kubelet = FakeSource('kubelet', [('10.0.0.2', 'c.main'), ('10.0.0.3', 'd.main')])
+
+    entries, failed = generate_container_ip_map.collect_inventory(
+        [docker, kubelet], deadline_s=5,
+    )
+
+    assert entries == [
+        ('10.0.0.1', 'a.main'),
+        ('10.0.0.2', 'b.main'),
+        ('10.0.0.3', 'd.main'),
+    ]
+    assert failed == []
+    assert 'Conflict for 10.0.0.2' in capsys.readouterr().err
+
+
+def test_collect_inventory_reports_failed_and_slow_sources(capsys):
+    never = threading.Event()
+    ok = FakeSource('ok', [('10.0.0.1', 'a.main')])
+    broken = FakeSource('broken', error=RuntimeError('boom'))
+    slow = FakeSource('slow', [('10.0.0.2', 'b.main')], block=never)
+
+    entries, failed = generate_container_ip_map.collect_inventory(
+        [ok, broken, slow], deadline_s=0.1,
+    )
+
+    assert entries == [('10.0.0.1', 'a.main')]
+    assert failed == ['broken', 'slow']
+    err = capsys.readouterr().err
+    assert 'broken failed: boom' in err
+    assert 'slow failed: deadline exceeded' in err
+
+
+def test_static_file_source(tmpdir):
+    map_file = tmpdir.join('static.map')
+    map_file.write('10.0.0.1 a.main\n\n10.0.0.2  b.main\n   \n10.0.0.3\n')
+
+    source = generate_container_ip_map.StaticFileSource(str(map_file))
+
+    assert sorted(source.extract(timeout=1)) == [
+        ('10.0.0.1', 'a.main'),
+        ('10.0.0.2', 'b.main'),
+    ]
+
+
+def test_docker_source_passes_the_timeout():
+    with mock.patch.object(
+        generate_container_ip_map, 'get_docker_client', autospec=True,
+    ) as mock_get_docker_client:
+        docker_client = mock_get_docker_client.return_value
+        docker_client.containers.return_value = []
+
+        assert generate_container_ip_map.DockerSource().extract(timeout=3) == []
+
+    assert docker_client.timeout == 3
+
+
+def test_main_fails_when_every_source_fails(tmpdir):
+    map_file = tmpdir.join('ip_to_service.map')
+    map_file.write('10.0.0.1 a.main')
+    broken = FakeSource('docker', error=RuntimeError('no docker'))
+
+    with mock.patch(
+        'sys.argv', ['generate_container_ip_map', str(map_file)],
+    ), mock.patch.object(
+        generate_container_ip_map, 'get_inventory_source', return_value=broken,
+    ), pytest.raises(SystemExit) as excinfo:
+        generate_container_ip_map.main()
+
+    assert excinfo.value.code == 1
+    # The stale map is kept
+    assert map_file.read() == '10.0.0.1 a.main'
+
+
+def test_main_keeps_unclaimed_entries_when_a_source_fails(tmpdir):
+    map_file = tmpdir.join('ip_to_service.map')
+    map_file.write('10.0.0.1 a.main\n10.0.0.2 b.main')
+    sources = {
+        'docker': FakeSource('docker', [('10.0.0.1', 'c.main')]),
+        'kubelet': FakeSource('kubelet', error=RuntimeError('no kubelet')),
+    }
+
+    with mock.patch(
+        'sys.argv', [
+            'generate_container_ip_map', '-s', 'docker', '-s', 'kubelet',
+            str(map_file),
+        ],
+    ), mock.patch.object(
+        generate_container_ip_map, 'get_inventory_source', side_effect=sources.get,
+    ):
+        generate_container_ip_map.main()
+
+    assert map_file.read() == '10.0.0.1 c.main\n10.0.0.2 b.main'
@@ -0,0 +1,47 @@
+import mock
+
+from synapse_tools import haproxy_log_stats
+
+
+SHOW_INFO = '''Name: HAProxy
+Version: 2.4.22
+Uptime: 0d 1h02m03s
+DroppedLogs: 42
+BusyPolling: 0
+'''
+
+
+def test_parse_info():
+    info = haproxy_log_stats.parse_info(SHOW_INFO)
+
+    assert info['Version'] == '2.4.22'
+    # Only the first colon separates the value
+    assert info['Uptime'] == '0d 1h02m03s'
+    assert info['DroppedLogs'] == '42'
+
+
+def test_get_dropped_logs():
+    with mock.patch.object(
+        haproxy_log_stats, 'query_stats_socket', return_value=SHOW_INFO,
+    ) as mock_query:
+        assert haproxy_log_stats.get_dropped_logs('/var/run/synapse/haproxy.sock', 1.0) == 42
+
+    mock_query.assert_called_once_with('/var/run/synapse/haproxy.sock', 'show info', 1.0)
+
+    with mock.patch.object(
+        haproxy_log_stats, 'query_stats_socket', return_value='Name: HAProxy\nVersion: 1.8.30\n',
+    ):
+        assert haproxy_log_stats.get_dropped_logs('/var/run/synapse/haproxy.sock', 1.0) == 0
+
+
+def test_query_stats_socket():
+    with mock.patch('socket.socket') as mock_socket:
+        sock = mock_socket.return_value
+        sock.recv.side_effect = [b'DroppedLogs: ', b'42\n', b'']
+
+        output = haproxy_log_stats.query_stats_socket('/haproxy.sock', 'show info', 1.0)
+
+    assert output == 'DroppedLogs: 42\n'
+    sock.connect.assert_called_once_with('/haproxy.sock')
+    sock.sendall.assert_called_once_with(b'show info\n')
+    sock.close.assert_called_once_with()
@@ -1,4 +1,8 @@
+import os
+
 import mock
+import psutil
+import pytest
 
 from synapse_tools import haproxy_synapse_reaper
 
@@ -8,9 +12,11 @@ def test_parse_args():
     with mock.patch('sys.argv', mock_argv):
         args = haproxy_synapse_reaper.parse_args()
 
+    assert args.state_file == '/var/run/synapse_alumni.json'
     assert args.state_dir == '/var/run/synapse_alumni'
     assert args.reap_age == 3600
     assert args.username == 'nobody'
+    assert not args.daemon
 
 
 def test_parse_args_state_dir():
@@ -37,81 +43,180 @@ def test_parse_args_username():
     assert args.username == 'bar'
 
 
-def create_mock_process(pid, name='haproxy-synapse', create_time=0):
+def create_mock_process(pid, name='haproxy-synapse', create_time=0, ppid=0):
     proc = mock.Mock(pid=pid)
+    proc.ppid.return_value = ppid
     proc.name.return_value = name
     proc.username.return_value = 'nobody'
     proc.create_time.return_value = create_time
     return proc
 
 
-@mock.patch('synapse_tools.haproxy_synapse_reaper.psutil.process_iter')
-@mock.patch('synapse_tools.haproxy_synapse_reaper.get_main_pid')
-def test_get_alumni(mock_get_main_pid, mock_process_iter):
+def create_proc_entry(proc_root, pid, comm, cmdline=None, uids=None):
+    proc_dir = proc_root.mkdir(str(pid))
+    proc_dir.join('comm').write(comm + '\n')
+    if uids is None:
+        uids = [os.getuid()] * 4
+    # Real, effective, saved and filesystem uid
+    proc_dir.join('status').write(
+        'Name:\t{0}\nUid:\t{1}\nGid:\t0\t0\t0\t0\n'.format(
+            comm, '\t'.join(str(uid) for uid in uids)))
+    if cmdline is None:
+        cmdline = ['/usr/bin/' + comm]
+    proc_dir.join('cmdline').write('\0'.join(cmdline) + '\0')
+
+
+def test_find_pids_by_name(tmpdir):
+    create_proc_entry(tmpdir, 1, 'init')
+    create_proc_entry(tmpdir, 10, 'haproxy-synapse', ['/usr/bin/haproxy-synapse', '-f', 'haproxy.cfg'])
+    create_proc_entry(tmpdir, 11, 'haproxy-synaps')
+    # comm is truncated to 15 characters by the kernel, so only the command
+    # line tells this one apart
+    create_proc_entry(tmpdir, 12, 'haproxy-synapse-long'[:15], ['/usr/bin/haproxy-synapse-long'])
+    # Matched on its real uid, whatever it changed its effective one to
+    create_proc_entry(tmpdir, 14, 'haproxy-synapse', uids=[os.getuid(), 0, 0, 0])
+    create_proc_entry(tmpdir, 15, 'haproxy-synapse', uids=[os.getuid() + 1] + [os.getuid()] * 3)
+    # Exited between listdir and open
+    tmpdir.mkdir('13')
+    tmpdir.mkdir('self')
+
+    pids = haproxy_synapse_reaper.find_pids_by_name(
+        'haproxy-synapse', os.getuid(), str(tmpdir))
+    assert sorted(pids) == [10, 14]
+
+    pids = haproxy_synapse_reaper.find_pids_by_name(
+        'haproxy-synapse', os.getuid() + 1, str(tmpdir))
+    assert list(pids) == [15]
+
+
+HAPROXY = haproxy_synapse_reaper.ProxyConfig(
+    name='haproxy-synapse',
+    pidfile='/var/run/synapse/haproxy.pid',
+    process_name='haproxy-synapse',
+    username='nobody',
+    reap_age=3600,
+    max_procs=10,
+    max_alumni_rss=None,
+    drain=None,
+    kill_children=False,
+    cmdline_contains=None,
+)
+
+
+@mock.patch('synapse_tools.haproxy_synapse_reaper.psutil.Process')
+@mock.patch('synapse_tools.haproxy_synapse_reaper.pwd.getpwnam')
+def test_get_alumni(mock_getpwnam, mock_process, tmpdir):
     # main instance
-    proc_0 = create_mock_process(pid=0)
+    create_proc_entry(tmpdir, 100, 'haproxy-synapse')
 
     # Some alumni
-    proc_1 = create_mock_process(pid=1)
-    proc_2 = create_mock_process(pid=2)
+    create_proc_entry(tmpdir, 1, 'haproxy-synapse')
+    create_proc_entry(tmpdir, 2, 'haproxy-synapse')
 
     # Some other process that should not be killed
-    proc_3 = create_mock_process(pid=5, name='some-other-proc')
+    create_proc_entry(tmpdir, 5, 'some-other-proc')
+
+    mock_getpwnam.return_value.pw_uid = os.getuid()
+    mock_process.side_effect = create_mock_process
+
+    actual = haproxy_synapse_reaper.get_alumni(
+        HAPROXY, main_pid=100, proc_root=str(tmpdir))
+
+    assert sorted(proc.pid for proc in actual) == [1, 2]
+    mock_getpwnam.assert_called_once_with('nobody')
+
+
+@mock.patch('synapse_tools.haproxy_synapse_reaper.psutil.Process')
+@mock.patch('synapse_tools.haproxy_synapse_reaper.pwd.getpwnam')
+def test_get_alumni_nginx_masters(mock_getpwnam, mock_process, tmpdir):
+    ppids = {
+        # old master, and the master it was upgraded to before that
+        10: 1, 20: 10,
+        # main master, forked from 20 during the last reload
+        30: 20,
+        # workers of 10 and 30
+        11: 10, 31: 30,
+    }
+    for pid in ppids:
+        create_proc_entry(tmpdir, pid, 'nginx')
+    mock_getpwnam.return_value.pw_uid = os.getuid()
+    mock_process.side_effect = lambda pid: create_mock_process(
+        pid, name='nginx', ppid=ppids[pid])
+    nginx = HAPROXY._replace(
+        name='nginx', process_name='nginx', kill_children=True)
+
+    actual = haproxy_synapse_reaper.get_alumni(
+        nginx, main_pid=30, proc_root=str(tmpdir))
+
+    assert sorted(proc.pid for proc in actual) == [10, 20]
 
-    mock_process_iter.return_value = [proc_0, proc_1, proc_2, proc_3]
-    mock_get_main_pid.return_value = 0
 
-    expected = [proc_1, proc_2]
-    actual = haproxy_synapse_reaper.get_alumni('nobody')
+def test_get_alumni_cmdline_contains(tmpdir):
+    create_proc_entry(tmpdir, 1, 'haproxy-synapse')
+    tmpdir.join('1', 'cmdline').write('haproxy\0-p\0/var/run/shard1.pid\0')
 
-    assert expected == list(actual)
+    assert haproxy_synapse_reaper.cmdline_contains(
+        1, '-p /var/run/shard1.pid', str(tmpdir))
+    assert not haproxy_synapse_reaper.cmdline_contains(
+        1, '-p /var/run/shard2.pid', str(tmpdir))
+    assert not haproxy_synapse_reaper.cmdline_contains(
+        2, 'haproxy', str(tmpdir))
 
 
-@mock.patch('synapse_tools.haproxy_synapse_reaper.time.time')
-@mock.patch('synapse_tools.haproxy_synapse_reaper.os.path.getctime')
-@mock.patch('synapse_tools.haproxy_synapse_reaper.os.path.exists')
-@mock.patch('builtins.open')
-def test_kill_alumni_if_too_old(mock_open, mock_exists, mock_getctime, mock_time):
+def test_kill_process_with_children():
+    master = create_mock_process(pid=10)
+    worker = create_mock_process(pid=11)
+    new_master = create_mock_process(pid=12)
+    master.children.return_value = [worker, new_master]
+
+    haproxy_synapse_reaper.kill_process(
+        master, kill_children=True, spare_pids=frozenset([10, 12]))
+
+    assert master.kill.call_count == 1
+    assert worker.kill.call_count == 1
+    assert new_master.kill.call_count == 0
+
+
+def test_kill_alumni_if_too_old():
     alumni = [
-        # This process has no pidfile in the state_dir and exceeds the reap age
-        # (specified via mock_getctime)
+        # This process was already known and exceeds the reap age
         create_mock_process(pid=42),
 
-        # This process does have a pidfile in the state_dir and does not yet
-        # exceeed the reap age
+        # This process is new, so it starts its alumnus life now
         create_mock_process(pid=43)
     ]
-
-    mock_exists.side_effect = [False, True]
-    mock_time.return_value = 3600
-    mock_getctime.side_effect = [0, 1]
+    state = {42: {'create_time': 0, 'alumnus_since': 0}}
 
     reap_count = haproxy_synapse_reaper.kill_alumni(
-        alumni=alumni, state_dir='/state/dir', reap_age=3600, max_procs=10)
+        alumni=alumni, state=state, reap_age=3600, max_procs=10, now=3600)
 
     assert reap_count == 1
     assert alumni[0].kill.call_count == 1
     assert alumni[1].kill.call_count == 0
-    mock_open.assert_called_once_with('/state/dir/42', 'w')
+    assert state[43] == {'create_time': 0, 'alumnus_since': 3600}
+
 
+def test_kill_alumni_pid_reuse():
+    # pid 42 was an alumnus a long time ago, but this is a different process
+    alumni = [create_mock_process(pid=42, create_time=5000)]
+    state = {42: {'create_time': 0, 'alumnus_since': 0}}
 
-@mock.patch('synapse_tools.haproxy_synapse_reaper.time.time')
-@mock.patch('synapse_tools.haproxy_synapse_reaper.os.path.getctime')
-@mock.patch('synapse_tools.haproxy_synapse_reaper.os.path.exists')
-@mock.patch('builtins.open')
-def test_kill_alumni_if_too_many(mock_open, mock_exists, mock_getctime, mock_time):
+    reap_count = haproxy_synapse_reaper.kill_alumni(
+        alumni=alumni, state=state, reap_age=3600, max_procs=10, now=6000)
+
+    assert reap_count == 0
+    assert state[42] == {'create_time': 5000, 'alumnus_since': 6000}
+
+
+def test_kill_alumni_if_too_many():
     alumni = [
         create_mock_process(pid=42, create_time=124),
         create_mock_process(pid=43, create_time=123),
         create_mock_process(pid=44, create_time=125),
     ]
 
-    mock_exists.return_value = True
-    mock_time.return_value = 0
-    mock_getctime.return_value = 0
-
     reap_count = haproxy_synapse_reaper.kill_alumni(
-        alumni=alumni, state_dir='/state/dir', reap_age=3600, max_procs=2)
+        alumni=alumni, state={}, reap_age=3600, max_procs=2, now=0)
 
     assert reap_count == 1
     assert alumni[0].kill.call_count == 0
@@ -119,18 +224,344 @@ def test_kill_alumni_if_too_many(mock_open, mock_exists, mock_getctime, mock_tim
     assert alumni[2].kill.call_count == 0
 
 
-@mock.patch('synapse_tools.haproxy_synapse_reaper.os.listdir')
-@mock.patch('synapse_tools.haproxy_synapse_reaper.os.remove')
-def test_remove_stale_alumni_pidfiles(mock_remove, mock_listdir):
+def test_remove_stale_alumni():
     alumni = [
         create_mock_process(pid=42),
         create_mock_process(pid=43)
     ]
+    # 41 has no associated alumnus so should be forgotten
+    state = {
+        41: {'create_time': 0, 'alumnus_since': 0},
+        42: {'create_time': 0, 'alumnus_since': 0},
+    }
+
+    haproxy_synapse_reaper.remove_stale_alumni(alumni, state)
+
+    assert list(state) == [42]
+
+
+def test_save_and_load_state(tmpdir):
+    state_file = str(tmpdir.join('alumni.json'))
+    state = {
+        'haproxy-synapse': {42: {'create_time': 1.5, 'alumnus_since': 2.5}},
+        'nginx': {},
+    }
+
+    haproxy_synapse_reaper.save_state(state_file, state)
+
+    assert haproxy_synapse_reaper.load_state(state_file) == state
+    assert tmpdir.listdir() == [tmpdir.join('alumni.json')]
+
+
+def test_load_state_missing_or_corrupt(tmpdir):
+    state_file = tmpdir.join('alumni.json')
+    assert haproxy_synapse_reaper.load_state(str(state_file)) == {}
+
+    state_file.write('{not json')
+    assert haproxy_synapse_reaper.load_state(str(state_file)) == {}
+
+    state_file.write('{"42": {"alumnus_since": 2.5, "create_time": 1.5}}')
+    assert haproxy_synapse_reaper.load_state(str(state_file)) == {}
+
+
+def test_get_proxies(tmpdir):
+    config = tmpdir.join('reaper.json')
+    config.write(
+        '{"proxies": ['
+        '{"name": "haproxy-synapse", "pidfile": "/var/run/synapse/haproxy.pid",'
+        ' "process_name": "haproxy-synapse", "max_alumni_rss": "1G"},'
+        '{"name": "nginx", "pidfile": "/var/run/synapse/nginx.pid",'
+        ' "process_name": "nginx", "username": "root", "reap_age": 600,'
+        ' "kill_children": true, "drain": true, "soft_signal": "QUIT"}'
+        ']}')
+    mock_argv = ['haproxy_synapse_reaper', '--config', str(config), '--max-procs', '5']
+    with mock.patch('sys.argv', mock_argv):
+        args = haproxy_synapse_reaper.parse_args()
+
+    haproxy, nginx = haproxy_synapse_reaper.get_proxies(args)
+
+    assert haproxy == HAPROXY._replace(max_procs=5, max_alumni_rss=1024 ** 3)
+    assert nginx.username == 'root'
+    assert nginx.reap_age == 600
+    assert nginx.max_procs == 5
+    assert nginx.kill_children
+    assert nginx.drain == haproxy_synapse_reaper.DrainPolicy(
+        idle_connections=0, grace=300, soft_signal=3)
+
+
+def test_get_proxies_without_config():
+    with mock.patch('sys.argv', ['haproxy_synapse_reaper']):
+        args = haproxy_synapse_reaper.parse_args()
+
+    assert haproxy_synapse_reaper.get_proxies(args) == [HAPROXY]
+
+
+@mock.patch('synapse_tools.haproxy_synapse_reaper.psutil.Process')
+def test_import_legacy_state_dir(mock_process, tmpdir):
+    state_dir = tmpdir.mkdir('synapse_alumni')
+    state_dir.join('42').write('')
+    state_dir.join('junk').write('')
+    mock_process.side_effect = create_mock_process
+    state = {}
+
+    haproxy_synapse_reaper.import_legacy_state_dir(str(state_dir), state)
+
+    assert list(state) == [42]
+    assert state[42]['alumnus_since'] > 0
+    assert not state_dir.exists()
+
+
+@mock.patch('synapse_tools.haproxy_synapse_reaper.psutil.Process')
+def test_import_legacy_state_dir_access_denied(mock_process, tmpdir):
+    state_dir = tmpdir.mkdir('synapse_alumni')
+    state_dir.join('42').write('')
+    mock_process.side_effect = psutil.AccessDenied(42)
+    state = {}
+
+    haproxy_synapse_reaper.import_legacy_state_dir(str(state_dir), state)
+
+    assert state == {}
+    assert not state_dir.exists()
+
+
+def test_next_reap_delay():
+    state = {
+        42: {'create_time': 0, 'alumnus_since': 100},
+        43: {'create_time': 0, 'alumnus_since': 50},
+    }
+
+    assert haproxy_synapse_reaper.next_reap_delay({}, 3600, 0) is None
+    assert haproxy_synapse_reaper.next_reap_delay(state, 3600, 650) == 3000
+    assert haproxy_synapse_reaper.next_reap_delay(state, 3600, 9999) == 0
+
+
+def test_parse_size():
+    assert haproxy_synapse_reaper.parse_size('1024') == 1024
+    assert haproxy_synapse_reaper.parse_size('512K') == 512 * 1024
+    assert haproxy_synapse_reaper.parse_size('1.5g') == 1536 * 1024 * 1024
+    assert haproxy_synapse_reaper.parse_size('2MB') == 2 * 1024 * 1024
+
+
+def test_parse_args_max_alumni_rss():
+    mock_argv = ['haproxy_synapse_reaper', '--max-alumni-rss', '2G']
+    with mock.patch('sys.argv', mock_argv):
+        args = haproxy_synapse_reaper.parse_args()
+
+    assert args.max_alumni_rss == 2 * 1024 ** 3
+
+
+def test_get_process_memory(tmpdir):
+    proc = create_mock_process(pid=42)
+    proc.memory_info.return_value.rss = 1000
+
+    # No smaps_rollup on older kernels
+    assert haproxy_synapse_reaper.get_process_memory(proc, str(tmpdir)) == 1000
+
+    tmpdir.mkdir('42').join('smaps_rollup').write(
+        'Rss:                 200 kB\nPss:                 100 kB\n')
+    assert haproxy_synapse_reaper.get_process_memory(proc, str(tmpdir)) == 100 * 1024
+
+
+@mock.patch('synapse_tools.haproxy_synapse_reaper.get_process_memory')
+def test_kill_alumni_over_memory_budget(mock_get_process_memory):
+    alumni = [
+        create_mock_process(pid=42, create_time=124),
+        create_mock_process(pid=43, create_time=123),
+        create_mock_process(pid=44, create_time=125),
+    ]
+    memory = {42: 300, 43: 100, 44: 200}
+    mock_get_process_memory.side_effect = lambda proc: memory[proc.pid]
+
+    reap_count = haproxy_synapse_reaper.kill_alumni(
+        alumni=alumni, state={}, reap_age=3600, max_procs=10, now=0,
+        max_alumni_rss=250)
+
+    # Oldest first: 43 (100) is not enough, 42 (300) brings us to 200
+    assert reap_count == 2
+    assert alumni[0].kill.call_count == 1
+    assert alumni[1].kill.call_count == 1
+    assert alumni[2].kill.call_count == 0
+
+
+DRAIN = haproxy_synapse_reaper.DrainPolicy(
+    idle_connections=1, grace=300, soft_signal=10)
+
+
+@mock.patch('synapse_tools.haproxy_synapse_reaper.count_connections')
+def test_kill_alumni_drain_idle(mock_count_connections):
+    alumni = [
+        create_mock_process(pid=42),
+        create_mock_process(pid=43),
+    ]
+    mock_count_connections.side_effect = lambda proc: {42: 1, 43: 50}[proc.pid]
+
+    reap_count = haproxy_synapse_reaper.kill_alumni(
+        alumni=alumni, state={}, reap_age=3600, max_procs=10, now=0,
+        drain=DRAIN)
+
+    # Idle alumni go right away, busy young ones are left alone
+    assert reap_count == 1
+    assert alumni[0].kill.call_count == 1
+    assert alumni[1].kill.call_count == 0
+    assert alumni[1].send_signal.call_count == 0
+
+
+@mock.patch('synapse_tools.haproxy_synapse_reaper.count_connections')
+def test_kill_alumni_drain_busy(mock_count_connections):
+    proc = create_mock_process(pid=42)
+    mock_count_connections.return_value = 50
+    state = {42: {'create_time': 0, 'alumnus_since': 0}}
+
+    # Within the grace period of the deadline: soft signal only
+    reap_count = haproxy_synapse_reaper.kill_alumni(
+        alumni=[proc], state=state, reap_age=3600, max_procs=10, now=3400,
+        drain=DRAIN)
+    assert reap_count == 0
+    proc.send_signal.assert_called_once_with(10)
+    assert state[42]['soft_stop_at'] == 3400
+
+    # Still draining before the deadline
+    reap_count = haproxy_synapse_reaper.kill_alumni(
+        alumni=[proc], state=state, reap_age=3600, max_procs=10, now=3650,
+        drain=DRAIN)
+    assert reap_count == 0
+    assert proc.kill.call_count == 0
+
+    # Deadline passed
+    reap_count = haproxy_synapse_reaper.kill_alumni(
+        alumni=[proc], state=state, reap_age=3600, max_procs=10, now=3700,
+        drain=DRAIN)
+    assert reap_count == 1
+    assert proc.kill.call_count == 1
+    assert proc.send_signal.call_count == 1
+
+
+def test_kill_alumni_drain_busy_without_soft_signal():
+    proc = create_mock_process(pid=42)
+    state = {42: {'create_time': 0, 'alumnus_since': 0}}
+    drain = DRAIN._replace(soft_signal=None)
+
+    with mock.patch('synapse_tools.haproxy_synapse_reaper.count_connections', return_value=50):
+        # The reload already soft stopped it, so nothing to do until the deadline
+        assert haproxy_synapse_reaper.kill_alumni(
+            alumni=[proc], state=state, reap_age=3600, max_procs=10, now=3400,
+            drain=drain) == 0
+        assert haproxy_synapse_reaper.kill_alumni(
+            alumni=[proc], state=state, reap_age=3600, max_procs=10, now=3600,
+            drain=drain) == 1
+
+    assert proc.send_signal.call_count == 0
+    assert 'soft_stop_at' not in state[42]
+
+
+UNIX_SOCKETS = '''Num       RefCount Protocol Flags    Type St Inode Path
+0000000000000000: 00000002 00000000 00010000 0001 01 100 /var/run/synapse/sockets/a.sock
+0000000000000000: 00000003 00000000 00000000 0001 03 101 /var/run/synapse/sockets/a.sock
+0000000000000000: 00000003 00000000 00000000 0001 03 102
+0000000000000000: 00000002 00000000 00000000 0002 01 103 /var/run/synapse/log.sock
+0000000000000000: 00000003 00000000 00000000 0001 03 999 /var/run/synapse/sockets/b.sock
+'''
+
+
+def test_count_connections(tmpdir):
+    proc_dir = tmpdir.mkdir('42')
+    proc_dir.mkdir('net').join('unix').write(UNIX_SOCKETS)
+    fd_dir = proc_dir.mkdir('fd')
+    for fd, inode in enumerate(range(100, 104)):
+        os.symlink('socket:[%d]' % inode, str(fd_dir.join(str(fd))))
+    os.symlink('/dev/null', str(fd_dir.join('9')))
+    proc = create_mock_process(pid=42)
+    proc.connections.return_value = [
+        mock.Mock(status='ESTABLISHED'),
+        mock.Mock(status='LISTEN'),
+        mock.Mock(status='TIME_WAIT'),
+    ]
+
+    # One established TCP connection, and only the accepted unix stream
+    # connection: not the listener, the socketpair, the datagram socket nor
+    # another process' connection
+    assert haproxy_synapse_reaper.count_connections(proc, str(tmpdir)) == 2
+
+
+def test_next_reap_delay_drain():
+    state = {
+        42: {'create_time': 0, 'alumnus_since': 100},
+        43: {'create_time': 0, 'alumnus_since': 50, 'soft_stop_at': 3500},
+    }
+
+    assert haproxy_synapse_reaper.next_reap_delay(
+        state, 3600, 3000, drain_grace=300) == 400
+    del state[42]
+    assert haproxy_synapse_reaper.next_reap_delay(
+        state, 3600, 3000, drain_grace=300) == 800
+
+
+def test_next_reap_delay_drain_too_many():
+    state = {
+        42: {'create_time': 2, 'alumnus_since': 100},
+        43: {'create_time': 1, 'alumnus_since': 50, 'soft_stop_at': 3000},
+    }
+
+    # 43 is past max_procs, so it is killed once its grace period is over
+    # rather than at its reap deadline
+    assert haproxy_synapse_reaper.next_reap_delay(
+        state, 7200, 3000, drain_grace=300, max_procs=1) == 300
+    assert haproxy_synapse_reaper.next_reap_delay(
+        state, 7200, 3000, drain_grace=300, max_procs=2) == 4000
+
+
+def test_watch_pidfile_dirs_waits_for_missing_directories(tmpdir):
+    run_dir = tmpdir.mkdir('run')
+    synapse_dir = run_dir.mkdir('synapse')
+    nginx_dir = run_dir.join('nginx')
+    inotify = mock.Mock()
+    inotify.add_watch.side_effect = [1, 2, 3]
+    watched_dirs = {}
+
+    haproxy_synapse_reaper.watch_pidfile_dirs(
+        inotify, [str(synapse_dir), str(nginx_dir)], watched_dirs)
+
+    # Not ours to create, so watch for it to appear
+    assert not nginx_dir.exists()
+    assert watched_dirs == {1: str(synapse_dir), 2: str(run_dir)}
+
+    haproxy_synapse_reaper.watch_pidfile_dirs(
+        inotify, [str(synapse_dir), str(nginx_dir)], watched_dirs)
+    assert inotify.add_watch.call_count == 2
+
+    nginx_dir.mkdir()
+    haproxy_synapse_reaper.watch_pidfile_dirs(
+        inotify, [str(synapse_dir), str(nginx_dir)], watched_dirs)
+    assert watched_dirs == {1: str(synapse_dir), 2: str(run_dir), 3: str(nginx_dir)}
+    inotify.add_watch.assert_called_with(
+        str(nginx_dir), haproxy_synapse_reaper.IN_FILE_REPLACED)
+
+
+class StopDaemon(Exception):
+    pass
+
+
+@mock.patch('synapse_tools.haproxy_synapse_reaper.Inotify')
+@mock.patch('synapse_tools.haproxy_synapse_reaper.reap')
+def test_run_daemon_survives_failed_passes(mock_reap, mock_inotify, tmpdir):
+    inotify = mock_inotify.return_value.__enter__.return_value
+    inotify.add_watch.return_value = 1
+    inotify.read_events.side_effect = [[], [], StopDaemon()]
+    mock_reap.side_effect = [KeyError('getpwnam(): name not found'), psutil.AccessDenied(42), 0]
+    args = mock.Mock(poll_interval=60)
+    haproxy = HAPROXY._replace(pidfile=str(tmpdir.join('haproxy.pid')))
+
+    with pytest.raises(StopDaemon):
+        haproxy_synapse_reaper.run_daemon(args, [haproxy], {})
+
+    assert mock_reap.call_count == 3
 
-    # The pidfile '41' has no associated alumnus so should be removed
-    mock_listdir.return_value = ['41', '42']
 
-    haproxy_synapse_reaper.remove_stale_alumni_pidfiles(alumni, '/state/dir')
+@mock.patch('synapse_tools.haproxy_synapse_reaper.get_alumni')
+def test_reap_proxy_without_pidfile(mock_get_alumni, tmpdir):
+    state = {42: {'create_time': 0, 'alumnus_since': 0}}
+    nginx = HAPROXY._replace(pidfile=str(tmpdir.join('nginx.pid')))
 
-    mock_listdir.assert_called_once_with('/state/dir')
-    mock_remove.assert_called_once_with('/state/dir/41')
+    assert haproxy_synapse_reaper.reap_proxy(nginx, state) == 0
+    assert mock_get_alumni.call_count == 0
+    assert list(state) == [42]
@@ -0,0 +1,75 @@
+import mock
+import pytest
+
+from synapse_tools import configure_synapse
+from synapse_tools import healthcheck_planner
+
+
+def generate_config(**service_a):
+    location_types = ['superregion', 'region']
+    service_a.update(proxy_port=1001, discover='region')
+    with mock.patch('environment_tools.type_utils.available_location_types',
+                    return_value=location_types), \
+            mock.patch('synapse_tools.configure_synapse.available_location_types',
+                       return_value=location_types), \
+            mock.patch('synapse_tools.configure_synapse.get_current_location',
+                       return_value='my_region'):
+        return configure_synapse.generate_configuration(
+            synapse_tools_config=configure_synapse.set_defaults({'bind_addr': '0.0.0.0'}),
+            zookeeper_topology=['1.2.3.4'],
+            services=[
+                ('service_a', service_a),
+                ('service_b', {'proxy_port': 1002, 'advertise': ['region'], 'discover': 'region'}),
+            ],
+            envoy_migration_config={'migration_enabled': False, 'namespaces': {}},
+        )
+
+
+def test_parse_haproxy_time():
+    assert healthcheck_planner.parse_haproxy_time('10m') == 600
+    assert healthcheck_planner.parse_haproxy_time('30s') == 30
+    assert healthcheck_planner.parse_haproxy_time('1500') == 1.5
+    assert healthcheck_planner.parse_haproxy_time('250ms') == 0.25
+    with pytest.raises(ValueError):
+        healthcheck_planner.parse_haproxy_time('soon')
+
+
+def test_check_loads():
+    config = generate_config(
+        advertise=['region', 'superregion'],
+        endpoint_timeouts={'/slow': 10000},
+    )
+
+    loads = healthcheck_planner.check_loads(config)
+
+    # Every advertise type and endpoint timeout has its own backend, each
+    # checking every 10m, or 30s while failing or down
+    assert [(load.service, load.backends) for load in loads] == [
+        ('service_a', 4), ('service_b', 1),
+    ]
+    assert loads[0].inter_rate == pytest.approx(4 / 600)
+    assert loads[0].fastinter_rate == pytest.approx(4 / 30)
+    assert loads[0].downinter_rate == pytest.approx(4 / 30)
+
+    lines = healthcheck_planner.format_loads(loads, clients=1500)
+    assert lines[1].split() == ['service_a', '4', '10.00', '200.00', '200.00']
+
+    assert healthcheck_planner.over_limit(loads, 1500, max_qps=None) == []
+    assert healthcheck_planner.over_limit(loads, 1500, max_qps=5) == loads[:1]
+
+
+def test_check_loads_with_service_overrides():
+    config = generate_config(
+        advertise=['region'],
+        healthcheck_inter_ms=3600000,
+        healthcheck_fastinter_ms=120000,
+    )
+
+    loads = healthcheck_planner.check_loads(config)
+
+    assert loads[0].service == 'service_b'
+    service_a = loads[1]
+    assert service_a.inter_rate == pytest.approx(1 / 3600)
+    assert service_a.fastinter_rate == pytest.approx(1 / 120)
+    # Still the default-server line's
+    assert service_a.downinter_rate == pytest.approx(1 / 30)
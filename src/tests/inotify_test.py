@@ -0,0 +1,13 @@
+from synapse_tools import inotify
+
+
+def test_read_events(tmpdir):
+    with inotify.Inotify() as watcher:
+        watcher.add_watch(str(tmpdir), inotify.IN_FILE_REPLACED)
+        tmpdir.join('haproxy.pid').write('42')
+
+        events = watcher.read_events(timeout=1)
+
+        assert {event.name for event in events} == {'haproxy.pid'}
+        assert any(event.mask & inotify.IN_CLOSE_WRITE for event in events)
+        assert watcher.read_events(timeout=0) == []
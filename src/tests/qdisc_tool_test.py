@@ -0,0 +1,141 @@
+import argparse
+
+import mock
+
+from synapse_tools.haproxy import qdisc_tool
+from synapse_tools.haproxy.qdisc_util import PlugStats
+
+
+@mock.patch('synapse_tools.haproxy.qdisc_tool.subprocess.check_call')
+@mock.patch('synapse_tools.haproxy.qdisc_tool.os.getuid', return_value=0)
+@mock.patch('synapse_tools.haproxy.qdisc_tool.PlugController')
+def test_protect_call_cmd(mock_controller_cls, mock_getuid, mock_check_call, caplog, tmpdir):
+    controller = mock_controller_cls.return_value
+    controller.get_stats.side_effect = [
+        PlugStats(packets=10, bytes=600, drops=0, qlen=0, backlog=0),
+        PlugStats(packets=15, bytes=900, drops=1, qlen=0, backlog=0),
+    ]
+    calls = mock.Mock()
+    calls.attach_mock(controller.plug, 'plug')
+    calls.attach_mock(mock_check_call, 'check_call')
+    calls.attach_mock(controller.unplug, 'unplug')
+
+    args = argparse.Namespace(
+        cmd='reload', args=['haproxy'], pidfile=None, plug_limit=None,
+        state_file=str(tmpdir.join('plug.json')))
+    with caplog.at_level('INFO'):
+        assert qdisc_tool.protect_call_cmd(args) == 0
+
+    assert [name for name, _, _ in calls.mock_calls] == ['plug', 'check_call', 'unplug']
+    assert controller.close.call_count == 1
+    assert '5 packets (300 bytes) went through the plug lane, 1 dropped' in caplog.text
+    assert 'The plug overflowed and dropped 1 packets' in caplog.text
+    history = qdisc_tool.load_plug_history(args.state_file)
+    assert (history['packets'], history['bytes']) == (15, 900)
+
+
+@mock.patch('synapse_tools.haproxy.qdisc_tool.manage_plug')
+@mock.patch('synapse_tools.haproxy.qdisc_tool.subprocess.check_call')
+@mock.patch('synapse_tools.haproxy.qdisc_tool.os.getuid', return_value=0)
+@mock.patch('synapse_tools.haproxy.qdisc_tool.PlugController')
+def test_protect_call_cmd_retries_unplug(mock_controller_cls, mock_getuid, mock_check_call, mock_manage_plug, tmpdir):
+    controller = mock_controller_cls.return_value
+    controller.get_stats.return_value = None
+    controller.unplug.side_effect = RuntimeError('netlink hiccup')
+
+    args = argparse.Namespace(
+        cmd='reload', args=[], pidfile=None, plug_limit=None,
+        state_file=str(tmpdir.join('plug.json')))
+    assert qdisc_tool.protect_call_cmd(args) == 0
+
+    mock_manage_plug.assert_called_once_with('lo', enable_plug=False)
+
+
+@mock.patch('synapse_tools.haproxy.qdisc_tool.get_listeners')
+def test_wait_for_new_listeners(mock_get_listeners, tmpdir):
+    pidfile = tmpdir.join('haproxy.pid')
+    pidfile.write('43\n')
+    proc = mock.Mock()
+    proc.poll.return_value = None
+    old_listeners = frozenset([('0.0.0.0', 1234), ('0.0.0.0', 1235)])
+    # The new process binds one socket at a time
+    mock_get_listeners.side_effect = [
+        frozenset([('0.0.0.0', 1234)]),
+        old_listeners | frozenset([('0.0.0.0', 1236)]),
+    ]
+
+    assert qdisc_tool.wait_for_new_listeners(
+        proc, str(pidfile), 42, old_listeners, timeout=5)
+    mock_get_listeners.assert_called_with(43)
+
+
+def test_wait_for_new_listeners_gives_up(tmpdir):
+    pidfile = tmpdir.join('haproxy.pid')
+    pidfile.write('42\n')
+    proc = mock.Mock()
+    proc.poll.return_value = None
+
+    # The pid never changes
+    assert not qdisc_tool.wait_for_new_listeners(
+        proc, str(pidfile), 42, frozenset(), timeout=0.05)
+
+    # The command exited without starting a new process
+    proc.poll.return_value = 1
+    assert not qdisc_tool.wait_for_new_listeners(
+        proc, str(pidfile), 42, frozenset(), timeout=5)
+
+
+@mock.patch('synapse_tools.haproxy.qdisc_tool.wait_for_new_listeners')
+@mock.patch('synapse_tools.haproxy.qdisc_tool.subprocess.Popen')
+@mock.patch('synapse_tools.haproxy.qdisc_tool.os.getuid', return_value=0)
+@mock.patch('synapse_tools.haproxy.qdisc_tool.PlugController')
+def test_protect_call_cmd_unplugs_before_command_exits(
+    mock_controller_cls, mock_getuid, mock_popen, mock_wait, tmpdir,
+):
+    controller = mock_controller_cls.return_value
+    controller.get_stats.return_value = None
+    calls = mock.Mock()
+    calls.attach_mock(controller.plug, 'plug')
+    calls.attach_mock(mock_wait, 'wait_for_new_listeners')
+    calls.attach_mock(controller.unplug, 'unplug')
+    calls.attach_mock(mock_popen.return_value.wait, 'wait')
+    mock_popen.return_value.wait.return_value = 0
+
+    args = argparse.Namespace(
+        cmd='reload', args=[], pidfile=str(tmpdir.join('haproxy.pid')),
+        unplug_timeout=5, plug_limit=None,
+        state_file=str(tmpdir.join('plug.json')))
+    assert qdisc_tool.protect_call_cmd(args) == 0
+
+    assert [name for name, _, _ in calls.mock_calls] == [
+        'plug', 'wait_for_new_listeners', 'unplug', 'wait',
+    ]
+    assert controller.unplug.call_count == 1
+
+
+def test_choose_plug_limit():
+    args = argparse.Namespace(plug_limit=None, pidfile=None)
+    assert qdisc_tool.choose_plug_limit(args, None, None, now=0) is None
+
+    args.plug_limit = '2000000'
+    assert qdisc_tool.choose_plug_limit(args, None, None, now=0) == 2000000
+
+    # Nothing known yet
+    args.plug_limit = 'auto'
+    assert qdisc_tool.choose_plug_limit(args, None, None, now=0) == 1024 * 1024
+
+    # 100000 SYNs of 80 bytes over 10s, and the last window took 3s
+    history = {'time': 100, 'packets': 1000, 'bytes': 80000, 'window_s': 3}
+    stats = PlugStats(packets=101000, bytes=8080000, drops=0, qlen=0, backlog=0)
+    assert qdisc_tool.choose_plug_limit(args, history, stats, now=110) == \
+        10000 * 3 * 80 * 4
+
+    # The window can't outlast the unplug timeout
+    args.pidfile = '/var/run/synapse/haproxy.pid'
+    args.unplug_timeout = 2
+    assert qdisc_tool.choose_plug_limit(args, history, stats, now=110) == \
+        10000 * 2 * 80 * 4
+
+    # The qdisc was recreated and its counters started over
+    stats = PlugStats(packets=10, bytes=800, drops=0, qlen=0, backlog=0)
+    assert qdisc_tool.choose_plug_limit(args, history, stats, now=110) == 1024 * 1024
@@ -0,0 +1,180 @@
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import shutil
+import traceback
+
+import pytest
+from pyroute2 import IPRoute
+from pyroute2.iproute import transform_handle
+from pyroute2.netlink import NetlinkError
+
+from synapse_tools.haproxy import qdisc_util
+
+
+class FakeTcMsg(dict):
+    def __init__(self, kind, handle, parent, options=None, info=0):
+        super(FakeTcMsg, self).__init__(handle=handle, parent=parent, info=info)
+        self.attrs = {'TCA_KIND': kind, 'TCA_OPTIONS': options}
+
+    def get_attr(self, name):
+        return self.attrs.get(name)
+
+
+def test_format_handle():
+    assert qdisc_util.format_handle(0x10000) == '1:'
+    assert qdisc_util.format_handle(0x10004) == '1:4'
+    assert qdisc_util.format_handle(0x400000) == '40:'
+    assert qdisc_util.format_handle(0xFFFFFFFF) == 'root'
+
+
+def test_diff_tc_tree_matches():
+    expected = qdisc_util.expected_tc_tree()
+
+    assert qdisc_util.diff_tc_tree(expected, set(expected)) == ([], [])
+
+
+def test_diff_tc_tree_accepts_fifo_instead_of_plug():
+    expected = qdisc_util.expected_tc_tree()
+    actual = {
+        node._replace(kind='pfifo', options='limit 1000') if node.kind == 'plug' else node
+        for node in expected
+    }
+
+    assert qdisc_util.diff_tc_tree(expected, actual) == ([], [])
+
+
+def test_diff_tc_tree_reports_differences():
+    expected = qdisc_util.expected_tc_tree()
+    filter_node = [node for node in expected if node.type == 'filter'][0]
+    ingress = qdisc_util.TcNode('qdisc', 'ingress', 'ffff:', 'ffff:fff1', '')
+    actual = (expected - {filter_node}) | {ingress}
+
+    assert qdisc_util.diff_tc_tree(expected, actual) == ([filter_node], [ingress])
+
+
+def test_to_tc_nodes():
+    qdiscs = [
+        FakeTcMsg('prio', 0x10000, 0xFFFFFFFF,
+                  '04:00:00:00:01:02:02:02:01:02:00:00:01:01:01:01:01:01:01:01'),
+        FakeTcMsg('pfifo', 0x100000, 0x10001, 'e8:03:00:00'),
+    ]
+    assert qdisc_util._to_tc_nodes('qdisc', qdiscs) == {
+        qdisc_util.TcNode('qdisc', 'prio', '1:', 'root', 'bands 4'),
+        qdisc_util.TcNode('qdisc', 'pfifo', '10:', '1:1', 'limit 1000'),
+    }
+
+    fw_options = FakeTcMsg('fw', 0, 0)
+    fw_options.attrs = {'TCA_FW_CLASSID': 0x10004}
+    # prio 1, protocol ip (network byte order)
+    info = (1 << 16) | 0x0008
+    filters = [
+        # The filter head comes without a handle
+        FakeTcMsg('fw', 0, 0x10000, None, info),
+        FakeTcMsg('fw', 1, 0x10000, fw_options, info),
+    ]
+    assert qdisc_util._to_tc_nodes('filter', filters) == {
+        qdisc_util.TcNode('filter', 'fw', '0:1', '1:', 'prio 1 protocol ip classid 1:4'),
+    }
+
+
+def test_expected_tc_tree_ipv6():
+    extra = qdisc_util.expected_tc_tree(ipv6=True) - qdisc_util.expected_tc_tree()
+
+    assert extra == {
+        qdisc_util.TcNode('filter', 'fw', '0:1', '1:', 'prio 2 protocol ipv6 classid 1:4'),
+    }
+
+
+CLONE_NEWNET = 0x40000000
+
+NETNS_INTERFACE = 'synapse0'
+
+
+class NetnsUnavailable(Exception):
+    pass
+
+
+def run_in_new_netns(func):
+    """Runs `func` in a child process with a network namespace of its own,
+    so nothing it does to interfaces or the firewall leaks onto the host
+
+    Skips the test if the namespace or what `func` needs can't be had.
+    """
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+
+    def child():
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if libc.unshare(CLONE_NEWNET) != 0:
+                raise NetnsUnavailable('unshare(CLONE_NEWNET): {0}'.format(
+                    os.strerror(ctypes.get_errno())))
+            results.put(('ok', func()))
+        except NetnsUnavailable as e:
+            results.put(('skip', str(e)))
+        except Exception:
+            results.put(('error', traceback.format_exc()))
+
+    process = context.Process(target=child)
+    process.start()
+    status, value = results.get(timeout=60)
+    process.join()
+    if status == 'skip':
+        pytest.skip(value)
+    if status == 'error':
+        pytest.fail(value)
+    return value
+
+
+def create_dummy_interface(firewall):
+    ip = IPRoute()
+    try:
+        try:
+            ip.link('add', index=0, ifname=NETNS_INTERFACE, kind='dummy')
+        except NetlinkError as e:
+            raise NetnsUnavailable('No dummy interfaces: {0}'.format(e))
+        index = ip.link_lookup(ifname=NETNS_INTERFACE)[0]
+        ip.link('set', index=index, state='up')
+
+        # The plug falls back to a fifo, but there is no setup without these
+        try:
+            qdisc_util._add_qdisc(
+                ip, index, 'prio', qdisc_util.ROOT, 'root',
+                qdisc_util.PRIO_QOPT.pack(qdisc_util.PRIO_BANDS, *qdisc_util.PRIO_PRIOMAP))
+            ip.tc('add-filter', 'fw', index, 1,
+                  parent=transform_handle(qdisc_util.ROOT),
+                  prio=qdisc_util.FILTER_PRIO,
+                  protocol=qdisc_util.ETH_P_IP,
+                  classid=transform_handle(qdisc_util.PLUG_CLASS))
+        except NetlinkError as e:
+            raise NetnsUnavailable('No prio qdisc or fw classifier: {0}'.format(e))
+    finally:
+        ip.close()
+    # Start from nothing again
+    qdisc_util.clear(NETNS_INTERFACE, [], firewall)
+
+
+def setup_check_clear():
+    if shutil.which('iptables'):
+        firewall = 'iptables'
+    elif shutil.which('nft'):
+        firewall = 'nftables'
+    else:
+        raise NetnsUnavailable('Neither iptables nor nft is installed')
+    create_dummy_interface(firewall)
+
+    source_ips = ['127.0.0.1']
+    statuses = [qdisc_util.check_setup(NETNS_INTERFACE, source_ips, firewall=firewall)]
+    qdisc_util.setup(NETNS_INTERFACE, source_ips, firewall=firewall)
+    statuses.append(qdisc_util.check_setup(NETNS_INTERFACE, source_ips, firewall=firewall))
+    qdisc_util.clear(NETNS_INTERFACE, source_ips, firewall=firewall)
+    statuses.append(qdisc_util.check_setup(NETNS_INTERFACE, source_ips, firewall=firewall))
+    return statuses
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason='Needs root for a network namespace')
+def test_setup_check_clear_in_netns():
+    # Nothing, then exactly what setup creates, then nothing again
+    assert run_in_new_netns(setup_check_clear) == [1, 0, 1]
@@ -0,0 +1,87 @@
+import argparse
+import signal
+import subprocess
+import threading
+
+import mock
+import pytest
+
+from synapse_tools import reload_nginx
+
+
+def make_args(pidfile, **kwargs):
+    options = dict(
+        pidfile=pidfile,
+        old_master_timeout=5.0,
+        new_master_timeout=5.0,
+        keep_old_masters=False,
+    )
+    options.update(kwargs)
+    return argparse.Namespace(**options)
+
+
+def test_wait_for_exit():
+    proc = subprocess.Popen(['sleep', '10'])
+    try:
+        assert not reload_nginx.wait_for_exit(proc.pid, 0.05)
+    finally:
+        proc.kill()
+        proc.wait()
+    assert reload_nginx.wait_for_exit(proc.pid, 0.05)
+
+
+def test_wait_for_new_pid(tmpdir):
+    pidfile = tmpdir.join('nginx.pid')
+    pidfile.write('100\n')
+    timer = threading.Timer(0.05, lambda: pidfile.write('200\n'))
+    timer.start()
+    try:
+        assert reload_nginx.wait_for_new_pid(str(pidfile), 100, timeout=5) == 200
+    finally:
+        timer.cancel()
+
+    assert reload_nginx.wait_for_new_pid(str(pidfile), 200, timeout=0.05) is None
+
+
+@mock.patch.object(reload_nginx, 'is_nginx_master', autospec=True, return_value=True)
+@mock.patch.object(reload_nginx, 'wait_for_exit', autospec=True, return_value=True)
+@mock.patch.object(reload_nginx, 'wait_for_new_pid', autospec=True, return_value=300)
+@mock.patch.object(reload_nginx, 'signal_process', autospec=True, return_value=True)
+def test_reload_nginx(mock_signal_process, mock_wait_for_new_pid, mock_wait_for_exit,
+                      mock_is_nginx_master, tmpdir):
+    pidfile = tmpdir.join('nginx.pid')
+    pidfile.write('200\n')
+    tmpdir.join('nginx.pid.oldbin').write('100\n')
+    timings = []
+
+    reload_nginx.reload_nginx(make_args(str(pidfile)), timings)
+
+    assert mock_signal_process.call_args_list == [
+        mock.call(100, signal.SIGTERM, group=True),
+        mock.call(200, signal.SIGUSR2),
+        mock.call(200, signal.SIGWINCH),
+        mock.call(200, signal.SIGQUIT),
+    ]
+    mock_wait_for_exit.assert_called_once_with(100, 5.0)
+    assert [timing.phase for timing in timings] == [
+        'stop_previous_old_master', 'start_new_master', 'stop_old_master',
+    ]
+
+
+@mock.patch.object(reload_nginx, 'is_nginx_master', autospec=True, return_value=True)
+@mock.patch.object(reload_nginx, 'wait_for_new_pid', autospec=True, return_value=None)
+@mock.patch.object(reload_nginx, 'signal_process', autospec=True, return_value=True)
+def test_reload_nginx_new_master_fails(mock_signal_process, mock_wait_for_new_pid,
+                                       mock_is_nginx_master, tmpdir):
+    pidfile = tmpdir.join('nginx.pid')
+    pidfile.write('200\n')
+    timings = []
+
+    with pytest.raises(reload_nginx.ReloadError) as excinfo:
+        reload_nginx.reload_nginx(make_args(str(pidfile), keep_old_masters=True), timings)
+
+    assert excinfo.value.phase == 'start_new_master'
+    assert excinfo.value.exit_code == reload_nginx.EXIT_NEW_MASTER_FAILED
+    # The old master keeps serving
+    assert mock_signal_process.call_args_list == [mock.call(200, signal.SIGUSR2)]
+    assert [timing.phase for timing in timings] == ['stop_previous_old_master']